@@ -0,0 +1,177 @@
+"""In-memory stand-in for the part of pika the services use.
+
+loadtest.py installs it as sys.modules['pika'] before importing the
+services, so the store's outbox relay, the catalog's consumer and the
+gateway's cache invalidator talk to one in-process broker with fanout
+exchanges, per-queue prefetch and acks, instead of RabbitMQ. Publishing
+is synchronous, like a publisher confirm from a broker on localhost.
+"""
+import collections
+import itertools
+import threading
+import time
+import types
+import uuid
+
+
+class AMQPConnectionError(Exception):
+    pass
+
+
+exceptions = types.SimpleNamespace(AMQPConnectionError=AMQPConnectionError)
+
+
+class Broker:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.exchanges = collections.defaultdict(set)  # exchange -> bound queue names
+        self.queues = {}  # queue name -> deque of (properties, body)
+        self.published = 0
+
+    def declare_queue(self, name):
+        with self.lock:
+            self.queues.setdefault(name, collections.deque())
+
+    def publish(self, exchange, routing_key, body, properties):
+        if isinstance(body, str):
+            body = body.encode()
+        with self.lock:
+            # The default exchange '' routes to the queue named by the routing key
+            names = self.exchanges[exchange] if exchange else [routing_key]
+            for name in names:
+                self.queues.setdefault(name, collections.deque()).append((properties, body))
+            self.published += 1
+            self.lock.notify_all()
+
+    def get(self, name, timeout):
+        """Next message of a queue, or None after `timeout` seconds without one"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.lock:
+            while not self.queues[name]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            return self.queues[name].popleft()
+
+    def requeue(self, name, message):
+        with self.lock:
+            self.queues[name].appendleft(message)
+            self.lock.notify_all()
+
+
+BROKER = Broker()
+
+
+class URLParameters:
+    def __init__(self, url):
+        self.url = url
+
+
+class BasicProperties:
+    def __init__(self, delivery_mode=None, timestamp=None, message_id=None, headers=None,
+                 content_type=None, content_encoding=None, **kwargs):
+        self.delivery_mode = delivery_mode
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.timestamp = timestamp
+        self.message_id = message_id
+        self.headers = headers
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class Channel:
+    def __init__(self):
+        self.prefetch = 0
+        self.unacked = {}  # delivery tag -> (queue, message), for rejects with requeue
+        self.tags = itertools.count(1)
+        self.consumers = []
+        self.closed = False
+
+    def exchange_declare(self, exchange, exchange_type='fanout', durable=False, **kwargs):
+        with BROKER.lock:
+            BROKER.exchanges[exchange]
+
+    def queue_declare(self, queue='', durable=False, exclusive=False, arguments=None, passive=False):
+        name = queue or f'amq.gen-{uuid.uuid4().hex}'
+        BROKER.declare_queue(name)
+        with BROKER.lock:
+            count = len(BROKER.queues[name])
+        return types.SimpleNamespace(method=types.SimpleNamespace(queue=name, message_count=count))
+
+    def queue_bind(self, exchange, queue, routing_key=None):
+        with BROKER.lock:
+            BROKER.exchanges[exchange].add(queue)
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch = prefetch_count
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        BROKER.publish(exchange, routing_key, body, properties or BasicProperties())
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        if multiple:
+            self.unacked = {t: m for t, m in self.unacked.items() if t > delivery_tag}
+        else:
+            self.unacked.pop(delivery_tag, None)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        delivery = self.unacked.pop(delivery_tag, None)
+        if requeue and delivery is not None:
+            BROKER.requeue(*delivery)
+
+    def deliver(self, queue, message):
+        tag = next(self.tags)
+        self.unacked[tag] = (queue, message)
+        return types.SimpleNamespace(delivery_tag=tag)
+
+    def consume(self, queue, inactivity_timeout=None):
+        while not self.closed:
+            if self.prefetch and len(self.unacked) >= self.prefetch:
+                # Like the broker, hold back deliveries until some are acked
+                time.sleep(0.001)
+                yield None, None, None
+                continue
+            message = BROKER.get(queue, inactivity_timeout)
+            if message is None:
+                yield None, None, None
+                continue
+            properties, body = message
+            yield self.deliver(queue, message), properties, body
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers.append((queue, on_message_callback, auto_ack))
+
+    def start_consuming(self):
+        # Callbacks run one at a time, so at most one message is unacked
+        queue, callback, auto_ack = self.consumers[0]
+        while not self.closed:
+            message = BROKER.get(queue, 1.0)
+            if message is not None:
+                properties, body = message
+                if auto_ack:
+                    method = types.SimpleNamespace(delivery_tag=next(self.tags))
+                else:
+                    method = self.deliver(queue, message)
+                callback(self, method, properties, body)
+
+
+class BlockingConnection:
+    def __init__(self, parameters=None):
+        self.channels = []
+
+    def channel(self):
+        channel = Channel()
+        self.channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        for channel in self.channels:
+            channel.closed = True
@@ -0,0 +1,537 @@
+"""Load test of the whole stack on one machine, without Docker.
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --books 20000 --users 500 --concurrency 32 --duration 60
+    python benchmarks/loadtest.py --mix browse=40,login=20,edit=20,buy=20 --seed 7
+    python benchmarks/loadtest.py --baseline benchmarks/results/loadtest-20240101-120000.json
+
+The five services are copied to a temporary directory and served from this
+process on free localhost ports by threaded werkzeug servers, with local
+stand-ins for the infrastructure: SQLite instead of MySQL for the store and
+the orders and broker_shim instead of RabbitMQ, so the outbox relays, the
+catalog consumer, the gateway's cache invalidator and --order-workers order
+workers all run as they do in production.
+
+The stack is seeded with --books books (through POST /books/import, so the
+catalog gets them through events) and --users users. Then --concurrency
+virtual users, each with its own session and random generator (--seed),
+run scenarios picked by --mix for --duration seconds after --warmup:
+
+  browse  gateway /catalog, catalog() and search in catalog, list_books() in store
+  login   login() in auth, directly and through the gateway
+  edit    add a book, or edit one of the user's books, through the gateway
+  buy     buy -> pay -> deliver through the gateway; the order workers
+          then reserve the stock, charge and ship in the background
+
+Meanwhile a probe writes a book every --probe-interval seconds and times how
+long the catalog search takes to return it (replication lag).
+
+Gateway form posts count as errors when they do not redirect where a
+success does (a redirect to /login, or the form rendered again with an
+error), and a gateway login only succeeds if the session holds the user.
+
+When the load stops, the orders placed are counted by status (after up to
+30 s for the workers to catch up) with their checkout-to-shipped times.
+Throughput and p50/p95/p99 per operation are printed and saved as JSON in
+benchmarks/results/ (or --output). With --baseline, p95 of every operation
+is compared with an earlier result and the exit status is 1 when one got
+more than --max-regression slower. All services share one process and one
+GIL: compare results taken on the same machine, and do not read them as
+the capacity of a real deployment.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import re
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES_DIR = os.path.normpath(os.path.join(BENCH_DIR, '..', 'services'))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, BENCH_DIR)
+
+import broker_shim  # noqa: E402
+from replication_latency import percentile, sample as replication_sample  # noqa: E402
+
+SERVICES = {
+    'store': 'store_service',
+    'catalog': 'catalog_service',
+    'auth': 'auth_service',
+    'orders': 'order_service',
+    'frontend': 'frontend_gateway',
+}
+DATABASES = {'store': 'store.db', 'orders': 'orders.db'}  # services configured by DATABASE_URL
+SCENARIOS = ('browse', 'login', 'edit', 'buy')
+DEFAULT_MIX = 'browse=60,login=10,edit=15,buy=15'
+PASSWORD = 'bench-password'
+SORTS = ('id', 'title', 'price')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Stack:
+    """The four services, served from this process"""
+
+    def __init__(self, workdir, order_workers=2):
+        self.workdir = workdir
+        self.order_workers = order_workers
+        self.ports = {name: free_port() for name in SERVICES}
+        self.urls = {name: f'http://127.0.0.1:{port}' for name, port in self.ports.items()}
+        self.modules = {}
+        self.servers = []
+
+    def load(self, name):
+        path = os.path.join(self.workdir, SERVICES[name], 'app.py')
+        spec = importlib.util.spec_from_file_location(f'bench_{name}', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        return module
+
+    def start(self):
+        for directory in SERVICES.values():
+            shutil.copytree(os.path.join(SERVICES_DIR, directory), os.path.join(self.workdir, directory),
+                            ignore=shutil.ignore_patterns('*.db', '__pycache__'))
+        os.environ.update({
+            'RABBITMQ_URL': 'amqp://broker-shim',
+            'AUTH_SERVICE_URL': self.urls['auth'],
+            'CATALOG_SERVICE_URL': self.urls['catalog'],
+            'STORE_SERVICE_URL': self.urls['store'],
+            'ORDER_SERVICE_URL': self.urls['orders'],
+            'SERVICE_LOCK_DIR': self.workdir,
+            'CATALOG_BOOTSTRAP': 'never',
+            'CATALOG_REPLICA_ID': 'bench',
+            'AUTH_TOKEN_KEYS': f'bench:{secrets.token_urlsafe(32)}',
+            # Every virtual user comes from 127.0.0.1: per-client limits would throttle the test
+            'RATE_LIMIT_PER_IP': 'off',
+            'RATE_LIMIT_PER_USER': 'off',
+            'RATE_LIMIT_LOGIN': 'off',
+            'LOGIN_RATE_LIMIT_PER_ACCOUNT': 'off',
+        })
+        sys.modules['pika'] = broker_shim
+        sys.path[:0] = [SERVICES_DIR] + [os.path.join(self.workdir, SERVICES[n]) for n in ('auth', 'frontend')]
+
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no access log line per request
+        for name in SERVICES:
+            if name in DATABASES:
+                os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(self.workdir, DATABASES[name])
+            module = self.modules[name] = self.load(name)
+            if hasattr(module, 'create_schema'):
+                with module.app.app_context():
+                    module.create_schema()
+            module.start_background_tasks()
+            server = make_server('127.0.0.1', self.ports[name], module.app, threaded=True)
+            threading.Thread(target=server.serve_forever, name=f'serve-{name}', daemon=True).start()
+            self.servers.append(server)
+        # Order workers as threads of this process; each has its own broker connection
+        for n in range(self.order_workers):
+            threading.Thread(target=self.modules['orders'].run_worker, name=f'order-worker-{n}', daemon=True).start()
+        for url in self.urls.values():
+            wait_until(lambda: requests.get(f'{url}/healthz', timeout=1).ok, 30, f'{url} did not start')
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+
+    def order_summary(self, since, drain):
+        """Orders created since `since` (naive UTC) by status, and checkout-to-shipped times.
+
+        Waits up to `drain` seconds for the workers to finish the orders that
+        were still pending or paid when the load stopped.
+        """
+        orders = self.modules['orders']
+        deadline = time.monotonic() + drain
+        with orders.app.app_context():
+            try:
+                while True:
+                    rows = (orders.PurchaseOrder.query.filter(orders.PurchaseOrder.created_at >= since)
+                            .with_entities(orders.PurchaseOrder.status, orders.PurchaseOrder.payment_method,
+                                           orders.PurchaseOrder.provider_id, orders.PurchaseOrder.created_at,
+                                           orders.PurchaseOrder.shipped_at).all())
+                    # Orders abandoned before payment or delivery never move on
+                    in_progress = [r for r in rows if (r.status == 'pending' and r.payment_method)
+                                   or (r.status == 'paid' and r.provider_id)]
+                    if not in_progress or time.monotonic() >= deadline:
+                        break
+                    orders.db.session.remove()
+                    time.sleep(0.2)
+            finally:
+                orders.db.session.remove()
+        statuses = {}
+        for r in rows:
+            statuses[r.status] = statuses.get(r.status, 0) + 1
+        shipped = [(r.shipped_at - r.created_at).total_seconds() for r in rows if r.shipped_at]
+        summary = {'created': len(rows), 'by_status': statuses}
+        if shipped:
+            summary['checkout_to_shipped'] = {k: v for k, v in summarize(shipped, {}, 1).items()
+                                              if k == 'count' or k.endswith('_ms')}
+        return summary
+
+    def gateway_session(self, response):
+        """Contents of the session cookie the gateway set in `response`, {} if it set none"""
+        app = self.modules['frontend'].app
+        cookie = response.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+        return app.session_interface.get_signing_serializer(app).loads(cookie)
+
+    def catalog_count(self):
+        catalog = self.modules['catalog']
+        with catalog.app.app_context():
+            count = catalog.Book.query.count()
+            catalog.db.session.remove()
+            return count
+
+    def seed(self, books, users):
+        """Create `users` users sharing PASSWORD and `books` books spread over them"""
+        auth = self.modules['auth']
+        password_hash = auth.password_hasher.hash(PASSWORD)
+        with auth.app.app_context():
+            auth.db.session.execute(auth.User.__table__.insert(), [
+                {'username': f'user{i}', 'email': f'user{i}@bench.local', 'password_hash': password_hash}
+                for i in range(1, users + 1)])
+            auth.db.session.commit()
+            auth.db.session.remove()
+
+        started = time.perf_counter()
+        rng = random.Random(0)
+        for first in range(0, books, 5000):
+            rows = ''.join(json.dumps({
+                'title': f'Book {i} {rng.choice(("river", "night", "garden", "engine", "winter"))}',
+                'author': f'Author {i % 500}',
+                'description': 'A book seeded for the load test.',
+                'price': round(rng.uniform(5, 80), 2),
+                'stock': 100000,
+                'user_id': i % users + 1,
+            }) + '\n' for i in range(first, min(books, first + 5000)))
+            requests.post(f"{self.urls['store']}/books/import", data=rows,
+                          headers={'Content-Type': 'application/x-ndjson'}, timeout=300).raise_for_status()
+        wait_until(lambda: self.catalog_count() >= books, 600, 'the catalog did not replicate the seeded books')
+        return time.perf_counter() - started
+
+
+def redirect_to(pattern, flash=None, session_key=None):
+    """Expectation for a gateway form post: a redirect whose path matches `pattern`.
+
+    The gateway answers failures with 200 and a flash message, or with a
+    redirect elsewhere (e.g. to /login); `flash` (the start of the message
+    flashed on success) and `session_key` (set in the session on success)
+    tell apart the cases that redirect to the same page either way.
+    Returns check(response, session) -> None, or what went wrong.
+    """
+    def check(response, session):
+        location = response.headers.get('Location', '')
+        if not response.is_redirect:
+            return f'{response.status_code} (no redirect)'
+        path = urlsplit(location).path
+        if not re.fullmatch(pattern, path):
+            return f'{response.status_code} -> {path}'
+        if session_key and session_key not in session():
+            return f'no {session_key} in session'
+        if flash:
+            messages = [message for _, message in session().get('_flashes', [])]
+            if not any(message.startswith(flash) for message in messages):
+                return f"flash: {(messages or ['none'])[-1][:40]}"
+        return None
+    return check
+
+
+def status_ok(response, session):
+    return None if response.status_code == 200 else f'{response.status_code} (expected 200)'
+
+
+def wait_until(condition, timeout, message):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(message)
+
+
+class VirtualUser:
+    def __init__(self, index, stack, args, recorder):
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.stack = stack
+        self.urls = stack.urls
+        self.args = args
+        self.recorder = recorder
+        self.user_id = self.rng.randint(1, args.users)
+        self.session = requests.Session()
+        self.own_books = []
+
+    def call(self, operation, method, url, expect=None, **kwargs):
+        """Send a request and record it; returns the response, or None if it failed.
+
+        Statuses from 400 up are errors; so is a response `expect` (see
+        redirect_to()) finds something wrong with, e.g. a redirect to /login.
+        """
+        kwargs.setdefault('timeout', 30)
+        kwargs.setdefault('allow_redirects', False)
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+        except requests.RequestException as e:
+            response, status = None, type(e).__name__
+        elapsed = time.perf_counter() - started
+        if response is not None and status < 400 and expect is not None:
+            status = expect(response, lambda: self.stack.gateway_session(response)) or status
+        self.recorder.record(operation, elapsed, status)
+        return response if isinstance(status, int) and status < 400 else None
+
+    def login(self):
+        gateway = self.urls['frontend']
+        self.call('gateway.login', 'POST', f'{gateway}/login', expect=redirect_to('/catalog', session_key='user'),
+                  data={'email': f'user{self.user_id}@bench.local', 'password': PASSWORD})
+
+    def browse(self):
+        gateway, catalog, store = self.urls['frontend'], self.urls['catalog'], self.urls['store']
+        sort = self.rng.choice(SORTS)
+        self.call('gateway.catalog', 'GET', f'{gateway}/catalog', expect=status_ok, params={'sort': sort})
+        self.call('catalog.catalog', 'GET', f'{catalog}/catalog',
+                  params={'sort': sort, 'limit': 20, 'in_stock': self.rng.choice((0, 1))})
+        self.call('catalog.search', 'GET', f'{catalog}/catalog/search',
+                  params={'q': self.rng.choice(('river', 'night', 'garden', 'engine', 'winter'))})
+        self.call('store.list_books', 'GET', f'{store}/books', params={'user_id': self.user_id})
+
+    def login_scenario(self):
+        self.call('auth.login', 'POST', f"{self.urls['auth']}/login",
+                  json={'email': f'user{self.user_id}@bench.local', 'password': PASSWORD})
+        self.session.cookies.clear()
+        self.login()
+
+    def edit(self):
+        gateway = self.urls['frontend']
+        form = {'title': f'Bench book {self.rng.randrange(10 ** 6)}', 'author': 'Bench',
+                'description': 'Written by the load test.', 'price': round(self.rng.uniform(5, 80), 2), 'stock': 50}
+        if not self.own_books or self.rng.random() < 0.3:
+            self.call('gateway.add_book', 'POST', f'{gateway}/add_book', expect=redirect_to('/my_books'), data=form)
+            # The new book is the newest of this user in the store
+            response = requests.get(f"{self.urls['store']}/books", params={'user_id': self.user_id}, timeout=30)
+            if response.ok and response.json():
+                self.own_books = [b['id'] for b in response.json()][-20:]
+        else:
+            self.call('gateway.edit_book', 'POST', f'{gateway}/edit_book/{self.rng.choice(self.own_books)}',
+                      expect=redirect_to('/my_books', flash='Libro actualizado'), data=form)
+
+    def buy(self):
+        gateway = self.urls['frontend']
+        book_id = self.rng.randint(1, self.args.books)
+        response = self.call('gateway.buy', 'POST', f'{gateway}/buy/{book_id}', expect=redirect_to(r'/payment/\d+'),
+                             data={'quantity': 1, 'idempotency_key': f'{self.user_id}-{self.rng.random()}'})
+        if response is None:
+            return
+        purchase_id = urlsplit(response.headers['Location']).path.rsplit('/', 1)[1]
+        if self.call('gateway.pay', 'POST', f'{gateway}/payment/{purchase_id}',
+                     expect=redirect_to(rf'/delivery/{purchase_id}'), data={'method': 'card'}) is None:
+            return
+        self.call('gateway.deliver', 'POST', f'{gateway}/delivery/{purchase_id}',
+                  expect=redirect_to(rf'/orders/{purchase_id}', flash=f'Pedido #{purchase_id}'), data={'provider': '1'})
+
+    def run(self, scenarios, weights, stop):
+        self.login()
+        actions = {'browse': self.browse, 'login': self.login_scenario, 'edit': self.edit, 'buy': self.buy}
+        while not stop.is_set():
+            actions[self.rng.choices(scenarios, weights)[0]]()
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.samples = {}  # operation -> [seconds]
+        self.errors = {}  # operation -> {status or exception name: count}
+
+    def record(self, operation, seconds, status):
+        if not self.active:
+            return
+        with self.lock:
+            self.samples.setdefault(operation, []).append(seconds)
+            if not isinstance(status, int) or status >= 400:
+                errors = self.errors.setdefault(operation, {})
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+
+def summarize(seconds, errors, duration):
+    ms = [s * 1000 for s in seconds]
+    return {
+        'count': len(ms),
+        'errors': sum(errors.values()),
+        'errors_by_status': errors,
+        'throughput_rps': round(len(ms) / duration, 2),
+        'mean_ms': round(sum(ms) / len(ms), 2),
+        'p50_ms': round(percentile(ms, 50), 2),
+        'p95_ms': round(percentile(ms, 95), 2),
+        'p99_ms': round(percentile(ms, 99), 2),
+        'max_ms': round(max(ms), 2),
+    }
+
+
+def run_probe(stack, args, recorder, stop, lags):
+    probe_args = argparse.Namespace(store=stack.urls['store'], catalog=stack.urls['catalog'], user_id=1,
+                                    timeout=30, poll=0.005)
+    session = requests.Session()
+    while not stop.wait(args.probe_interval):
+        try:
+            lag, _ = replication_sample(session, probe_args)
+        except requests.RequestException:
+            continue
+        if lag is not None and recorder.active:
+            lags.append(lag)
+
+
+def parse_mix(spec):
+    weights = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f'unknown scenario {name!r}, expected one of {", ".join(SCENARIOS)}')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path, max_regression):
+    """Print p95 changes against a baseline; return the operations that regressed"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressed = []
+    print(f'\nCompared with {baseline_path} (commit {baseline.get("commit")}):')
+    for operation, stats in sorted(result['operations'].items()):
+        before = baseline.get('operations', {}).get(operation)
+        if not before:
+            continue
+        change = stats['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+        flag = '  REGRESSION' if change > max_regression else ''
+        print(f"{operation:<20} p95 {before['p95_ms']:>9.1f} -> {stats['p95_ms']:>9.1f} ms  {change:+7.1%}{flag}")
+        if flag:
+            regressed.append(operation)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16, help='virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds run before measuring')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'scenario weights (default {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--probe-interval', type=float, default=1.0, help='seconds between replication probes')
+    parser.add_argument('--order-workers', type=int, default=2, help='order worker threads (payment and delivery)')
+    parser.add_argument('--output', help='result file (default benchmarks/results/loadtest-<time>.json)')
+    parser.add_argument('--baseline', help='earlier result to compare p95 against')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='tolerated p95 increase (0.2 = 20%%)')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    stack = Stack(workdir, args.order_workers)
+    try:
+        print(f'Starting the stack in {workdir}', flush=True)
+        stack.start()
+        seed_seconds = stack.seed(args.books, args.users)
+        print(f'Seeded {args.books} books and {args.users} users ({seed_seconds:.1f}s until replicated)', flush=True)
+
+        recorder = Recorder()
+        stop = threading.Event()
+        users = [VirtualUser(i, stack, args, recorder) for i in range(args.concurrency)]
+        threads = [threading.Thread(target=u.run, args=(list(mix), list(mix.values()), stop), daemon=True)
+                   for u in users]
+        lags = []
+        threads.append(threading.Thread(target=run_probe, args=(stack, args, recorder, stop, lags), daemon=True))
+        for t in threads:
+            t.start()
+        time.sleep(args.warmup)
+        recorder.active = True
+        started = time.perf_counter()
+        measured_since = datetime.now(timezone.utc).replace(tzinfo=None)
+        time.sleep(args.duration)
+        recorder.active = False
+        duration = time.perf_counter() - started
+        stop.set()
+        for t in threads:
+            t.join(timeout=30)
+
+        operations = {op: summarize(seconds, recorder.errors.get(op, {}), duration)
+                      for op, seconds in sorted(recorder.samples.items())}
+        total = sum(s['count'] for s in operations.values())
+        lag = {k: v for k, v in summarize(lags, {}, duration).items()
+               if k == 'count' or k.endswith('_ms')} if lags else None
+        orders = stack.order_summary(measured_since, drain=30)
+        result = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+            'seed_replication_seconds': round(seed_seconds, 2),
+            'duration_seconds': round(duration, 2),
+            'throughput_rps': round(total / duration, 2),
+            'operations': operations,
+            'replication_lag': lag,
+            'orders': orders,
+        }
+
+        print(f"\n{'operation':<20} {'count':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for op, s in operations.items():
+            print(f"{op:<20} {s['count']:>7} {s['errors']:>5} {s['throughput_rps']:>8} "
+                  f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8}")
+        print(f"{'total':<20} {total:>7} {'':>5} {result['throughput_rps']:>8}")
+        if lag:
+            print(f"replication lag: {lag['count']} probes, p50 {lag['p50_ms']} ms, "
+                  f"p95 {lag['p95_ms']} ms, p99 {lag['p99_ms']} ms")
+        print(f"orders: {orders['created']} created, {orders['by_status']}")
+        if 'checkout_to_shipped' in orders:
+            shipped = orders['checkout_to_shipped']
+            print(f"checkout to shipped: p50 {shipped['p50_ms']} ms, p95 {shipped['p95_ms']} ms, "
+                  f"p99 {shipped['p99_ms']} ms")
+
+        output = args.output or os.path.join(RESULTS_DIR, f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'\nResults saved to {output}')
+
+        if args.baseline and compare(result, args.baseline, args.max_regression):
+            sys.exit(1)
+    finally:
+        stack.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""End-to-end write-to-read-visible latency of the catalog replica.
+
+    python benchmarks/replication_latency.py --store http://localhost:5003 --catalog http://localhost:5002
+    python benchmarks/replication_latency.py --samples 200 --interval 0.05
+
+Each sample creates a book with a unique title in the store, then polls the
+catalog's search until the book shows up, and deletes it afterwards. This is
+the delay a user sees between saving a book and finding it in the catalog:
+outbox relay, broker, consumer batching and the catalog commit together.
+The write is sent with its own traceparent, so with TRACE_EXPORTER=file the
+slowest samples can be looked up with `python -m common.tracing`.
+"""
+import argparse
+import os
+import statistics
+import time
+import uuid
+
+import requests
+
+
+def traceparent():
+    return f'00-{uuid.uuid4().hex}-{uuid.uuid4().hex[:16]}-01'
+
+
+def sample(session, args):
+    title = f'probe{uuid.uuid4().hex}'
+    header = traceparent()
+    book = {'title': title, 'author': 'probe', 'price': 1, 'stock': 1, 'user_id': args.user_id}
+    written = time.perf_counter()
+    response = session.post(f'{args.store}/books', json=book, headers={'traceparent': header}, timeout=5)
+    response.raise_for_status()
+    book_id = response.json()['id']
+    try:
+        deadline = written + args.timeout
+        while time.perf_counter() < deadline:
+            found = session.get(f'{args.catalog}/catalog/search', params={'q': title}, timeout=5)
+            if found.ok and found.json().get('items'):
+                return time.perf_counter() - written, header.split('-')[1]
+            time.sleep(args.poll)
+        return None, header.split('-')[1]
+    finally:
+        session.delete(f'{args.store}/books/{book_id}', timeout=5)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', default=os.getenv('STORE_SERVICE_URL', 'http://localhost:5003'))
+    parser.add_argument('--catalog', default=os.getenv('CATALOG_SERVICE_URL', 'http://localhost:5002'))
+    parser.add_argument('--user-id', type=int, default=1, help='owner of the probe books')
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between samples')
+    parser.add_argument('--poll', type=float, default=0.01, help='seconds between catalog polls')
+    parser.add_argument('--timeout', type=float, default=30, help='give up on a sample after this many seconds')
+    args = parser.parse_args()
+
+    session = requests.Session()
+    latencies = []
+    slowest = []
+    for _ in range(args.samples):
+        latency, trace_id = sample(session, args)
+        if latency is None:
+            print(f'not visible after {args.timeout}s (trace {trace_id})')
+        else:
+            latencies.append(latency)
+            slowest.append((latency, trace_id))
+        time.sleep(args.interval)
+
+    if not latencies:
+        return
+    ms = [l * 1000 for l in latencies]
+    print(f'samples {len(ms)}  mean {statistics.mean(ms):.1f} ms  p50 {percentile(ms, 50):.1f} ms  '
+          f'p95 {percentile(ms, 95):.1f} ms  p99 {percentile(ms, 99):.1f} ms  max {max(ms):.1f} ms')
+    for latency, trace_id in sorted(slowest, reverse=True)[:3]:
+        print(f'  {latency * 1000:.1f} ms  trace {trace_id}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Peak memory of the list endpoints while they serve large tables.
+
+    python benchmarks/streaming_memory.py                    # every service, 10k and 1M rows
+    python benchmarks/streaming_memory.py --service auth --rows 100000,1000000
+
+Each service is copied to a temporary directory and runs on a SQLite
+database there, so the checkout is never touched. Every measurement runs in
+a fresh process, reads the whole response and reports the growth of the
+peak RSS, for the streaming endpoint and for the previous approach of
+loading every row as an ORM object and jsonify-ing the full list. With
+streaming the peak stays flat as the table grows.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVICES_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services'))
+
+ENDPOINTS = {
+    'store': ('store_service', '/books'),
+    'catalog': ('catalog_service', '/catalog?format=ndjson'),
+    'auth': ('auth_service', '/users'),
+}
+DATABASES = {
+    'store': 'store.db',
+    'catalog': 'catalog.db',
+    'auth': 'auth.db',
+}
+
+
+def load_service(service, workdir):
+    """Import a service's app.py from its copy in workdir"""
+    if service == 'store':
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, DATABASES['store'])
+    sys.path.insert(0, SERVICES_DIR)  # for the shared `common` package
+    sys.path.insert(0, workdir)  # for the service's own modules, e.g. auth's hashing
+    path = os.path.join(workdir, 'app.py')
+    spec = importlib.util.spec_from_file_location(f'{service}_app', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_schema(service, module):
+    with module.app.app_context():
+        if service == 'auth':
+            module.db.create_all()
+        else:
+            module.create_schema()
+
+
+def fill(service, workdir, rows):
+    """Add rows until the service's main table holds `rows` rows"""
+    conn = sqlite3.connect(os.path.join(workdir, DATABASES[service]))
+    table = 'user' if service == 'auth' else 'book'
+    start = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    if service == 'store':
+        sql = ('INSERT INTO book (title, author, description, price, stock, user_id, version, updated_at) '
+               "VALUES (?, ?, ?, ?, ?, ?, 1, '2024-01-01 00:00:00')")
+        params = ((f'Book {i}', f'Author {i % 1000}', 'A description of a fairly ordinary book.',
+                   float(i % 100), i % 10, i % 500) for i in range(start, rows))
+    elif service == 'catalog':
+        sql = 'INSERT INTO book (title, author, description, price, stock, version) VALUES (?, ?, ?, ?, ?, 1)'
+        params = ((f'Book {i}', f'Author {i % 1000}', 'A description of a fairly ordinary book.',
+                   float(i % 100), i % 10) for i in range(start, rows))
+    else:
+        sql = 'INSERT INTO "user" (username, email, password_hash) VALUES (?, ?, ?)'
+        params = ((f'user{i}', f'user{i}@example.com', 'pbkdf2:sha256:600000$' + 'x' * 80)
+                  for i in range(start, rows))
+    with conn:
+        conn.executemany(sql, params)
+    conn.close()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024 * 1024)
+
+
+def materialized(service, module):
+    """The list endpoints as they were before streaming"""
+    if service == 'auth':
+        users = module.User.query.all()
+        return module.jsonify([{'id': u.id, 'username': u.username, 'email': u.email} for u in users])
+    if service == 'catalog':
+        books = module.Book.query.order_by(module.Book.id).all()
+        return module.jsonify({'items': [b.to_dict() for b in books]})
+    return module.jsonify([b.to_dict() for b in module.Book.query.all()])
+
+
+def measure(service, workdir, mode):
+    module = load_service(service, workdir)
+    path = ENDPOINTS[service][1]
+    client = module.app.test_client()
+    client.get('/')  # warm up Flask before the baseline
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    size = 0
+    if mode == 'stream':
+        response = client.get(path, buffered=False)
+        for chunk in response.response:
+            size += len(chunk)
+        response.close()
+    else:
+        with module.app.test_request_context(path):
+            size = len(materialized(service, module).get_data())
+    return {
+        'seconds': round(time.perf_counter() - started, 2),
+        'bytes': size,
+        'peak_mb': round(peak_rss_mb() - baseline, 1),
+    }
+
+
+def run_worker(args):
+    if args.phase == 'schema':
+        create_schema(args.service, load_service(args.service, args.workdir))
+    elif args.phase == 'fill':
+        fill(args.service, args.workdir, args.rows)
+    else:
+        print(json.dumps(measure(args.service, args.workdir, args.phase)))
+
+
+def worker(*args):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', *map(str, args)],
+                            check=True, capture_output=True, text=True).stdout
+    return output.strip().splitlines()[-1] if output.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--service', choices=sorted(ENDPOINTS), action='append',
+                        help='service to measure (repeatable, default: all)')
+    parser.add_argument('--rows', default='10000,1000000', help='comma-separated table sizes')
+    parser.add_argument('--skip-materialized', action='store_true',
+                        help='only measure the streaming endpoint (the old path needs a lot of memory at 1M rows)')
+    parser.add_argument('--worker', nargs=4, metavar=('PHASE', 'SERVICE', 'WORKDIR', 'ROWS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        phase, service, workdir, rows = args.worker
+        run_worker(argparse.Namespace(phase=phase, service=service, workdir=workdir, rows=int(rows)))
+        return
+
+    sizes = sorted(int(n) for n in args.rows.split(','))
+    modes = ['stream'] if args.skip_materialized else ['stream', 'materialized']
+    print(f"{'service':<8} {'rows':>9} {'mode':<13} {'peak MB':>8} {'seconds':>8} {'MB sent':>8}")
+    for service in args.service or sorted(ENDPOINTS):
+        workdir = tempfile.mkdtemp(prefix=f'bench-{service}-')
+        try:
+            shutil.copytree(os.path.join(SERVICES_DIR, ENDPOINTS[service][0]), workdir,
+                            dirs_exist_ok=True, ignore=shutil.ignore_patterns('*.db', '__pycache__'))
+            worker('schema', service, workdir, 0)
+            for rows in sizes:
+                worker('fill', service, workdir, rows)
+                for mode in modes:
+                    result = json.loads(worker(mode, service, workdir, rows))
+                    print(f"{service:<8} {rows:>9} {mode:<13} {result['peak_mb']:>8} "
+                          f"{result['seconds']:>8} {result['bytes'] / 1e6:>8.1f}", flush=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,128 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, g
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import text
 import os
+import hashlib
+import secrets
+from datetime import datetime, timedelta, timezone
+from common import tokens, serving, metrics, tracing, sqlite, migrations, ratelimit, streaming
+from hashing import PasswordHasher, HashingOverloaded
 
 app = Flask(__name__)
 BASE_DIR = os.path.dirname(__file__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE_DIR, 'auth.db')
+# WAL mode, one writer connection per process and a pool of read
+# connections, so logins and token checks do not queue behind writes
+# (see common/sqlite.py)
+sqlite.configure(app, os.path.join(BASE_DIR, 'auth.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options=sqlite.session_options())
+sqlite.init_app(app, db)
+
+# GET /metrics: request and query latencies, plus password hashing (hashing.py)
+metrics.init_app(app)
+metrics.instrument_sqlalchemy()
+# Traces: a server span per request and a span per query (see common/tracing.py)
+tracing.init_app(app, 'auth')
+tracing.instrument_sqlalchemy()
+
+# Access tokens are short-lived and verified locally by every service (see
+# common/tokens.py); refresh tokens are opaque, stored hashed, and rotated on
+# every use.
+TOKEN_KEYS = tokens.load_keys()
+REFRESH_TOKEN_TTL = int(os.getenv('REFRESH_TOKEN_TTL', str(14 * 24 * 3600)))
+# A refresh token rotated less than this many seconds ago is still accepted
+# once more while the token that replaced it is live: two requests of the
+# same session refreshing at once, not a stolen token
+REFRESH_REUSE_GRACE = float(os.getenv('REFRESH_REUSE_GRACE', '10'))
+
+# Password hashes run in a bounded process pool (see hashing.py)
+password_hasher = PasswordHasher()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(150), unique=True, nullable=False)
-    email = db.Column(db.String(150), unique=True, nullable=False)
+    # Named unique indexes (ix_user_username, ix_user_email) for the lookups
+    # of register and login
+    username = db.Column(db.String(150), unique=True, index=True, nullable=False)
+    email = db.Column(db.String(150), unique=True, index=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username, 'email': self.email}
+
+class RefreshToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=True)
+    # The token issued when this one was rotated
+    replaced_by_id = db.Column(db.Integer, nullable=True)
+
+class RevokedToken(db.Model):
+    """Access token revoked before its expiry, listed by /token/revocations until then"""
+    jti = db.Column(db.String(32), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def hash_refresh_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_tokens(user, replaces=None):
+    """New access + refresh token pair for `user` (caller commits); `replaces`
+    is the refresh token being rotated, which is linked to the new one"""
+    access_token, _, exp = tokens.issue_access_token(
+        {'sub': str(user.id), 'name': user.username, 'email': user.email}, TOKEN_KEYS)
+    refresh_token = secrets.token_urlsafe(32)
+    stored = RefreshToken(user_id=user.id, token_hash=hash_refresh_token(refresh_token),
+                          expires_at=utcnow() + timedelta(seconds=REFRESH_TOKEN_TTL))
+    db.session.add(stored)
+    if replaces is not None:
+        db.session.flush()
+        replaces.replaced_by_id = stored.id
+    return {
+        'access_token': access_token,
+        'refresh_token': refresh_token,
+        'token_type': 'Bearer',
+        'expires_in': exp - int(datetime.now(timezone.utc).timestamp()),
+    }
+
+def load_revocations():
+    now = utcnow()
+    rows = db.session.query(RevokedToken.jti, RevokedToken.expires_at).filter(RevokedToken.expires_at > now)
+    return {jti: int(expires_at.replace(tzinfo=timezone.utc).timestamp()) for jti, expires_at in rows}
+
+verifier = tokens.TokenVerifier(TOKEN_KEYS, tokens.RevocationList(load_revocations))
+tokens.init_app(app, verifier)
+
+# Bursts of logins are cut before they reach the hasher, and requests past
+# the concurrency limit are shed with 503 (see common/ratelimit.py)
+rate_limiter = ratelimit.RateLimiter()
+# Password guessing against one account, from however many addresses
+ACCOUNT_LOGIN_LIMIT = ratelimit.parse_limit(os.getenv('LOGIN_RATE_LIMIT_PER_ACCOUNT', '10/minute'))
+# Per client address on /login and /register. Off by default: unless
+# TRUSTED_PROXY_HOPS is set, every request comes from the gateway's address.
+IP_LOGIN_LIMIT = ratelimit.parse_limit(os.getenv('AUTH_RATE_LIMIT_PER_IP', 'off'))
+admission = ratelimit.AdmissionControl()
+
+@app.before_request
+def limit_credential_requests():
+    if request.method == 'POST' and request.endpoint in ('login', 'register'):
+        rate_limiter.hit('auth_ip', ratelimit.client_ip(), IP_LOGIN_LIMIT)
+
+ratelimit.init_app(app, admission)
+
+@app.errorhandler(HashingOverloaded)
+def hashing_overloaded(e):
+    app.logger.warning(f"Shedding request: {e}")
+    response = jsonify({'error': 'overloaded', 'description': 'too many logins in progress, retry shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 @app.route('/')
 def index():
@@ -35,7 +140,7 @@ def register():
         abort(400, 'username already exists')
     if User.query.filter_by(email=email).first():
         abort(400, 'email already exists')
-    u = User(username=username, email=email, password_hash=generate_password_hash(password))
+    u = User(username=username, email=email, password_hash=password_hasher.hash(password))
     db.session.add(u)
     db.session.commit()
     return jsonify({'id': u.id, 'username': u.username, 'email': u.email}), 201
@@ -47,19 +152,120 @@ def login():
     password = data.get('password')
     if not email or not password:
         abort(400, 'email and password required')
+    rate_limiter.hit('login_account', email.strip().lower(), ACCOUNT_LOGIN_LIMIT)
     u = User.query.filter_by(email=email).first()
     if not u or not u.check_password(password):
         abort(401, 'invalid credentials')
-    # For now return a simple success message; token-based auth can be added later
-    return jsonify({'message': 'logged_in', 'user': {'id': u.id, 'username': u.username, 'email': u.email}})
+    if password_hasher.needs_rehash(u.password_hash):
+        # Hashed with older parameters: upgrade it now that we know the password
+        try:
+            u.password_hash = password_hasher.hash(password)
+        except HashingOverloaded:
+            pass  # retried at the next login
+    issued = issue_tokens(u)
+    db.session.commit()
+    return jsonify(dict(issued, message='logged_in', user=u.to_dict()))
+
+@app.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    """Exchange a refresh token for a new token pair; the old refresh token stops working"""
+    data = request.get_json() or {}
+    presented = data.get('refresh_token')
+    if not presented:
+        abort(400, 'refresh_token required')
+    token_hash = hash_refresh_token(presented)
+    now = utcnow()
+    # Compare-and-set on the writer: of two requests presenting the same
+    # token, exactly one rotates it, and the other sees it rotated
+    claimed = (RefreshToken.query
+               .filter(RefreshToken.token_hash == token_hash, RefreshToken.revoked_at.is_(None),
+                       RefreshToken.expires_at > now)
+               .update({'revoked_at': now}, synchronize_session=False))
+    stored = RefreshToken.query.filter_by(token_hash=token_hash).first()
+    if claimed:
+        issued = issue_tokens(db.session.get(User, stored.user_id), replaces=stored)
+        db.session.commit()
+        return jsonify(issued)
+    if not stored or stored.expires_at <= now:
+        db.session.rollback()
+        abort(401, 'invalid refresh token')
+    successor = db.session.get(RefreshToken, stored.replaced_by_id) if stored.replaced_by_id else None
+    if (successor is not None and successor.revoked_at is None
+            and now - stored.revoked_at <= timedelta(seconds=REFRESH_REUSE_GRACE)):
+        # The request that lost the race above: a pair of its own, without rotating again
+        issued = issue_tokens(db.session.get(User, stored.user_id))
+        db.session.commit()
+        return jsonify(issued)
+    # A rotated token used again was probably stolen: end every session of the user
+    RefreshToken.query.filter_by(user_id=stored.user_id, revoked_at=None).update({'revoked_at': now})
+    db.session.commit()
+    abort(401, 'invalid refresh token')
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    """Revoke the refresh token in the body and the access token in Authorization"""
+    data = request.get_json() or {}
+    if data.get('refresh_token'):
+        RefreshToken.query.filter_by(token_hash=hash_refresh_token(data['refresh_token']), revoked_at=None) \
+            .update({'revoked_at': utcnow()})
+    claims = g.token_claims
+    if claims:
+        expires_at = datetime.fromtimestamp(claims['exp'], timezone.utc).replace(tzinfo=None)
+        db.session.merge(RevokedToken(jti=claims['jti'], expires_at=expires_at))
+        verifier.revocations.add(claims['jti'], claims['exp'])
+    # Forget revocations of tokens that have expired anyway
+    RevokedToken.query.filter(RevokedToken.expires_at <= utcnow()).delete()
+    db.session.commit()
+    return jsonify({'message': 'logged_out'})
+
+@app.route('/token/revocations', methods=['GET'])
+def token_revocations():
+    """Ids of revoked access tokens that have not expired yet: {"revoked": {jti: exp}}"""
+    return jsonify({'revoked': load_revocations()})
 
 @app.route('/users', methods=['GET'])
 def get_users():
-    """Obtiene la lista de todos los usuarios registrados"""
-    users = User.query.all()
-    return jsonify([{'id': u.id, 'username': u.username, 'email': u.email} for u in users])
+    """Obtiene la lista de todos los usuarios registrados (NDJSON con ?format=ndjson)"""
+    # Streamed from a column-only query: the password hashes are never loaded
+    query = db.session.query(User.id, User.username, User.email).order_by(User.id)
+    return streaming.stream_json(streaming.iterate_rows(query), streaming.wants_ndjson())
+
+@app.route('/hashing/stats')
+def hashing_stats():
+    return jsonify(password_hasher.stats())
+
+@app.route('/admission/stats')
+def admission_stats():
+    return jsonify({'admission': admission.stats(), 'rate_limits': rate_limiter.stats()})
+
+serving.add_health_routes(app, {'database': lambda: db.session.execute(text('SELECT 1'))})
+
+def create_user_indexes(conn):
+    # Databases created before these indexes keep their implicit UNIQUE
+    # constraints too: SQLite cannot drop them without rebuilding the table
+    migrations.create_index(conn, User.__table__, 'ix_user_username')
+    migrations.create_index(conn, User.__table__, 'ix_user_email')
+
+# Schema changes made after the first deploy, applied in order by
+# create_schema() (see common/migrations.py). Append, never edit or reorder.
+MIGRATIONS = [
+    (1, 'named unique indexes on user.username and user.email', create_user_indexes),
+    (2, 'refresh_token.replaced_by_id',
+     lambda conn: migrations.add_column(conn, 'refresh_token', 'replaced_by_id', 'INTEGER NULL')),
+]
+
+def create_schema():
+    """Create missing tables, then apply pending migrations"""
+    db.create_all()
+    migrations.migrate(db.engine, MIGRATIONS, app.logger)
+
+def start_background_tasks():
+    """Start this process's password hashing pool"""
+    password_hasher.start()
 
 if __name__ == '__main__':
+    # Development server; production runs gunicorn with gunicorn.conf.py
     with app.app_context():
-        db.create_all()
+        create_schema()
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,194 @@
+"""Password hashing off the request threads.
+
+Hashes are computed in a small process pool, so a burst of logins keeps
+the CPU-heavy work out of the server process and cannot starve the other
+requests. The pool accepts at most HASH_MAX_PENDING jobs at a time (by
+default, what it can hash in HASH_QUEUE_TARGET seconds); past that, or
+when a job waits longer than HASH_TIMEOUT, HashingOverloaded is raised and
+the caller answers 503 instead of queueing without bound.
+
+Each server worker process has its own pool and queue. By default the
+WEB_CONCURRENCY workers split the CPUs between their pools, so the
+container runs one hashing process per core and the queues add up to what
+all the cores hash in HASH_QUEUE_TARGET seconds.
+
+PASSWORD_HASH_METHOD picks the algorithm and its cost, using werkzeug's
+method strings ("scrypt:32768:8:1", "pbkdf2:sha256:600000") or
+"argon2:<time_cost>:<memory_kib>:<parallelism>" when argon2-cffi is
+installed. Stored hashes made with other parameters keep working and are
+reported by needs_rehash(), so they are upgraded at the next login.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from common import metrics
+
+
+def pool_size(cpus, server_workers):
+    """Hashing processes of one server worker when `server_workers` share `cpus`"""
+    return max(1, cpus // max(server_workers, 1))
+
+
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# Server worker processes of the container, exported by gunicorn.conf.py
+SERVER_WORKERS = int(os.getenv('WEB_CONCURRENCY', '1'))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(pool_size(os.cpu_count() or 1, SERVER_WORKERS))))
+HASH_TIMEOUT = float(os.getenv('HASH_TIMEOUT', '5'))
+# A job queued behind n others waits about n / HASH_WORKERS hash times, so
+# the queue is sized from the time of one hash (measured at start-up) to
+# what the pool clears in HASH_QUEUE_TARGET seconds: with the default
+# scrypt cost (~0.12 s per hash on one core) that is ~16 per worker. A
+# burst of logins then waits a couple of seconds, well under HASH_TIMEOUT,
+# instead of being shed while the pool is merely busy; past that, waiting
+# longer would only turn into timeouts. HASH_MAX_PENDING overrides it, per
+# server worker like HASH_WORKERS.
+HASH_QUEUE_TARGET = float(os.getenv('HASH_QUEUE_TARGET', '2'))
+HASH_MAX_PENDING = int(os.getenv('HASH_MAX_PENDING', '0'))  # 0: sized as above
+
+
+# Time seen by the request: waiting for a pool worker plus hashing
+HASH_SECONDS = metrics.Histogram('password_hash_duration_seconds',
+                                 'Time to hash or verify a password, including the wait for the pool',
+                                 ('operation', 'result'))
+
+
+class HashingOverloaded(Exception):
+    """Too many hashes pending: the request should be retried later"""
+
+
+def queue_size(workers, hash_seconds, target=HASH_QUEUE_TARGET):
+    """Jobs `workers` processes finish within `target` seconds, at least one per worker"""
+    return max(workers, 1, int(workers * target / max(hash_seconds, 1e-3)))
+
+
+def argon2_hasher(method):
+    from argon2 import PasswordHasher  # optional dependency, only for argon2 methods
+    params = [int(p) for p in method.split(':')[1:]]
+    names = ('time_cost', 'memory_cost', 'parallelism')
+    return PasswordHasher(**dict(zip(names, params)))
+
+
+# Module-level functions so the pool can pickle them
+def compute_hash(password, method):
+    if method.startswith('argon2'):
+        return argon2_hasher(method).hash(password)
+    return generate_password_hash(password, method)
+
+
+def check_hash(stored, password):
+    if stored.startswith('$argon2'):
+        from argon2.exceptions import InvalidHashError, VerificationError
+        try:
+            return argon2_hasher('argon2').verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored, password)
+
+
+class PasswordHasher:
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=HASH_WORKERS,
+                 max_pending=HASH_MAX_PENDING, timeout=HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        # Werkzeug fills in default parameters ("scrypt" -> "scrypt:32768:8:1"):
+        # hashes are compared against the prefix it actually writes
+        started = time.perf_counter()
+        sample = compute_hash('', method)
+        self.hash_seconds = time.perf_counter() - started
+        self.prefix = None if method.startswith('argon2') else sample.split('$')[0]
+        self.max_pending = max_pending or queue_size(workers, self.hash_seconds)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.counters = {'hashed': 0, 'verified': 0, 'shed': 0, 'timeouts': 0}
+
+    def start(self):
+        """Create the worker pool (call before the server starts its threads)"""
+        with self.lock:
+            if self.workers > 0 and self.executor is None:
+                # forkserver: workers are forked from a clean single-threaded process
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context(method))
+            return self.executor
+
+    def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        executor = self.start()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counters['shed'] += 1
+                raise HashingOverloaded(f'{self.pending} password hashes pending')
+            self.pending += 1
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.finish(None)
+            self.restart()
+            raise HashingOverloaded('password hashing pool restarted')
+        future.add_done_callback(self.finish)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.counters['timeouts'] += 1
+            raise HashingOverloaded('password hashing timed out')
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory): start a fresh pool for the next requests
+            self.restart()
+            raise HashingOverloaded('password hashing pool restarted')
+
+    def restart(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def finish(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def timed_run(self, operation, fn, *args):
+        started = time.perf_counter()
+        result = 'overloaded'
+        try:
+            value = self.run(fn, *args)
+            result = 'ok'
+            return value
+        finally:
+            HASH_SECONDS.observe(time.perf_counter() - started, operation=operation, result=result)
+
+    def hash(self, password):
+        result = self.timed_run('hash', compute_hash, password, self.method)
+        with self.lock:
+            self.counters['hashed'] += 1
+        return result
+
+    def verify(self, stored, password):
+        result = self.timed_run('verify', check_hash, stored, password)
+        with self.lock:
+            self.counters['verified'] += 1
+        return result
+
+    def needs_rehash(self, stored):
+        """True if `stored` was made with another algorithm or other parameters"""
+        if self.prefix is not None:
+            return stored.split('$')[0] != self.prefix
+        if not stored.startswith('$argon2'):
+            return True
+        return argon2_hasher(self.method).check_needs_rehash(stored)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=self.pending, max_pending=self.max_pending,
+                        workers=self.workers, server_workers=SERVER_WORKERS, method=self.method,
+                        hash_seconds=round(self.hash_seconds, 4))
@@ -1,56 +1,456 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import tuple_, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import os
 import pika
+import requests
+import socket
 import json
+import base64
+import re
 import threading
 import time
+import zlib
+from datetime import datetime, timezone
+from common import tokens, serving, metrics, tracing, sqlite, migrations, events, streaming, conditional
 
 app = Flask(__name__)
 BASE_DIR = os.path.dirname(__file__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(BASE_DIR, "catalog.db")}'
+# WAL mode, a single writer (the event consumer) and a pool of read
+# connections for the HTTP threads (see common/sqlite.py)
+sqlite.configure(app, os.path.join(BASE_DIR, 'catalog.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options=sqlite.session_options())
+sqlite.init_app(app, db)
+
+# GET /metrics: request and query latencies, plus the event consumer below
+metrics.init_app(app)
+metrics.instrument_sqlalchemy()
+# Traces: a server span per request and a span per query (see common/tracing.py)
+tracing.init_app(app, 'catalog')
+tracing.instrument_sqlalchemy()
+
+# The catalog is public; callers that send an access token are identified
+# locally (g.token_claims) without a call to auth_service.
+AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://auth_service:5001')
+tokens.init_app(app, tokens.TokenVerifier(
+    revocations=tokens.RevocationList(tokens.http_revocation_loader(AUTH_SERVICE_URL))))
 
 # RabbitMQ setup
 rabbitmq_url = os.getenv('RABBITMQ_URL', 'amqp://rabbitmq')
+STORE_SERVICE_URL = os.getenv('STORE_SERVICE_URL', 'http://store_service:5003')
+
+# Every replica owns a durable queue bound to book_events, so events published
+# while it is down wait for it. Queues of replicas that never come back are
+# removed by the broker after CATALOG_QUEUE_EXPIRES_HOURS without consumers.
+CATALOG_REPLICA_ID = os.getenv('CATALOG_REPLICA_ID', socket.gethostname())
+CATALOG_QUEUE = f'catalog.{CATALOG_REPLICA_ID}'
+CATALOG_QUEUE_EXPIRES = int(float(os.getenv('CATALOG_QUEUE_EXPIRES_HOURS', '72')) * 3600 * 1000)
+
+# Bootstrap from a store snapshot: 'auto' only when catalog.db is empty,
+# 'always' to resync on every start, 'never' to rely on the queue alone.
+CATALOG_BOOTSTRAP = os.getenv('CATALOG_BOOTSTRAP', 'auto')
+SNAPSHOT_BATCH_SIZE = 1000
+
+# Batching of the event consumer: up to CONSUMER_PREFETCH unacked messages are
+# in flight, and they are applied in one transaction every CONSUMER_BATCH_SIZE
+# messages or CONSUMER_BATCH_WINDOW_MS milliseconds, whichever comes first.
+CONSUMER_PREFETCH = int(os.getenv('CONSUMER_PREFETCH', '500'))
+CONSUMER_BATCH_SIZE = int(os.getenv('CONSUMER_BATCH_SIZE', '200'))
+CONSUMER_BATCH_WINDOW = int(os.getenv('CONSUMER_BATCH_WINDOW_MS', '200')) / 1000.0
+QUEUE_DEPTH_INTERVAL = 5  # seconds between broker queue depth samples
+# A message that fails for any reason but being malformed (the database is
+# locked, the store cannot be reached to fill a gap) goes back to the queue
+# after CONSUMER_RETRY_DELAY seconds instead of being dropped.
+CONSUMER_RETRY_DELAY = float(os.getenv('CONSUMER_RETRY_DELAY', '1.0'))
+
+class ConsumerStats:
+    """Throughput and lag counters of the event consumer, read by /consumer/stats.
+
+    processed and messages_per_sec count book events, which may be more
+    than broker messages when the store sends batches.
+    """
+
+    RATE_WINDOW = 10  # seconds of history used for messages/sec
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.queue_depth = None
+        self.last_event_age = None
+        self.last_batch_at = None
+        self.recent = []  # (monotonic time, messages) per committed batch
+
+    def record_batch(self, count, failed, oldest_timestamp):
+        now = time.monotonic()
+        with self.lock:
+            self.processed += count
+            self.failed += failed
+            self.batches += 1
+            self.last_batch_at = time.time()
+            if oldest_timestamp:
+                self.last_event_age = max(0.0, time.time() - oldest_timestamp)
+            self.recent.append((now, count))
+            self.recent = [(t, n) for t, n in self.recent if now - t <= self.RATE_WINDOW]
+
+    def record_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depth = depth
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            recent = sum(n for t, n in self.recent if now - t <= self.RATE_WINDOW)
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'messages_per_sec': round(recent / self.RATE_WINDOW, 2),
+                'queue_depth': self.queue_depth,
+                'last_event_age_seconds': self.last_event_age,
+                'last_batch_at': self.last_batch_at,
+            }
+
+consumer_stats = ConsumerStats()
+
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+EVENT_SECONDS = metrics.Histogram('catalog_event_processing_seconds',
+                                  'Time to apply one book event (without the commit)', ('type',))
+BATCH_SECONDS = metrics.Histogram('catalog_consumer_batch_seconds',
+                                  'Time to apply, commit and ack one batch of messages')
+CONSUMER_EVENTS = metrics.Counter('catalog_consumer_events_total',
+                                  'Book events applied (result="applied"), malformed messages rejected '
+                                  '(result="rejected") and messages requeued to retry (result="requeued")',
+                                  ('result',))
+# Write-to-visible latency, see record_visible()
+REPLICATION_LAG_SECONDS = metrics.Histogram('catalog_replication_lag_seconds',
+                                            'Time from the store writing a change to the catalog making it readable',
+                                            buckets=LAG_BUCKETS)
+QUEUE_DEPTH = metrics.Gauge('catalog_consumer_queue_depth', 'Messages waiting in the replica queue')
+EVENT_GAPS = metrics.Counter('catalog_event_gaps_total',
+                             'Deltas that found an older copy than their base version, by whether the book was reloaded',
+                             ('result',))
+
+def mark_changed():
+    """Bump the catalog-wide change counter that /catalog ETags are built from"""
+    state = db.session.get(CatalogState, 1)
+    state.changes += 1
+    state.updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+
+def is_newer(version, current):
+    """Events from before versioning carry no version and are always applied"""
+    return version is None or current is None or version > current
+
+class EventGap(Exception):
+    """A delta cannot be applied and the book could not be reloaded from the store.
+
+    Transient: apply_batch() requeues the message, and the delta reloads the
+    book once the store answers again.
+    """
+
+class BatchState:
+    """Books and tombstones touched by one transaction, loaded with a query per chunk of ids.
+
+    Keeps stock churn from costing two SELECTs (and an autoflush) per event.
+    """
+    CHUNK = 500  # stays under SQLite's limit of bound parameters
+
+    def __init__(self):
+        self.books = {}
+        self.tombstones = {}
+        self.changed = False
+
+    def load(self, book_events):
+        ids = sorted({event['id'] for event in book_events} - self.books.keys())
+        for start in range(0, len(ids), self.CHUNK):
+            chunk = ids[start:start + self.CHUNK]
+            self.books.update({book.id: book for book in Book.query.filter(Book.id.in_(chunk))})
+            self.tombstones.update({t.id: t for t in BookTombstone.query.filter(BookTombstone.id.in_(chunk))})
+            for book_id in chunk:
+                self.books.setdefault(book_id, None)
+
+    def book(self, book_id):
+        if book_id not in self.books:
+            self.books[book_id] = db.session.get(Book, book_id)
+            self.tombstones[book_id] = db.session.get(BookTombstone, book_id)
+        return self.books[book_id]
 
-def process_book_event(ch, method, properties, body):
+    def new_book(self, book_id):
+        book = self.books[book_id] = Book(id=book_id)
+        db.session.add(book)
+        return book
+
+    def delete_book(self, book_id):
+        book = self.books.get(book_id)
+        if book is not None:
+            db.session.delete(book)
+            self.books[book_id] = None
+
+    def tombstone(self, book_id, version):
+        tombstone = self.tombstones.get(book_id)
+        if tombstone is None:
+            tombstone = self.tombstones[book_id] = BookTombstone(id=book_id, version=version)
+            db.session.add(tombstone)
+        else:
+            tombstone.version = version
+
+    def commit(self):
+        """Bump the change counter once for everything applied, then commit"""
+        if self.changed:
+            mark_changed()
+        db.session.commit()
+
+def process_book_event(event, state):
+    """Apply one schema 2 book event (see common/events.py) through `state`; the caller commits.
+
+    Events carry the book's version, so redelivered, out-of-order or
+    already-snapshotted events are skipped instead of applied twice. Only
+    the fields in the event are written. A delta whose base version is
+    newer than the local copy (a change was missed) reloads the book.
+    """
+    book_id = event['id']
+    version = event.get('version')
+
+    book = state.book(book_id)
+    tombstone = state.tombstones.get(book_id)
+    if tombstone and not is_newer(version, tombstone.version):
+        return  # the book was deleted after this change
+
+    if event['type'] == 'book_deleted':
+        if book and is_newer(version, book.version):
+            state.delete_book(book_id)
+            state.changed = True
+        if version is not None:
+            state.tombstone(book_id, version)
+        return
+
+    if book is not None and not is_newer(version, book.version):
+        return
+    if not events.is_full(event) and version is not None and (book is None or book.version < version - 1):
+        reload_book(book_id, state, version)
+        return
+    if book is None:
+        book = state.new_book(book_id)
+    for field, value in event['fields'].items():
+        setattr(book, field, value)
+    if version is not None:  # schema 1 events from before versioning keep the local version
+        book.version = version
+    state.changed = True
+
+def reload_book(book_id, state, version):
+    """Replace the local copy with the store's current book, or delete it if the store has none"""
     try:
-        with app.app_context():
-            event = json.loads(body)
-            event_type = event['type']
-            book_data = event['book']
-            
-            if event_type == 'book_created':
-                book = Book(id=book_data['id'],
-                           title=book_data['title'],
-                           author=book_data['author'],
-                           description=book_data.get('description'),
-                           price=book_data['price'],
-                           stock=book_data['stock'])
-                db.session.merge(book)
-            elif event_type == 'book_updated':
-                book = Book.query.get(book_data['id'])
-                if book:
-                    book.title = book_data['title']
-                    book.author = book_data['author']
-                    book.description = book_data.get('description')
-                    book.price = book_data['price']
-                    book.stock = book_data['stock']
-            elif event_type == 'book_deleted':
-                book = Book.query.get(book_data['id'])
-                if book:
-                    db.session.delete(book)
-            
+        response = requests.get(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=(2, 5))
+        if response.status_code not in (200, 404):
+            response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        EVENT_GAPS.inc(result='failed')
+        raise EventGap(f'book {book_id} missed changes before version {version} and could not be reloaded: {e}')
+    EVENT_GAPS.inc(result='reloaded')
+    app.logger.warning(f"Book {book_id} missed changes before version {version}, reloaded from the store")
+    if response.status_code == 404:
+        state.delete_book(book_id)
+        state.tombstone(book_id, version)
+    else:
+        current = response.json()
+        book = state.books.get(book_id) or state.new_book(book_id)
+        for field in events.BOOK_FIELDS:
+            setattr(book, field, current.get(field))
+        book.version = current['version']
+    state.changed = True
+
+def upsert_snapshot_rows(rows):
+    """Insert or refresh snapshot rows, keeping any local row that is already newer"""
+    stmt = sqlite_insert(Book.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Book.id],
+        set_={c: stmt.excluded[c] for c in ('title', 'author', 'description', 'price', 'stock', 'version')},
+        where=stmt.excluded.version > Book.version,
+    )
+    db.session.execute(stmt)
+
+def bootstrap_from_snapshot():
+    """Load the store's /books/export snapshot into catalog.db.
+
+    Must run after the replica queue is bound, so every change made
+    after the snapshot was taken is waiting in the queue; replaying
+    those is safe because process_book_event skips versions it has.
+    """
+    app.logger.info(f"Bootstrapping catalog from {STORE_SERVICE_URL}/books/export")
+    fields = ('id', 'title', 'author', 'description', 'price', 'stock', 'version')
+    seen = set()
+    batch = []
+    completed = False
+    with app.app_context():
+        try:
+            with requests.get(f'{STORE_SERVICE_URL}/books/export', stream=True, timeout=(5, 60)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    row = json.loads(line)
+                    if row.get('end'):
+                        completed = row['count'] == len(seen)
+                        break
+                    seen.add(row['id'])
+                    batch.append({f: row.get(f) for f in fields})
+                    if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                        upsert_snapshot_rows(batch)
+                        db.session.commit()
+                        batch = []
+            if not completed:
+                raise RuntimeError('snapshot stream ended early')
+            if batch:
+                upsert_snapshot_rows(batch)
+            mark_changed()
+            # Rows the store no longer has were deleted while we were not listening
+            stale = [book_id for (book_id,) in db.session.query(Book.id) if book_id not in seen]
+            for i in range(0, len(stale), SNAPSHOT_BATCH_SIZE):
+                Book.query.filter(Book.id.in_(stale[i:i + SNAPSHOT_BATCH_SIZE])).delete(synchronize_session=False)
             db.session.commit()
-            app.logger.info(f"Processed {event_type} event for book {book_data['id']}")
-    except Exception as e:
-        app.logger.error(f"Error processing event: {e}")
-        
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+    app.logger.info(f"Bootstrap done: {len(seen)} books loaded, {len(stale)} stale books removed")
+
+def needs_bootstrap():
+    if CATALOG_BOOTSTRAP == 'always':
+        return True
+    if CATALOG_BOOTSTRAP == 'never':
+        return False
+    with app.app_context():
+        return db.session.query(Book.id).first() is None
+
+class MalformedMessage(Exception):
+    """A message that cannot be decoded or holds an invalid event: retrying it cannot help"""
+
+EVENT_TYPES = ('book_created', 'book_updated', 'book_deleted')
+
+def unpack_events(body, properties):
+    """Schema 2 events carried by one message, in any encoding (see common/events.py).
+
+    Raises MalformedMessage if the body cannot be decoded or an event lacks
+    what process_book_event() needs.
+    """
+    try:
+        message_events = events.unpack(events.decode(body, properties.content_type, properties.content_encoding))
+    except (ValueError, KeyError, TypeError, AttributeError, zlib.error) as e:
+        raise MalformedMessage(f'cannot decode message: {e!r}') from e
+    for event in message_events:
+        version = event.get('version')
+        if (event.get('type') not in EVENT_TYPES or type(event.get('id')) is not int
+                or not isinstance(event.get('fields'), dict) or not set(event['fields']) <= set(events.BOOK_FIELDS)
+                or not (version is None or type(version) is int)):
+            raise MalformedMessage(f'invalid book event: {event!r}')
+    return message_events
+
+def apply_messages(messages, applied):
+    """Apply the events of (properties, body) messages in the current transaction and commit it.
+
+    Each event is remembered in `applied` for record_visible().
+    """
+    unpacked = [(properties, unpack_events(body, properties)) for properties, body in messages]
+    state = BatchState()
+    state.load([event for _, message_events in unpacked for event in message_events])
+    for properties, message_events in unpacked:
+        for event in message_events:
+            started = time.time()
+            with EVENT_SECONDS.time(type=event.get('type')):
+                process_book_event(event, state)
+            applied.append((event, properties, started))
+    state.commit()
+
+def record_visible(applied):
+    """Write-to-visible latency and a consumer span per event, once its commit made it readable.
+
+    Outbox events carry {"trace": {"traceparent", "written_at"}} from the
+    request that wrote them; older messages only have the message
+    timestamp, with a resolution of one second.
+    """
+    visible_at = time.time()
+    for event, properties, started in applied:
+        trace = event.get('trace') or {}
+        written_at = trace.get('written_at') or (properties.timestamp if properties else None)
+        if written_at:
+            REPLICATION_LAG_SECONDS.observe(max(0.0, visible_at - written_at))
+        parent = trace.get('traceparent') or ((properties.headers or {}).get('traceparent') if properties else None)
+        if parent:
+            span = tracing.start_span(f"apply {event.get('type')}", 'consumer', parent, start_time=started,
+                                      attributes={'book.id': event.get('id')})
+            if written_at:
+                span.set_attribute('replication.write_to_visible_ms', round((visible_at - written_at) * 1000, 1))
+            span.end(visible_at)
+
+def apply_batch(channel, batch):
+    """Apply a batch of (delivery_tag, properties, body) in one transaction and ack it.
+
+    If the batch fails as a whole, its messages are retried one transaction
+    each so a single malformed message cannot block the rest: malformed
+    messages are rejected (not requeued) and logged. A message that fails
+    for any other reason is transient (a locked database, a gap the store
+    cannot fill yet): it and the rest of the batch go back to the queue
+    after CONSUMER_RETRY_DELAY, so no event is lost.
+    """
+    started = time.perf_counter()
+    applied = []
+    failed = 0
+    retry = []
+    with app.app_context():
+        try:
+            apply_messages([(properties, body) for _, properties, body in batch], applied)
+            record_visible(applied)
+            channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+        except Exception as e:
+            db.session.rollback()
+            applied = []
+            app.logger.warning(f"Batch of {len(batch)} messages failed ({e}), retrying one by one")
+            for index, (delivery_tag, properties, body) in enumerate(batch):
+                message_applied = []
+                try:
+                    apply_messages([(properties, body)], message_applied)
+                    record_visible(message_applied)
+                    channel.basic_ack(delivery_tag=delivery_tag)
+                    applied.extend(message_applied)
+                except MalformedMessage as e:
+                    db.session.rollback()
+                    failed += 1
+                    app.logger.error(f"Rejecting malformed message: {e}")
+                    channel.basic_reject(delivery_tag=delivery_tag, requeue=False)
+                except Exception as e:
+                    db.session.rollback()
+                    retry = batch[index:]
+                    app.logger.warning(f"Message failed ({e!r}), requeueing it and the {len(retry) - 1} after it "
+                                       f"in {CONSUMER_RETRY_DELAY}s")
+                    break
+        finally:
+            db.session.remove()
+
+    if retry:
+        time.sleep(CONSUMER_RETRY_DELAY)
+        for delivery_tag, _, _ in retry:
+            channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+
+    timestamps = [p.timestamp for _, p, _ in batch if p and p.timestamp]
+    consumer_stats.record_batch(len(applied), failed, min(timestamps) if timestamps else None)
+    BATCH_SECONDS.observe(time.perf_counter() - started)
+    CONSUMER_EVENTS.inc(len(applied), result='applied')
+    if failed:
+        CONSUMER_EVENTS.inc(failed, result='rejected')
+    if retry:
+        CONSUMER_EVENTS.inc(len(retry), result='requeued')
+    app.logger.info(f"Processed batch of {len(batch)} messages, {len(applied)} book events "
+                    f"({failed} messages rejected, {len(retry)} requeued)")
+
 def start_event_consumer():
+    bootstrap_pending = needs_bootstrap()
     while True:
+        connection = None
         try:
             connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
             channel = connection.channel()
@@ -59,23 +459,50 @@ def start_event_consumer():
                                   exchange_type='fanout',
                                   durable=True)
             
-            result = channel.queue_declare(queue='', exclusive=True)
-            queue_name = result.method.queue
+            queue_name = CATALOG_QUEUE
+            channel.queue_declare(queue=queue_name, durable=True,
+                                  arguments={'x-expires': CATALOG_QUEUE_EXPIRES})
             
             channel.queue_bind(exchange='book_events',
                              queue=queue_name)
-            
-            channel.basic_consume(queue=queue_name,
-                                on_message_callback=process_book_event,
-                                auto_ack=True)
+            channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+
+            if bootstrap_pending:
+                # Events keep piling up in the queue while the snapshot loads
+                bootstrap_from_snapshot()
+                bootstrap_pending = False
             
             app.logger.info("Started consuming book events")
-            channel.start_consuming()
+            batch = []
+            batch_started = None
+            depth_sampled = 0
+            for method, properties, body in channel.consume(queue=queue_name,
+                                                            inactivity_timeout=CONSUMER_BATCH_WINDOW):
+                now = time.monotonic()
+                if method is not None:
+                    if not batch:
+                        batch_started = now
+                    batch.append((method.delivery_tag, properties, body))
+                if batch and (len(batch) >= CONSUMER_BATCH_SIZE or now - batch_started >= CONSUMER_BATCH_WINDOW):
+                    apply_batch(channel, batch)
+                    batch = []
+                if now - depth_sampled >= QUEUE_DEPTH_INTERVAL:
+                    depth = channel.queue_declare(queue=queue_name, passive=True).method.message_count
+                    consumer_stats.record_queue_depth(depth)
+                    QUEUE_DEPTH.set(depth)
+                    depth_sampled = now
         except pika.exceptions.AMQPConnectionError:
+            # Unacked messages of the unfinished batch are redelivered by the broker
             app.logger.error("Lost connection to RabbitMQ, reconnecting...")
             time.sleep(5)
         except Exception as e:
             app.logger.error(f"Unexpected error in consumer: {e}")
+            # Closing the connection hands unacked messages back to the broker
+            try:
+                if connection is not None:
+                    connection.close()
+            except Exception:
+                pass
             time.sleep(5)
 
 class Book(db.Model):
@@ -86,27 +513,294 @@ class Book(db.Model):
     description = db.Column(db.Text, nullable=True)
     price = db.Column(db.Float)
     stock = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Indexes backing the keyset pagination of /catalog: one per sort key
+    # (always with id as tie-breaker) plus author-prefixed variants for the
+    # author filter.
+    __table_args__ = (
+        db.Index('ix_book_title_id', 'title', 'id'),
+        db.Index('ix_book_price_id', 'price', 'id'),
+        db.Index('ix_book_author_id', 'author', 'id'),
+        db.Index('ix_book_author_title_id', 'author', 'title', 'id'),
+        db.Index('ix_book_author_price_id', 'author', 'price', 'id'),
+    )
 
     def to_dict(self):
-        return {"id": self.id, "title": self.title, "author": self.author, "description": self.description, "price": self.price, "stock": self.stock}
+        return {"id": self.id, "title": self.title, "author": self.author, "description": self.description, "price": self.price, "stock": self.stock, "version": self.version}
+
+class CatalogState(db.Model):
+    """Single row counting applied changes; its value versions every catalog response"""
+    __tablename__ = 'catalog_state'
+    id = db.Column(db.Integer, primary_key=True)
+    changes = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+def catalog_validators(representation='json'):
+    """ETag and Last-Modified of the catalog. The ETag names the representation
+    too: a JSON page and the NDJSON stream of the same URL are different bodies."""
+    state = db.session.get(CatalogState, 1)
+    return f'catalog-{state.changes}-{representation}', state.updated_at
+
+class BookTombstone(db.Model):
+    """Version at which a book was deleted, so late events cannot resurrect it"""
+    __tablename__ = 'book_tombstone'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
 
 @app.route('/')
 def index():
     return jsonify({"service": "catalog", "status": "ok"})
 
+# Pagination settings for /catalog
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+SORT_COLUMNS = {
+    'id': Book.id,
+    'title': Book.title,
+    'price': Book.price,
+}
+
+def encode_cursor(sort, book):
+    """Opaque cursor pointing right after `book` for the given sort key"""
+    payload = {'s': sort, 'k': getattr(book, sort), 'id': book.id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor, sort):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if payload['s'] != sort:
+            raise ValueError('cursor was issued for a different sort')
+        return payload['k'], int(payload['id'])
+    except (ValueError, KeyError, TypeError) as e:
+        abort(400, f'invalid cursor: {e}')
+
+def keyset_segments(query, column, descending, after=None, nullable=True):
+    """Ordered queries that list, one after the other, the books after `after` in (column, id) order.
+
+    `after` is the (key, id) of a cursor. SQLite sorts NULL keys before any
+    value, so they come first ascending and last descending. A row-value
+    comparison is never true for NULL, so that block gets its own query (by
+    id, on the same index) instead of an OR that would stop the index from
+    seeking to the cursor. nullable=False skips that query when a filter
+    already rules NULL keys out.
+    """
+    def ordered(q, *columns):
+        return q.order_by(*[c.desc() if descending else c.asc() for c in columns])
+
+    nulls = ordered(query.filter(column.is_(None)), Book.id)
+    values = ordered(query.filter(column.isnot(None)), column, Book.id)
+    if after is None:
+        segments = [values, nulls] if descending else [nulls, values]
+        return segments if nullable else [values]
+    key, last_id = after
+    if key is None:
+        nulls = nulls.filter(Book.id < last_id if descending else Book.id > last_id)
+        return [nulls] if descending else [nulls, values]
+    if descending:
+        values = ordered(query.filter(tuple_(column, Book.id) < tuple_(key, last_id)), column, Book.id)
+        return [values, nulls] if nullable else [values]
+    return [ordered(query.filter(tuple_(column, Book.id) > tuple_(key, last_id)), column, Book.id)]
+
+@app.route('/consumer/stats')
+def consumer_stats_view():
+    return jsonify(consumer_stats.snapshot())
+
 @app.route('/catalog')
 def catalog():
-    # For early victory this service reads directly from store DB
-    books = Book.query.all()
-    return jsonify([b.to_dict() for b in books])
+    """Keyset-paginated catalog.
+
+    Query params: limit, cursor, sort (id|title|price), order (asc|desc),
+    author, min_price, max_price, in_stock. With ?format=ndjson every
+    matching book after the cursor is streamed instead of one page.
+    """
+    # The body depends on Accept (JSON page or NDJSON stream): caches must key on it
+    ndjson = streaming.wants_ndjson()
+    etag, last_modified = catalog_validators('ndjson' if ndjson else 'json')
+    cached = conditional.not_modified(etag, last_modified, vary='Accept')
+    if cached:
+        return cached
+
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    sort = request.args.get('sort', 'id')
+    if sort not in SORT_COLUMNS:
+        abort(400, f'sort must be one of {", ".join(SORT_COLUMNS)}')
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        abort(400, 'order must be asc or desc')
+
+    query = Book.query
+    author = request.args.get('author')
+    if author:
+        query = query.filter(Book.author == author)
+    min_price = request.args.get('min_price', type=float)
+    if min_price is not None:
+        query = query.filter(Book.price >= min_price)
+    max_price = request.args.get('max_price', type=float)
+    if max_price is not None:
+        query = query.filter(Book.price <= max_price)
+    if request.args.get('in_stock') in ('1', 'true', 'yes'):
+        query = query.filter(Book.stock > 0)
+
+    descending = order == 'desc'
+    cursor = request.args.get('cursor')
+    if sort == 'id':
+        if cursor:
+            _, last_id = decode_cursor(cursor, sort)
+            query = query.filter(Book.id < last_id if descending else Book.id > last_id)
+        segments = [query.order_by(Book.id.desc() if descending else Book.id.asc())]
+    else:
+        price_range = min_price is not None or max_price is not None
+        segments = keyset_segments(query, SORT_COLUMNS[sort], descending, decode_cursor(cursor, sort) if cursor else None,
+                                   nullable=not (sort == 'price' and price_range))
+
+    # Column-only rows: no ORM objects to build and track per book
+    segments = [segment.with_entities(*Book.__table__.c) for segment in segments]
+    if ndjson:
+        rows = (row for segment in segments for row in streaming.iterate_rows(segment))
+        response = streaming.stream_json(rows, ndjson=True)
+        return conditional.with_validators(response, etag, last_modified, vary='Accept')
+
+    # Fetch one extra row to know whether there is a next page
+    books = []
+    for segment in segments:
+        books += segment.limit(limit + 1 - len(books)).all()
+        if len(books) > limit:
+            break
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor(sort, books[-1])
+    return conditional.with_validators(jsonify({
+        'items': [b._asdict() for b in books],
+        'next_cursor': next_cursor,
+        'limit': limit,
+        'sort': sort,
+        'order': order,
+    }), etag, last_modified, vary='Accept')
+
+# Full-text search. book_fts is an external-content FTS5 index over the book
+# table: the triggers below update it inside the same transaction as every
+# write process_book_event makes, so the index can never drift from the rows.
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        title, author, description,
+        content='book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE OF title, author, description ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+        INSERT INTO book_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END""",
+    # Rank matches in the title above author, and author above description
+    "INSERT INTO book_fts(book_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+]
+MAX_SEARCH_OFFSET = 1000
+SEARCH_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+def build_match_query(q):
+    """Turn free text into an FTS5 query: every word must match, as a prefix.
+
+    User input is never passed through as FTS5 syntax, so quotes, column
+    filters or operators typed in the search box cannot break the query.
+    """
+    tokens = SEARCH_TOKEN.findall(q)
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+@app.route('/catalog/search')
+def search():
+    """Ranked full-text search over title, author and description.
+
+    Query params: q, limit, offset, in_stock.
+    """
+    match = build_match_query(request.args.get('q', ''))
+    if not match:
+        abort(400, 'q is required')
+    etag, last_modified = catalog_validators()
+    cached = conditional.not_modified(etag, last_modified)
+    if cached:
+        return cached
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0 or offset > MAX_SEARCH_OFFSET:
+        abort(400, f'offset must be between 0 and {MAX_SEARCH_OFFSET}')
+    stock_filter = 'AND b.stock > 0' if request.args.get('in_stock') in ('1', 'true', 'yes') else ''
+
+    rows = db.session.execute(text(f"""
+        SELECT b.id, b.title, b.author, b.description, b.price, b.stock, b.version
+        FROM book_fts JOIN book b ON b.id = book_fts.rowid
+        WHERE book_fts MATCH :match {stock_filter}
+        ORDER BY book_fts.rank
+        LIMIT :limit OFFSET :offset
+    """), {'match': match, 'limit': limit + 1, 'offset': offset}).mappings().all()
+
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if offset + limit <= MAX_SEARCH_OFFSET:
+            next_offset = offset + limit
+    return conditional.with_validators(jsonify({
+        'items': [dict(r) for r in rows],
+        'next_offset': next_offset,
+        'limit': limit,
+        'offset': offset,
+    }), etag, last_modified)
+
+def create_keyset_indexes(conn):
+    for name in ('ix_book_title_id', 'ix_book_price_id', 'ix_book_author_title_id', 'ix_book_author_price_id'):
+        migrations.create_index(conn, Book.__table__, name)
+
+# Schema changes made after the first deploy, applied in order by
+# create_schema() (see common/migrations.py). Append, never edit or reorder.
+MIGRATIONS = [
+    (1, 'book.version for ordering events',
+     lambda conn: migrations.add_column(conn, 'book', 'version', 'INTEGER NOT NULL DEFAULT 1')),
+    (2, 'keyset pagination indexes', create_keyset_indexes),
+    (3, 'index on book.author, id for the author filter sorted by id',
+     lambda conn: migrations.create_index(conn, Book.__table__, 'ix_book_author_id')),
+]
+
+def create_schema():
+    """Create missing tables, apply pending migrations and set up search"""
+    db.create_all()
+    migrations.migrate(db.engine, MIGRATIONS, app.logger)
+    with db.engine.begin() as conn:
+        fts_exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_fts'")).first()
+        for statement in FTS_SCHEMA:
+            conn.execute(text(statement))
+        if not fts_exists:
+            # Index the rows that were replicated before search existed
+            conn.execute(text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+    if db.session.get(CatalogState, 1) is None:
+        db.session.add(CatalogState(id=1, changes=0))
+        db.session.commit()
+
+serving.add_health_routes(app, {'database': lambda: db.session.execute(text('SELECT 1'))})
+
+def start_background_tasks():
+    """Start the event consumer; with several server workers only one runs it"""
+    serving.run_exclusively('catalog-consumer', start_event_consumer)
 
 if __name__ == '__main__':
-    # Create tables and start consumer in background thread
+    # Development server; production runs gunicorn with gunicorn.conf.py
     with app.app_context():
-        db.create_all()
+        create_schema()
     
     # Start event consumer in background thread
-    consumer_thread = threading.Thread(target=start_event_consumer, daemon=True)
-    consumer_thread.start()
+    start_background_tasks()
     
     app.run(host='0.0.0.0', port=5002, debug=True)
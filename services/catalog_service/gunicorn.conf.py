@@ -0,0 +1,53 @@
+"""Production server: gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be tuned through the environment of the container.
+"""
+import os
+import tempfile
+
+# Workers share their metrics through files so /metrics covers the whole container
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'catalog-metrics'))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5002')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# Import the app once in the master and fork the workers from it
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+# On SIGTERM workers stop accepting and get this long to finish in-flight requests
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+
+
+def on_starting(server):
+    # Once, in the master, before any worker exists
+    from app import app, create_schema, db
+    with app.app_context():
+        create_schema()
+        # Connections opened here must not be shared with the forked workers
+        for engine in db.engines.values():
+            engine.dispose()
+    # Start from empty counters, without the files of a previous run
+    from common import metrics
+    metrics.REGISTRY.reset()
+
+
+def post_worker_init(worker):
+    from app import start_background_tasks
+    start_background_tasks()
+
+
+def worker_exit(server, worker):
+    # In the exiting worker: write the samples of its last seconds
+    from common import metrics
+    metrics.REGISTRY.flush()
+
+
+def child_exit(server, worker):
+    # In the master: fold the exited worker's counters into the archive and drop its file
+    from common import metrics
+    metrics.REGISTRY.retire(worker.pid)
@@ -0,0 +1 @@
+"""Code shared by the bookstore services (copied into every image next to app.py)"""
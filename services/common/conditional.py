@@ -0,0 +1,46 @@
+"""Conditional GETs: ETag and Last-Modified validators on read endpoints.
+
+A view computes its validators cheaply (a version, a change counter) and
+calls not_modified() before building the body; if the client's copy is
+still current it answers the 304 that helper returns. Otherwise it wraps
+the full response in with_validators(). ETags are weak: the same data may
+be serialized differently. An endpoint that answers one URL with several
+representations (JSON and NDJSON) names the representation in its ETag and
+passes vary='Accept', so a cache never revalidates one with the other.
+"""
+from datetime import timezone
+
+from flask import Response, request
+
+
+def http_date(value):
+    """A naive UTC datetime, as stored in the database, at HTTP-date precision"""
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def not_modified(etag, last_modified=None, vary=None):
+    """Return a 304 response if the request's validators still match, else None.
+
+    If-None-Match takes precedence over If-Modified-Since (RFC 9110).
+    """
+    if last_modified is not None:
+        last_modified = http_date(last_modified)
+    if request.if_none_match:
+        matches = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        matches = last_modified <= request.if_modified_since
+    else:
+        matches = False
+    if not matches:
+        return None
+    return with_validators(Response(status=304), etag, last_modified, vary)
+
+
+def with_validators(response, etag, last_modified=None, vary=None):
+    """Set the ETag, Last-Modified and Vary headers of a response"""
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = http_date(last_modified)
+    if vary:
+        response.vary.add(vary)
+    return response
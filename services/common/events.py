@@ -0,0 +1,105 @@
+"""Schema and wire format of the book_events exchange.
+
+Schema 2 events are per-book field deltas:
+
+    {"v": 2, "type": "book_updated", "id": 7, "version": 12, "fields": {"stock": 3}}
+
+- type is book_created, book_updated or book_deleted;
+- version is the book's version after the change. The store bumps it by
+  exactly one per change, so a replica holding version - 1 can apply
+  `fields` as they are;
+- fields holds only the columns that changed: all of BOOK_FIELDS for
+  book_created, none for book_deleted.
+
+Consumers drop events that are not newer than their copy of the book. A
+delta that finds an older copy than version - 1 means a change was missed,
+and the replica must reload the whole book instead of applying it.
+Schema 1 events ({"type": ..., "book": {...}}, the full book, or only
+id/stock/version for book_stock_changed) are still accepted: unpack()
+turns every event into schema 2.
+
+A message is one event or {"type": "batch", "events": [...]}. It is
+compact JSON by default, or msgpack with BOOK_EVENTS_ENCODING=msgpack
+(every consumer then needs the msgpack package). Bodies of at least
+BOOK_EVENTS_COMPRESS_MIN_BYTES are zlib-compressed. The content_type and
+content_encoding properties of each message tell consumers how to decode
+it, so they read any mix of encodings.
+"""
+import json
+import os
+import zlib
+
+SCHEMA_VERSION = 2
+BOOK_FIELDS = ('title', 'author', 'description', 'price', 'stock')
+
+BOOK_EVENTS_ENCODING = os.getenv('BOOK_EVENTS_ENCODING', 'json')
+BOOK_EVENTS_COMPRESS_MIN_BYTES = int(os.getenv('BOOK_EVENTS_COMPRESS_MIN_BYTES', '4096'))
+BOOK_EVENTS_COMPRESS_LEVEL = int(os.getenv('BOOK_EVENTS_COMPRESS_LEVEL', '6'))
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+DEFLATE = 'deflate'
+
+
+def book_event(event_type, book_id, version, fields=None):
+    """Schema 2 event for one change of a book"""
+    return {'v': SCHEMA_VERSION, 'type': event_type, 'id': book_id, 'version': version, 'fields': fields or {}}
+
+
+def created(book):
+    """book_created event from a full book dict"""
+    return book_event('book_created', book['id'], book.get('version'), {f: book.get(f) for f in BOOK_FIELDS})
+
+
+def changed_fields(before, after):
+    """Fields of BOOK_FIELDS whose value differs between two book dicts"""
+    return {f: after[f] for f in BOOK_FIELDS if f in after and before.get(f) != after[f]}
+
+
+def is_full(event):
+    """True when the event carries the whole book, not just a delta"""
+    return all(f in event['fields'] for f in BOOK_FIELDS)
+
+
+def normalize(event):
+    """Schema 2 form of an event of any schema (extra keys such as 'trace' are kept)"""
+    if event.get('v') == SCHEMA_VERSION:
+        return event
+    book = event['book']
+    event_type = 'book_updated' if event['type'] == 'book_stock_changed' else event['type']
+    normalized = book_event(event_type, book['id'], book.get('version'),
+                            {f: book[f] for f in BOOK_FIELDS if f in book} if event_type != 'book_deleted' else None)
+    for key, value in event.items():
+        if key not in ('type', 'book'):
+            normalized.setdefault(key, value)
+    return normalized
+
+
+def unpack(message):
+    """Schema 2 events of one decoded message"""
+    events = message['events'] if message.get('type') == 'batch' else [message]
+    return [normalize(event) for event in events]
+
+
+def encode(message, encoding=None, compress_min_bytes=None):
+    """Body, content_type and content_encoding (None when not compressed) of a message"""
+    encoding = encoding or BOOK_EVENTS_ENCODING
+    compress_min_bytes = BOOK_EVENTS_COMPRESS_MIN_BYTES if compress_min_bytes is None else compress_min_bytes
+    if encoding == 'msgpack':
+        import msgpack  # optional dependency, only with BOOK_EVENTS_ENCODING=msgpack
+        body, content_type = msgpack.packb(message, use_bin_type=True), MSGPACK
+    else:
+        body, content_type = json.dumps(message, separators=(',', ':')).encode(), JSON
+    if compress_min_bytes and len(body) >= compress_min_bytes:
+        return zlib.compress(body, BOOK_EVENTS_COMPRESS_LEVEL), content_type, DEFLATE
+    return body, content_type, None
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """Message from a body written by encode() (or plain JSON from older producers)"""
+    if content_encoding == DEFLATE:
+        body = zlib.decompress(body)
+    if content_type == MSGPACK:
+        import msgpack
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
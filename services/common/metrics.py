@@ -0,0 +1,349 @@
+"""Prometheus metrics for the services, exposed by GET /metrics.
+
+init_app() times every request per route and instrument_sqlalchemy()
+times every database query; services define their own metrics for their
+hot paths (upstream calls, publishing, event processing) with Counter,
+Gauge and Histogram. Latencies are histograms, so Prometheus can compute
+p50/p99 per route or per hop with histogram_quantile().
+
+Under gunicorn each worker process has its own counters. When METRICS_DIR
+is set (gunicorn.conf.py sets it) every process writes its samples to a
+file there every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the
+files of all workers, so a scrape reports the whole container whichever
+worker answers it. Gauges report the most recently written value. When a
+worker exits, the gunicorn master folds its counters and histograms into
+one archive file and removes its file (retire()), so counters never go
+backwards and the directory does not grow with every restarted worker; the
+gauges of an exited worker are dropped.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+        # Forked workers start from zero instead of repeating the parent's samples
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.flusher = None
+        for metric in self.metrics.values():
+            metric.samples = {}
+
+    def reset(self):
+        """Drop every sample and every worker file (the gunicorn master calls it before forking)"""
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.samples = {}
+        for path in self.worker_files():
+            os.remove(path)
+
+    def updated(self):
+        """Called after every change: start the flusher of this process the first time"""
+        if self.flusher is None and self.directory:
+            with self.lock:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.flush_forever, name='metrics-flush', daemon=True)
+                    self.flusher.start()
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(key), value] for key, value in metric.copy_samples().items()]
+                    for name, metric in self.metrics.items() if metric.samples}
+
+    def path(self, pid=None):
+        return os.path.join(self.directory, f'{pid or os.getpid()}.json')
+
+    def archive_path(self):
+        return os.path.join(self.directory, 'archive.json')
+
+    def worker_files(self):
+        return glob.glob(os.path.join(self.directory, '*.json')) if self.directory else []
+
+    def write(self, path, snapshot):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def flush(self):
+        snapshot = self.snapshot()
+        if snapshot and self.directory:
+            self.write(self.path(), snapshot)
+
+    def retire(self, pid):
+        """Fold the file of an exited worker into the archive and remove it.
+
+        The gunicorn master calls it for each worker that exits; only the
+        master writes the archive. Metrics this process does not know are
+        left in the worker's file, since they cannot be merged by kind.
+        """
+        path = self.path(pid)
+        try:
+            with open(path) as f:
+                retired = json.load(f)
+        except (OSError, ValueError):
+            return
+        try:
+            with open(self.archive_path()) as f:
+                archive = json.load(f)
+        except (OSError, ValueError):
+            archive = {}
+        unknown = {}
+        for name, samples in retired.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                unknown[name] = samples
+                continue
+            if metric.kind == 'gauge':
+                continue
+            merged = {tuple(key): value for key, value in archive.get(name, [])}
+            for key, value in samples:
+                merged[tuple(key)] = metric.merge(merged.get(tuple(key)), value)
+            archive[name] = [[list(key), value] for key, value in merged.items()]
+        self.write(self.archive_path(), archive)
+        if unknown:
+            self.write(path, unknown)
+        else:
+            os.remove(path)
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass  # a full or missing disk must not stop the worker
+
+    def collect(self):
+        """{name: {label values: value}} of this process plus the files of the other workers"""
+        snapshots = []
+        own = self.path() if self.directory else None
+        for path in sorted(self.worker_files(), key=os.path.getmtime):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # being replaced or removed right now
+        snapshots.append(self.snapshot())
+        merged = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in samples:
+                    key = tuple(key)
+                    merged[name][key] = metric.merge(merged[name].get(key), value)
+        return merged
+
+    def render(self):
+        lines = []
+        for name, samples in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(samples.items()):
+                lines.extend(metric.render(key, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{n}="{escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        self.samples = {}
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def copy_samples(self):
+        return dict(self.samples)
+
+    def render(self, key, value):
+        return [f'{self.name}{format_labels(self.labelnames, key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+        self.registry.updated()
+
+    def merge(self, current, value):
+        return value if current is None else current + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.samples[key] = value
+        self.registry.updated()
+
+    def merge(self, current, value):
+        return value  # snapshots are merged oldest first
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.registry.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # per-bucket counts (last one is +Inf), sum, count
+                sample = self.samples[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+        self.registry.updated()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def copy_samples(self):
+        return {key: [list(counts), total, count] for key, (counts, total, count) in self.samples.items()}
+
+    def merge(self, current, value):
+        if current is None:
+            return [list(value[0]), value[1], value[2]]
+        return [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+
+    def render(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += n
+            labels = format_labels(self.labelnames, key, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time to build the response of a request',
+                            ('method', 'route', 'status'))
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'Database queries run by one request',
+                            ('method', 'route'), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_QUERY_SECONDS = Histogram('db_query_duration_seconds', 'Time spent executing a database query',
+                             ('operation',))
+
+QUERY_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'}
+
+
+def init_app(app, registry=REGISTRY):
+    """Time every request per route (register it before other before_request hooks) and add GET /metrics.
+
+    For streamed responses the time covers building the response, not
+    sending the body.
+    """
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                                    route=route, status=response.status_code)
+            REQUEST_QUERIES.observe(g.pop('db_queries', 0), method=request.method, route=route)
+        return response
+
+    @app.route('/metrics')
+    def metrics_view():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+_sqlalchemy_instrumented = False
+
+
+def instrument_sqlalchemy():
+    """Time every query of every SQLAlchemy engine in this process"""
+    global _sqlalchemy_instrumented
+    if _sqlalchemy_instrumented:
+        return  # the listeners are global: several apps in one process share them
+    _sqlalchemy_instrumented = True
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def observe_query(conn, cursor, statement, parameters, context, executemany):
+        words = statement.split(None, 1)
+        operation = words[0].upper() if words else ''
+        DB_QUERY_SECONDS.observe(time.perf_counter() - context.metrics_started,
+                                 operation=operation if operation in QUERY_OPERATIONS else 'OTHER')
+        if has_request_context() and 'db_queries' in g:
+            g.db_queries += 1
@@ -0,0 +1,62 @@
+"""Versioned schema migrations for the services.
+
+db.create_all() only creates missing tables: it never adds a column or an
+index to a table that already exists. Every service therefore lists the
+schema changes made after its first deploy as MIGRATIONS, an ordered list
+of (version, description, upgrade) where upgrade(connection) makes the
+change, and its create_schema() calls migrate() after create_all().
+
+migrate() records applied versions in the schema_migrations table and
+runs the missing ones in order, each in its own transaction. MySQL
+commits DDL statements implicitly, so a migration that fails halfway is
+not rolled back there: upgrades use add_column() and create_index(),
+which skip what already exists, and are safe to run again. A fresh
+database gets its tables, with every column and index of the models,
+from create_all(), and the migrations only record their versions.
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+MIGRATIONS_TABLE = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migrate(engine, migrations, logger=None):
+    """Apply the migrations missing from the database; returns their versions"""
+    versions = [version for version, _, _ in migrations]
+    if versions != sorted(set(versions)):
+        raise ValueError('migration versions must be unique and in ascending order')
+    MIGRATIONS_TABLE.create(bind=engine, checkfirst=True)
+    with engine.connect() as conn:
+        applied = set(conn.execute(select(MIGRATIONS_TABLE.c.version)).scalars())
+
+    done = []
+    for version, description, upgrade in migrations:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            upgrade(conn)
+            conn.execute(MIGRATIONS_TABLE.insert().values(
+                version=version, description=description,
+                applied_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+        if logger:
+            logger.info(f"Applied migration {version}: {description}")
+        done.append(version)
+    return done
+
+
+def add_column(conn, table, name, definition):
+    """ALTER TABLE ... ADD COLUMN, unless the column exists"""
+    if name not in {c['name'] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {definition}'))
+
+
+def create_index(conn, table, name):
+    """Create the index `name` declared on a model's table, unless it exists"""
+    index = next(i for i in table.indexes if i.name == name)
+    index.create(bind=conn, checkfirst=True)
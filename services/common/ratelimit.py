@@ -0,0 +1,312 @@
+"""Rate limiting and admission control for the services.
+
+Two independent protections against bursts, both answering quickly with
+Retry-After instead of letting latency grow without bound:
+
+- RateLimiter: token buckets keyed by client (IP, user, account...). A
+  limit such as '10/minute' refills 10 tokens per minute continuously and
+  holds at most 10, so short bursts pass and sustained excess gets 429.
+  Buckets live in this process (MemoryStore) or, with RATE_LIMIT_URL set to
+  redis://..., in a Redis-compatible server shared by every worker and
+  replica; any server that speaks the Redis protocol and runs Lua scripts
+  can stand in for it locally. If that server fails the limiter lets the
+  request through rather than taking the service down with it.
+- AdmissionControl: at most ADMISSION_MAX_CONCURRENT requests run at once
+  per process; up to ADMISSION_MAX_QUEUE more wait for a slot for at most
+  ADMISSION_QUEUE_TIMEOUT seconds. Anything beyond is shed with 503. The
+  limits are per server worker, so a container admits WEB_CONCURRENCY
+  times as many. Under gunicorn a request waiting for a slot also holds one
+  of the worker's GUNICORN_THREADS threads, so by default three quarters of
+  them run requests and the rest may wait (see admission_defaults()).
+
+init_app() wires admission control into an app and turns RateLimited and
+Overloaded into 429/503 responses; each service applies its own rate
+limits, usually in a before_request hook registered before init_app().
+Behind TRUSTED_PROXY_HOPS proxies, the client address is taken from
+X-Forwarded-For.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from common import metrics
+
+
+def admission_defaults(threads):
+    """(max_concurrent, max_queue) for a worker serving requests on `threads`
+    threads, or the limits of a server without a fixed thread count (0)"""
+    if not threads:
+        return 12, 16
+    concurrent = max(1, threads * 3 // 4)
+    return concurrent, threads - concurrent
+
+
+RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL', '')
+# Worker processes and threads of each, exported by every gunicorn.conf.py
+SERVER_WORKERS = int(os.getenv('WEB_CONCURRENCY', '1'))
+SERVER_THREADS = int(os.getenv('GUNICORN_THREADS', '0'))
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', str(admission_defaults(SERVER_THREADS)[0])))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', str(admission_defaults(SERVER_THREADS)[1])))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '0.5'))
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+# Never limited nor queued: probes and scrapes must answer under overload
+EXEMPT_PATHS = ('/healthz', '/readyz', '/metrics')
+
+PERIODS = {'s': 1, 'second': 1, 'm': 60, 'minute': 60, 'h': 3600, 'hour': 3600}
+
+RATE_LIMITED = metrics.Counter('rate_limited_total', 'Requests rejected with 429 by a rate limit', ('rule',))
+REQUESTS_SHED = metrics.Counter('admission_shed_total', 'Requests shed with 503 by admission control',
+                                ('reason',))
+
+
+class RateLimited(Exception):
+    """The client exhausted a rate limit"""
+
+    def __init__(self, rule, retry_after):
+        super().__init__(f'rate limit {rule} exceeded, retry in {retry_after:.1f}s')
+        self.rule = rule
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """Admission control shed the request"""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(f'overloaded ({reason})')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limit:
+    """Token bucket parameters: `rate` tokens per second, at most `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def __repr__(self):
+        return f'Limit(rate={self.rate}, burst={self.burst})'
+
+
+def parse_limit(spec):
+    """'10/minute' (or 10/m, 5/s, 100/hour) -> Limit; '' or 'off' -> None (no limit)"""
+    spec = (spec or '').strip().lower()
+    if spec in ('', 'off', 'none', '0'):
+        return None
+    count, _, period = spec.partition('/')
+    if period not in PERIODS or int(count) <= 0:
+        raise ValueError(f'invalid rate limit {spec!r}, expected e.g. 10/minute')
+    return Limit(int(count) / PERIODS[period], int(count))
+
+
+class MemoryStore:
+    """Buckets of this process, bounded in number (the least recently used go first)"""
+
+    MAX_KEYS = 100000
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, updated)
+        self.lock = threading.Lock()
+
+    def take(self, key, limit, now, cost=1):
+        """Take `cost` tokens; returns 0 if allowed, else seconds until they are available"""
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + max(0, now - updated) * limit.rate)
+            retry_after = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / limit.rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            # A forgotten bucket is a full one: evicting never blocks anybody
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return retry_after
+
+
+# Same algorithm as MemoryStore, atomic on the server. The result is a
+# string because Redis truncates Lua numbers to integers.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(retry_after)
+"""
+
+
+class RedisStore:
+    """Buckets shared through any Redis-compatible server"""
+
+    def __init__(self, url, prefix='ratelimit:'):
+        import redis  # optional dependency, only when RATE_LIMIT_URL is set
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, limit, now, cost=1):
+        return float(self.script(keys=[self.prefix + key], args=[limit.rate, limit.burst, now, cost]))
+
+
+def make_store(url=RATE_LIMIT_URL):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    return MemoryStore()
+
+
+class RateLimiter:
+    def __init__(self, store=None):
+        self.store = store or make_store()
+        self.lock = threading.Lock()
+        self.rejected = {}
+        self.store_errors = 0
+
+    def hit(self, rule, key, limit, cost=1):
+        """Count a request of `key` against `limit`; raises RateLimited past it.
+
+        `rule` names the limit (e.g. 'ip' or 'login') in metrics and keys;
+        a None limit is disabled.
+        """
+        if limit is None:
+            return
+        try:
+            # Wall clock: buckets in a shared store are compared across hosts
+            retry_after = self.store.take(f'{rule}:{key}', limit, time.time(), cost)
+        except Exception:
+            with self.lock:
+                self.store_errors += 1
+            return  # fail open
+        if retry_after > 0:
+            with self.lock:
+                self.rejected[rule] = self.rejected.get(rule, 0) + 1
+            RATE_LIMITED.inc(rule=rule)
+            raise RateLimited(rule, retry_after)
+
+    def stats(self):
+        with self.lock:
+            return {'store': type(self.store).__name__, 'rejected': dict(self.rejected),
+                    'store_errors': self.store_errors}
+
+
+class AdmissionControl:
+    """Concurrency limit with a bounded, time-limited queue, per process"""
+
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.counters = {'admitted': 0, 'queued': 0, 'shed_queue_full': 0, 'shed_queue_timeout': 0}
+
+    def acquire(self):
+        """Take a slot, waiting up to queue_timeout; raises Overloaded otherwise"""
+        with self.condition:
+            if self.in_flight < self.max_concurrent and not self.waiting:
+                return self.admit()
+            if self.waiting >= self.max_queue:
+                self.shed('queue_full')
+            self.waiting += 1
+            self.counters['queued'] += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.in_flight < self.max_concurrent,
+                                                   timeout=self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.shed('queue_timeout')
+            self.admit()
+
+    def admit(self):
+        self.in_flight += 1
+        self.counters['admitted'] += 1
+
+    def shed(self, reason):
+        self.counters[f'shed_{reason}'] += 1
+        REQUESTS_SHED.inc(reason=reason)
+        raise Overloaded(reason)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counters, in_flight=self.in_flight, waiting=self.waiting,
+                        max_concurrent=self.max_concurrent, max_queue=self.max_queue,
+                        queue_timeout=self.queue_timeout, scope='process', server_workers=SERVER_WORKERS)
+
+
+def client_ip():
+    """Address of the client (X-Forwarded-For is honoured behind TRUSTED_PROXY_HOPS)"""
+    return request.remote_addr or 'unknown'
+
+
+def is_exempt():
+    return request.path in EXEMPT_PATHS
+
+
+def json_error(error, status):
+    if isinstance(error, RateLimited):
+        return jsonify({'error': 'rate_limited', 'description': 'too many requests, retry later'})
+    return jsonify({'error': 'overloaded', 'description': 'the service is overloaded, retry shortly'})
+
+
+def init_app(app, admission=None, render=json_error):
+    """Run every request through `admission` and answer RateLimited/Overloaded.
+
+    render(error, status) builds the body of those responses (JSON by
+    default); the status and Retry-After are set here.
+    """
+    if TRUSTED_PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+    if admission is not None:
+        @app.before_request
+        def admit_request():
+            if not is_exempt():
+                admission.acquire()
+                g.admitted = True
+
+        @app.teardown_request
+        def release_request(exc=None):
+            if g.pop('admitted', False):
+                admission.release()
+
+    def respond(error, status):
+        response = app.make_response((render(error, status), status))
+        response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+        return response
+
+    @app.errorhandler(RateLimited)
+    def rate_limited(e):
+        app.logger.info(f"Rate limited {client_ip()}: {e}")
+        return respond(e, 429)
+
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        app.logger.warning(f"Shedding request: {e}")
+        return respond(e, 503)
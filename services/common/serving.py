@@ -0,0 +1,54 @@
+"""Helpers for running a service with several server workers.
+
+In production every service runs under gunicorn (see its gunicorn.conf.py)
+with WEB_CONCURRENCY worker processes. Background loops such as the
+catalog's event consumer or the store's outbox relay must still run once
+per container, not once per worker: run_exclusively() makes every worker
+wait on the same file lock and only the holder runs the loop. The OS
+releases the lock when that process exits, so another worker takes over.
+"""
+import fcntl
+import os
+import tempfile
+import threading
+
+from flask import jsonify
+
+SERVICE_LOCK_DIR = os.getenv('SERVICE_LOCK_DIR', tempfile.gettempdir())
+
+
+def run_exclusively(name, target):
+    """Run target() in a daemon thread of exactly one process at a time"""
+    def wait_for_lock():
+        lock_file = open(os.path.join(SERVICE_LOCK_DIR, f'{name}.lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)  # blocks while another process holds it
+        target()
+
+    thread = threading.Thread(target=wait_for_lock, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def add_health_routes(app, checks=None):
+    """GET /healthz: the process answers. GET /readyz: every check passes, else 503.
+
+    `checks` maps a name to a function that raises when the dependency
+    is not usable (e.g. the database does not answer).
+    """
+    checks = checks or {}
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        results = {}
+        for name, check in checks.items():
+            try:
+                check()
+                results[name] = 'ok'
+            except Exception as e:
+                results[name] = f'error: {e}'
+        ready = all(result == 'ok' for result in results.values())
+        return jsonify({'status': 'ready' if ready else 'unavailable', 'checks': results}), 200 if ready else 503
@@ -0,0 +1,132 @@
+"""SQLite engines for the services that keep their data in a local file.
+
+catalog_service and auth_service read far more than they write, and the
+catalog's event consumer writes while HTTP threads read. configure() sets
+an app up with two engines on the same file:
+
+- the default engine is the writer: one pooled connection per process, so
+  the threads of a worker queue for it in the pool instead of failing on
+  SQLite's lock, and other processes are waited for up to
+  SQLITE_BUSY_TIMEOUT_MS;
+- the READ_BIND engine is a pool of SQLITE_READ_POOL_SIZE connections with
+  PRAGMA query_only, which never wait on the writer.
+
+The database runs in WAL mode, where readers see the last commit and a
+commit does not block them. With the session class of session_options(),
+db.session sends queries to the read pool and switches to the writer for a
+flush or an INSERT/UPDATE/DELETE, and for everything after it until the
+transaction ends, so a transaction reads its own writes. db.engine is
+still the writer, for the schema and other direct writes.
+
+A write that still finds the database locked after the busy timeout
+answers 503 with Retry-After instead of a 500.
+"""
+import os
+
+from flask import jsonify
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from flask_sqlalchemy.session import Session
+
+from common import metrics
+
+READ_BIND = 'read'
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')) / 1000.0
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '8'))
+# NORMAL only fsyncs at checkpoints in WAL mode: a power loss can drop the
+# last commits but never corrupts the file. FULL fsyncs every commit.
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', '16'))  # page cache of each connection
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', '256'))  # shared by every connection through the OS
+READ_STATEMENTS = ('SELECT', 'WITH', 'PRAGMA', 'EXPLAIN')
+
+DATABASE_BUSY = metrics.Counter('sqlite_busy_total',
+                                'Requests answered 503 because the database stayed locked past the busy timeout')
+
+
+def configure(app, path):
+    """Use the SQLite file at `path` as the app's database, with a writer and a read pool"""
+    url = 'sqlite:///' + path
+    common = {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT, 'check_same_thread': False},
+              'pool_timeout': SQLITE_BUSY_TIMEOUT}
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(common, pool_size=1, max_overflow=0)
+    app.config['SQLALCHEMY_BINDS'] = {
+        READ_BIND: dict(common, url=url, pool_size=SQLITE_READ_POOL_SIZE, max_overflow=SQLITE_READ_POOL_SIZE),
+    }
+
+
+def session_options():
+    """session_options for SQLAlchemy(app, ...) that route reads to the read pool"""
+    return {'class_': RoutingSession}
+
+
+def init_app(app, db):
+    """Set the pragmas of every new connection and turn lock timeouts into 503"""
+    with app.app_context():
+        engines = dict(db.engines)
+    for key, engine in engines.items():
+        event.listen(engine, 'connect', pragmas(read_only=key == READ_BIND))
+
+    @app.errorhandler(OperationalError)
+    def database_busy(e):
+        if not is_busy(e):
+            raise e
+        DATABASE_BUSY.inc()
+        app.logger.warning(f"Database busy: {e.orig}")
+        response = jsonify({'error': 'busy', 'description': 'the database is busy, retry shortly'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+
+def pragmas(read_only):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            # Persistent in the file; only a writer may change it
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}')
+        cursor.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+    return on_connect
+
+
+def is_busy(error):
+    message = str(getattr(error, 'orig', error))
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def is_read(clause):
+    if clause is None or getattr(clause, 'is_dml', False):
+        return False
+    if getattr(clause, 'is_select', False):
+        return True
+    statement = getattr(clause, 'text', None)  # text() statements
+    return statement is not None and statement.lstrip().upper().startswith(READ_STATEMENTS)
+
+
+class RoutingSession(Session):
+    """db.session that reads from READ_BIND until its transaction writes"""
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.writing = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self.writing and not self._flushing and is_read(clause):
+            engines = self._db.engines
+            if READ_BIND in engines:
+                return engines[READ_BIND]
+        if bind is None:
+            self.writing = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def end_writing(session, transaction):
+    if transaction.parent is None:
+        session.writing = False
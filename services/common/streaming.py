@@ -0,0 +1,73 @@
+"""Streamed JSON and NDJSON responses for large listings.
+
+A listing endpoint runs a column-only query, turns its rows into dicts with
+iterate_rows() and hands them to stream_json(), which serializes them while
+the client reads. Neither the rows nor the body are ever held in memory at
+once, and chunked() keeps the server from writing one row per syscall.
+Clients ask for NDJSON with `Accept: application/x-ndjson` or
+`?format=ndjson` (see wants_ndjson()).
+"""
+import json
+
+from flask import Response, request, stream_with_context
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BATCH_SIZE = 1000
+
+
+def chunked(pieces):
+    """Join small strings into ~64 KB chunks so the server does not write row by row"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def wants_ndjson():
+    """True if the current request asked for NDJSON rather than a JSON array"""
+    return (request.args.get('format') == 'ndjson' or
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+
+
+def iterate_rows(query):
+    """Yield the rows of a column-only query as dicts, then close its session.
+
+    Flask tears the app context down (removing db.session) when the view
+    returns, before a streamed body is read; the query keeps its own
+    session, which would otherwise hold a pooled connection until it is
+    garbage collected.
+    """
+    try:
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            yield row._asdict()
+    finally:
+        query.session.close()
+
+
+def stream_json(items, ndjson=False):
+    """Response that serializes an iterable of dicts while it is consumed.
+
+    Either one JSON array, written element by element, or NDJSON (one
+    object per line). Memory stays flat however many items there are.
+    """
+    if ndjson:
+        pieces = (json.dumps(item) + '\n' for item in items)
+        mimetype = 'application/x-ndjson'
+    else:
+        def array():
+            yield '['
+            separator = ''
+            for item in items:
+                yield separator + json.dumps(item)
+                separator = ','
+            yield ']'
+        pieces = array()
+        mimetype = 'application/json'
+    return Response(stream_with_context(chunked(pieces)), mimetype=mimetype)
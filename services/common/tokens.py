@@ -0,0 +1,191 @@
+"""Signed access tokens, verified locally by every service.
+
+auth_service issues short-lived access tokens in JWT format (HS256): the
+header names the key that signed it (kid), the payload carries the user
+(sub, name, email), an id (jti) and the expiry (exp). Any service holding
+the same keys verifies a token with one HMAC and a dict lookup, with no
+call to auth.
+
+Keys come from AUTH_TOKEN_KEYS as "kid:secret,kid:secret"; the first one
+signs, all of them verify, so keys can be rotated by adding the new key
+first and dropping the old one once its tokens have expired. A service
+without AUTH_TOKEN_KEYS fails to start, unless AUTH_TOKEN_DEV_KEYS=1 lets
+it use DEV_KEYS, whose secret is public: anyone can mint tokens with it.
+
+Logged-out tokens are listed by auth in GET /token/revocations until they
+expire. RevocationList keeps that list in memory and refreshes it at most
+every TOKEN_REVOCATION_REFRESH seconds, so a revoked token stops working
+everywhere within that interval.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+import uuid
+from functools import wraps
+
+from flask import abort, g, request
+
+DEV_KEYS = 'dev:dev-token-secret-change-me'
+ACCESS_TOKEN_TTL = int(os.getenv('ACCESS_TOKEN_TTL', '900'))
+TOKEN_REVOCATION_REFRESH = float(os.getenv('TOKEN_REVOCATION_REFRESH', '30'))
+# Tolerated clock difference between services when checking exp
+CLOCK_LEEWAY = 30
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_keys(spec=None):
+    """Parse AUTH_TOKEN_KEYS into an ordered {kid: secret bytes}"""
+    spec = spec or os.getenv('AUTH_TOKEN_KEYS')
+    if not spec:
+        if os.getenv('AUTH_TOKEN_DEV_KEYS') != '1':
+            raise RuntimeError('AUTH_TOKEN_KEYS is not set; set AUTH_TOKEN_DEV_KEYS=1 to use the public '
+                               'development key instead')
+        spec = DEV_KEYS
+    keys = {}
+    for item in spec.split(','):
+        kid, _, secret = item.strip().partition(':')
+        if not kid or not secret:
+            raise ValueError('AUTH_TOKEN_KEYS must look like "kid:secret,kid:secret"')
+        keys[kid] = secret.encode()
+    if DEV_KEYS.partition(':')[2].encode() in keys.values():
+        warn_dev_keys()
+    return keys
+
+
+_dev_keys_warned = False
+
+
+def warn_dev_keys():
+    global _dev_keys_warned
+    if not _dev_keys_warned:
+        _dev_keys_warned = True
+        logging.getLogger(__name__).warning('Access tokens are signed with the public development key: anyone can '
+                                            'forge them. Set AUTH_TOKEN_KEYS to a secret of your own.')
+
+
+def sign(signing_input, secret):
+    return b64encode(hmac.new(secret, signing_input.encode(), hashlib.sha256).digest())
+
+
+def issue_access_token(claims, keys=None, ttl=ACCESS_TOKEN_TTL):
+    """Return (token, jti, exp) for a new access token carrying `claims`"""
+    keys = keys or load_keys()
+    kid, secret = next(iter(keys.items()))
+    now = int(time.time())
+    payload = dict(claims, iat=now, exp=now + ttl, jti=uuid.uuid4().hex, typ='access')
+    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': kid}
+    signing_input = (b64encode(json.dumps(header, separators=(',', ':')).encode()) + '.' +
+                     b64encode(json.dumps(payload, separators=(',', ':')).encode()))
+    return f'{signing_input}.{sign(signing_input, secret)}', payload['jti'], payload['exp']
+
+
+class RevocationList:
+    """In-memory set of revoked token ids, reloaded at most every refresh_interval seconds.
+
+    loader() returns {jti: exp}. Only one thread reloads at a time; the
+    others keep using the current list, and a failed reload keeps it too.
+    """
+
+    def __init__(self, loader, refresh_interval=TOKEN_REVOCATION_REFRESH):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.revoked = {}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        self.revoked = dict(self.loader())
+        self.loaded_at = time.monotonic()
+
+    def add(self, jti, exp):
+        self.revoked[jti] = exp
+
+    def is_revoked(self, jti):
+        if time.monotonic() - self.loaded_at >= self.refresh_interval and self.lock.acquire(blocking=False):
+            try:
+                self.refresh()
+            except Exception:
+                self.loaded_at = time.monotonic()  # retry after the next interval
+            finally:
+                self.lock.release()
+        return jti in self.revoked
+
+
+def http_revocation_loader(auth_url, timeout=1.0):
+    """Loader for RevocationList reading auth_service's GET /token/revocations"""
+    def load():
+        with urllib.request.urlopen(f"{auth_url.rstrip('/')}/token/revocations", timeout=timeout) as response:
+            return json.load(response)['revoked']
+    return load
+
+
+class TokenVerifier:
+    def __init__(self, keys=None, revocations=None):
+        self.keys = keys or load_keys()
+        self.revocations = revocations
+
+    def verify(self, token):
+        """Return the claims of a valid access token, or raise InvalidToken"""
+        try:
+            header_b64, payload_b64, signature = token.split('.')
+            header = json.loads(b64decode(header_b64))
+            secret = self.keys.get(header.get('kid'))
+            if header.get('alg') != 'HS256' or secret is None:
+                raise InvalidToken('unknown key')
+            if not hmac.compare_digest(sign(f'{header_b64}.{payload_b64}', secret), signature):
+                raise InvalidToken('bad signature')
+            claims = json.loads(b64decode(payload_b64))
+        except InvalidToken:
+            raise
+        except (ValueError, AttributeError) as e:
+            raise InvalidToken(f'malformed token: {e}')
+        if claims.get('typ') != 'access':
+            raise InvalidToken('not an access token')
+        if claims.get('exp', 0) + CLOCK_LEEWAY < time.time():
+            raise InvalidToken('token expired')
+        if self.revocations is not None and self.revocations.is_revoked(claims.get('jti')):
+            raise InvalidToken('token revoked')
+        return claims
+
+
+def init_app(app, verifier):
+    """Verify the Bearer token of every request and expose its claims as g.token_claims.
+
+    Requests without a token get g.token_claims = None; a token that is
+    present but invalid, expired or revoked is answered with 401.
+    """
+    @app.before_request
+    def load_token_claims():
+        g.token_claims = None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            try:
+                g.token_claims = verifier.verify(header[len('Bearer '):])
+            except InvalidToken as e:
+                abort(401, f'invalid token: {e}')
+
+
+def token_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.get('token_claims') is None:
+            abort(401, 'token required')
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,383 @@
+"""Distributed tracing with W3C trace context (the `traceparent` header).
+
+init_app() opens a server span for every request, continuing the trace of
+the caller's traceparent header, and instrument_sqlalchemy() adds a span
+per query. Outgoing calls carry the current span with inject(); the store
+also copies it into its outbox events, so the catalog's span applying a
+change joins the trace of the request that made it.
+
+TRACE_EXPORTER chooses where finished spans go:
+  none  spans are not recorded (the default); ids are still propagated
+  file  one JSON object per line appended to TRACE_FILE
+  otlp  OTLP/HTTP JSON posted to OTLP_ENDPOINT (an OpenTelemetry collector)
+TRACE_SAMPLE_RATE is the fraction of new traces that are recorded; calls
+that arrive with a traceparent follow the caller's decision.
+
+    PYTHONPATH=services python -m common.tracing /tmp/traces/*.jsonl --trace <trace id>
+
+prints the spans of the slowest traces in the files (or of one trace) as a tree.
+"""
+import argparse
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from flask import g, request
+
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none')
+TRACE_FILE = os.getenv('TRACE_FILE')
+OTLP_ENDPOINT = os.getenv('OTLP_ENDPOINT', 'http://otel-collector:4318/v1/traces')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL = 2  # seconds between exports of finished spans
+EXPORT_QUEUE_SIZE = 10000  # past this spans are dropped rather than slowing requests down
+MAX_STATEMENT_LENGTH = 500
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+KINDS = {'internal': 1, 'server': 2, 'client': 3, 'producer': 4, 'consumer': 5}
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class SpanContext:
+    """The part of a span that crosses process boundaries"""
+
+    def __init__(self, trace_id, span_id, sampled):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @classmethod
+    def parse(cls, traceparent):
+        match = TRACEPARENT.match((traceparent or '').strip().lower())
+        if match is None or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+            return None
+        return cls(match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1)
+
+
+class Span(SpanContext):
+    def __init__(self, name, kind, trace_id, parent_id, sampled, start_time=None, attributes=None):
+        super().__init__(trace_id, random_id(8), sampled)
+        self.name = name
+        self.kind = kind
+        self.parent_id = parent_id
+        self.start_time = start_time or time.time()
+        self.end_time = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    @property
+    def recording(self):
+        return self.sampled and exporter is not None
+
+    def set_attribute(self, key, value):
+        if self.recording:
+            self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = str(error) or type(error).__name__
+
+    def end(self, end_time=None):
+        if self.end_time is None:
+            self.end_time = end_time or time.time()
+            if self.recording:
+                exporter.export(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'service': SERVICE_NAME,
+            'start': self.start_time,
+            'end': self.end_time,
+            'duration_ms': round((self.end_time - self.start_time) * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def random_id(size):
+    return random.getrandbits(size * 8).to_bytes(size, 'big').hex()
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_traceparent():
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+def start_span(name, kind='internal', parent=None, start_time=None, attributes=None):
+    """New span, child of `parent` (a span or a traceparent string) or of the current span.
+
+    The span is not made current; use span() for a with block that does.
+    """
+    if parent is None:
+        parent = _current_span.get()
+    elif isinstance(parent, str):
+        parent = SpanContext.parse(parent)
+    if parent is None:
+        return Span(name, kind, random_id(16), None, random.random() < TRACE_SAMPLE_RATE, start_time, attributes)
+    return Span(name, kind, parent.trace_id, parent.span_id, parent.sampled, start_time, attributes)
+
+
+@contextmanager
+def span(name, kind='internal', parent=None, attributes=None):
+    """Run the with block in a new current span, ended (and marked failed) on exit"""
+    new_span = start_span(name, kind, parent, attributes=attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.set_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+def inject(headers):
+    """Add the traceparent of the current span to a dict of outgoing headers"""
+    traceparent = current_traceparent()
+    if traceparent is not None:
+        headers['traceparent'] = traceparent
+    return headers
+
+
+class Exporter:
+    """Sends finished spans from a background thread, in batches"""
+
+    def __init__(self, kind, path=None, endpoint=None):
+        self.kind = kind
+        self.path = path
+        self.endpoint = endpoint
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+        # A forked worker needs its own export thread
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='trace-export', daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while len(batch) < EXPORT_BATCH_SIZE and time.monotonic() < deadline:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.send(batch)
+            except Exception as e:
+                print(f'[tracing] could not export {len(batch)} spans: {e}', flush=True)
+
+    def send(self, spans):
+        if self.kind == 'file':
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            data = ''.join(json.dumps(s) + '\n' for s in spans).encode()
+            # One O_APPEND write per batch: workers sharing the file do not interleave lines
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        else:
+            body = json.dumps(otlp_payload(spans)).encode()
+            req = urllib.request.Request(self.endpoint, data=body, headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(req, timeout=5).close()
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_payload(spans):
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+        'scopeSpans': [{'scope': {'name': 'bookstore'}, 'spans': [{
+            'traceId': s['trace_id'],
+            'spanId': s['span_id'],
+            'parentSpanId': s['parent_id'] or '',
+            'name': s['name'],
+            'kind': KINDS[s['kind']],
+            'startTimeUnixNano': str(int(s['start'] * 1e9)),
+            'endTimeUnixNano': str(int(s['end'] * 1e9)),
+            'attributes': [{'key': k, 'value': otlp_value(v)} for k, v in s['attributes'].items()],
+            'status': {'code': 2, 'message': s['error']} if s['error'] else {},
+        } for s in spans]}],
+    }]}
+
+
+SERVICE_NAME = 'unknown'
+exporter = None
+
+
+def configure(service_name):
+    """Name this process's spans and create the exporter chosen by TRACE_EXPORTER"""
+    global SERVICE_NAME, exporter
+    SERVICE_NAME = service_name
+    if TRACE_EXPORTER == 'file':
+        path = TRACE_FILE or os.path.join(tempfile.gettempdir(), 'traces', f'{service_name}.jsonl')
+        exporter = Exporter('file', path=path)
+    elif TRACE_EXPORTER == 'otlp':
+        exporter = Exporter('otlp', endpoint=OTLP_ENDPOINT)
+    elif TRACE_EXPORTER != 'none':
+        raise ValueError(f'TRACE_EXPORTER must be none, file or otlp, not {TRACE_EXPORTER!r}')
+
+
+def init_app(app, service_name):
+    """Open a server span per request and return its traceparent in the response"""
+    configure(service_name)
+
+    @app.before_request
+    def start_server_span():
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        server_span = start_span(f'{request.method} {route}', 'server', request.headers.get('traceparent'),
+                                 attributes={'http.method': request.method, 'http.route': route})
+        g.trace_span = server_span
+        _current_span.set(server_span)
+
+    @app.after_request
+    def add_traceparent(response):
+        server_span = g.get('trace_span')
+        if server_span is not None:
+            server_span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                server_span.set_error(f'HTTP {response.status_code}')
+            response.headers['traceparent'] = server_span.traceparent
+        return response
+
+    @app.teardown_request
+    def end_server_span(error):
+        server_span = g.pop('trace_span', None)
+        if server_span is not None:
+            if error is not None:
+                server_span.set_error(error)
+            server_span.end()
+        # Server threads are reused: the next request must not see this span
+        _current_span.set(None)
+
+
+_sqlalchemy_instrumented = False
+
+
+def instrument_sqlalchemy():
+    """Add a span per query to the recorded spans of this process"""
+    global _sqlalchemy_instrumented
+    if _sqlalchemy_instrumented:
+        return  # the listeners are global: several apps in one process share them
+    _sqlalchemy_instrumented = True
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query_span(conn, cursor, statement, parameters, context, executemany):
+        parent = _current_span.get()
+        if parent is not None and parent.recording:
+            words = statement.split(None, 1)
+            context.trace_span = start_span(words[0].upper() if words else 'SQL', 'client', parent, attributes={
+                'db.system': conn.dialect.name,
+                'db.statement': statement[:MAX_STATEMENT_LENGTH],
+            })
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def end_query_span(conn, cursor, statement, parameters, context, executemany):
+        query_span = getattr(context, 'trace_span', None)
+        if query_span is not None:
+            query_span.end()
+
+    @event.listens_for(Engine, 'handle_error')
+    def fail_query_span(exception_context):
+        query_span = getattr(exception_context.execution_context, 'trace_span', None)
+        if query_span is not None:
+            query_span.set_error(exception_context.original_exception)
+            query_span.end()
+
+
+def print_tree(spans):
+    children = {}
+    for s in spans:
+        children.setdefault(s['parent_id'], []).append(s)
+    ids = {s['span_id'] for s in spans}
+    first = min(s['start'] for s in spans)
+
+    def walk(s, depth):
+        error = f"  ERROR {s['error']}" if s.get('error') else ''
+        print(f"{(s['start'] - first) * 1000:9.1f} ms {s['duration_ms']:9.1f} ms  "
+              f"{'  ' * depth}{s['service']}: {s['name']}{error}")
+        for child in sorted(children.get(s['span_id'], []), key=lambda c: c['start']):
+            walk(child, depth + 1)
+
+    # Spans whose parent was not recorded (e.g. a caller without tracing) start a tree
+    for root in sorted((s for s in spans if s['parent_id'] not in ids), key=lambda r: r['start']):
+        walk(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show traces written by TRACE_EXPORTER=file')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--trace', help='trace id to show (default: the slowest ones)')
+    parser.add_argument('--top', type=int, default=3, help='how many of the slowest traces to show')
+    args = parser.parse_args()
+    traces = {}
+    for path in args.files:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    s = json.loads(line)
+                    traces.setdefault(s['trace_id'], []).append(s)
+    if args.trace:
+        selected = [args.trace]
+    else:
+        def duration(trace_id):
+            spans = traces[trace_id]
+            return max(s['end'] for s in spans) - min(s['start'] for s in spans)
+        selected = sorted(traces, key=duration, reverse=True)[:args.top]
+    for trace_id in selected:
+        print(f'trace {trace_id}')
+        print_tree(traces.get(trace_id, []))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,227 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
 import requests
 import os
+import threading
+import time
+import pika
+import uuid
+import math
+import tempfile
+from urllib.parse import urlencode
+from jinja2 import FileSystemBytecodeCache
+from http_client import UpstreamClient, fan_out, start_deadline
+from cache import ResponseCache, NotModified, Gone, make_backend, ALL
+from fragments import FragmentCache, PageCache, fill_keys, page_signature
+from common import tokens, serving, metrics, tracing, ratelimit, events
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'secretkey-for-frontend')
 
+# Plantillas compiladas guardadas en disco entre arranques; con preload de
+# gunicorn se compilan en el master y los workers las heredan ya cargadas
+JINJA_BYTECODE_CACHE_DIR = os.getenv('JINJA_BYTECODE_CACHE_DIR',
+                                     os.path.join(tempfile.gettempdir(), 'frontend-jinja-cache'))
+if JINJA_BYTECODE_CACHE_DIR:
+    os.makedirs(JINJA_BYTECODE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR)
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+# GET /metrics: latencia por ruta y por upstream (ver http_client.py)
+metrics.init_app(app)
+# Trazas: un span por petición y por llamada a upstream, propagado con traceparent
+tracing.init_app(app, 'frontend')
+
 # URLs de los microservicios
 AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://auth_service:5001')
 CATALOG_SERVICE_URL = os.getenv('CATALOG_SERVICE_URL', 'http://catalog_service:5002')
 STORE_SERVICE_URL = os.getenv('STORE_SERVICE_URL', 'http://store_service:5003')
+ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order_service:5004')
 
 print(f"[CONFIG] AUTH_SERVICE_URL: {AUTH_SERVICE_URL}")
 print(f"[CONFIG] CATALOG_SERVICE_URL: {CATALOG_SERVICE_URL}")
 print(f"[CONFIG] STORE_SERVICE_URL: {STORE_SERVICE_URL}")
+print(f"[CONFIG] ORDER_SERVICE_URL: {ORDER_SERVICE_URL}")
+
+# Clientes HTTP con pool de conexiones keep-alive, timeouts y reintentos, y
+# con circuit breaker y bulkhead propios para aislar a cada upstream
+auth_client = UpstreamClient('auth', AUTH_SERVICE_URL)
+catalog_client = UpstreamClient('catalog', CATALOG_SERVICE_URL)
+store_client = UpstreamClient('store', STORE_SERVICE_URL)
+order_client = UpstreamClient('orders', ORDER_SERVICE_URL)
+UPSTREAM_CLIENTS = (auth_client, catalog_client, store_client, order_client)
+
+# Caché de lecturas del catálogo, invalidada por los eventos de book_events
+RABBITMQ_URL = os.getenv('RABBITMQ_URL', 'amqp://rabbitmq')
+response_cache = ResponseCache(make_backend())
+
+# HTML de las tarjetas de libro por versión y, para anónimos, páginas del
+# catálogo completas (ver fragments.py); CATALOG_PRERENDER=0 las desactiva
+fragment_cache = FragmentCache(lambda: app.jinja_env.get_template('_book_card.html'))
+page_cache = PageCache()
+CATALOG_PRERENDER = os.getenv('CATALOG_PRERENDER', '1') == '1'
+
+# Límites por IP y por usuario (token bucket, en memoria o compartidos con
+# RATE_LIMIT_URL) y control de admisión: ver common/ratelimit.py
+rate_limiter = ratelimit.RateLimiter()
+IP_LIMIT = ratelimit.parse_limit(os.getenv('RATE_LIMIT_PER_IP', '120/minute'))
+USER_LIMIT = ratelimit.parse_limit(os.getenv('RATE_LIMIT_PER_USER', '120/minute'))
+# Login y registro calculan un hash de contraseña en auth: límite propio más estricto
+LOGIN_LIMIT = ratelimit.parse_limit(os.getenv('RATE_LIMIT_LOGIN', '10/minute'))
+admission = ratelimit.AdmissionControl()
+
+# Los access tokens emitidos por auth se verifican aquí mismo (firma, expiración
+# y lista de revocados), sin una llamada a auth_service por petición
+token_verifier = tokens.TokenVerifier(
+    revocations=tokens.RevocationList(tokens.http_revocation_loader(AUTH_SERVICE_URL)))
+
+class UpstreamGone(Gone, requests.exceptions.HTTPError):
+    """404 o 410 del upstream: la caché borra la entrada y las rutas lo ven como un HTTPError más"""
+
+def fetch_json(client, path, params=None, etag=None):
+    """GET condicional: devuelve (JSON, ETag), lanza NotModified si el upstream
+    responde 304 al etag enviado, UpstreamGone si responde 404 o 410, o
+    HTTPError si la respuesta no es 2xx"""
+    headers = {'If-None-Match': etag} if etag else None
+    response = client.get(path, params=params, headers=headers)
+    if response.status_code == 304:
+        raise NotModified()
+    if response.status_code in (404, 410):
+        raise UpstreamGone(f'{response.status_code} {path}', response=response)
+    response.raise_for_status()
+    return response.json(), response.headers.get('ETag')
+
+def get_book_cached(book_id):
+    """Libro del store_service, cacheado hasta que llegue un evento que lo cambie"""
+    return response_cache.get_or_fetch(
+        f'book:{book_id}',
+        lambda etag: fetch_json(store_client, f'/books/{book_id}', etag=etag),
+        scopes=(f'book:{book_id}',))
+
+def get_my_books_cached(user_id):
+    """Libros publicados por el usuario; cualquier cambio de libros invalida la lista
+    y al refrescarla se revalida con ETag"""
+    return response_cache.get_or_fetch(
+        f'my_books:{user_id}',
+        lambda etag: fetch_json(store_client, '/books', {'user_id': user_id}, etag),
+        scopes=('catalog',))
+
+def invalidate_book(book_id=None):
+    """Invalida las páginas del catálogo y, si se indica, un libro concreto"""
+    response_cache.invalidate('catalog')
+    if book_id is not None:
+        response_cache.invalidate(f'book:{book_id}')
+    fragment_cache.invalidate(book_id)
+
+def start_cache_invalidator():
+    """Escucha book_events (cola exclusiva de este proceso) e invalida la caché"""
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.URLParameters(RABBITMQ_URL))
+            channel = connection.channel()
+            channel.exchange_declare(exchange='book_events', exchange_type='fanout', durable=True)
+            queue_name = channel.queue_declare(queue='', exclusive=True).method.queue
+            channel.queue_bind(exchange='book_events', queue=queue_name)
+            # Mientras no hubo suscripción se pudieron perder eventos
+            response_cache.invalidate(ALL)
+            fragment_cache.invalidate()
+
+            def on_event(ch, method, properties, body):
+                try:
+                    # Un evento o un lote, en JSON o msgpack y quizá comprimido (common/events.py)
+                    message = events.decode(body, properties.content_type, properties.content_encoding)
+                    for event in events.unpack(message):
+                        invalidate_book(event['id'])
+                except Exception as e:
+                    app.logger.error(f"Evento de libro inválido: {e}")
+                    invalidate_book()
+
+            channel.basic_consume(queue=queue_name, on_message_callback=on_event, auto_ack=True)
+            app.logger.info("Invalidación de caché suscrita a book_events")
+            channel.start_consuming()
+        except Exception as e:
+            app.logger.error(f"Conexión con RabbitMQ perdida ({e}), reintentando...")
+            time.sleep(5)
+
+@app.before_request
+def set_request_deadline():
+    """Todas las llamadas a upstreams de esta petición comparten un mismo presupuesto"""
+    start_deadline()
+
+@app.before_request
+def apply_rate_limits():
+    """429 antes de hacer ningún trabajo si el cliente superó sus límites"""
+    if ratelimit.is_exempt():
+        return
+    ip = ratelimit.client_ip()
+    rate_limiter.hit('ip', ip, IP_LIMIT)
+    # El usuario de la sesión (cookie firmada), sin verificar el token: basta para contar
+    user_id = (session.get('user') or {}).get('id')
+    if user_id is not None:
+        rate_limiter.hit('user', user_id, USER_LIMIT)
+    if request.method == 'POST' and request.endpoint in ('login', 'register'):
+        rate_limiter.hit('login', ip, LOGIN_LIMIT)
+
+def render_overloaded(error, status):
+    """Página mínima para 429 y 503; sin context processors, que podrían llamar a auth"""
+    return app.jinja_env.get_template('busy.html').render(status=status, retry_after=math.ceil(error.retry_after))
+
+# Después de los límites: una petición rechazada no ocupa sitio en la cola
+ratelimit.init_app(app, admission, render=render_overloaded)
 
 # Simulación de flask-login con sesiones
+def store_tokens(issued):
+    """Guarda en la sesión el par de tokens devuelto por auth (/login o /token/refresh)"""
+    session['access_token'] = issued.get('access_token')
+    session['refresh_token'] = issued.get('refresh_token')
+
+def clear_session_user():
+    for key in ('user', 'access_token', 'refresh_token'):
+        session.pop(key, None)
+
+def auth_headers():
+    """Cabecera Authorization para reenviar la identidad del usuario a los servicios"""
+    access_token = session.get('access_token')
+    return {'Authorization': f'Bearer {access_token}'} if access_token else {}
+
+def load_session_user():
+    user = session.get('user')
+    access_token = session.get('access_token')
+    if not user or not access_token:
+        return None
+    try:
+        token_verifier.verify(access_token)
+        return user
+    except tokens.InvalidToken:
+        pass
+    # Token caducado o revocado: se renueva una vez con el refresh token
+    try:
+        response = auth_client.post('/token/refresh', json={'refresh_token': session.get('refresh_token')})
+    except requests.exceptions.RequestException as e:
+        app.logger.warning(f"Token refresh failed: {e}")
+        return None
+    if response.status_code == 200:
+        store_tokens(response.json())
+        return user
+    clear_session_user()
+    return None
+
 def get_current_user():
-    """Retorna el usuario actual de la sesión o None"""
-    return session.get('user')
+    """Retorna el usuario actual de la sesión o None.
+
+    El access token se verifica localmente; al caducar se renueva con el
+    refresh token y, si auth ya no lo acepta, se cierra la sesión.
+    """
+    if 'current_user' not in g:
+        g.current_user = load_session_user()
+    return g.current_user
 
 def login_required(f):
     """Decorador para rutas que requieren autenticación"""
     from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user' not in session:
+        if get_current_user() is None:
             flash('Debes iniciar sesión primero')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -35,6 +232,20 @@ def login_required(f):
 def home():
     return render_template('home.html')
 
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(dict(response_cache.stats(), fragments=fragment_cache.stats(), pages=page_cache.stats()))
+
+@app.route('/admission/stats')
+def admission_stats():
+    """Peticiones admitidas, en cola y rechazadas por sobrecarga o por límite (en este proceso)"""
+    return jsonify({'admission': admission.stats(), 'rate_limits': rate_limiter.stats()})
+
+@app.route('/upstreams/stats')
+def upstream_stats():
+    """Circuit breaker y llamadas en curso de cada upstream (en este proceso)"""
+    return jsonify({client.name: client.stats() for client in UPSTREAM_CLIENTS})
+
 @app.route('/debug')
 def debug():
     return jsonify({
@@ -55,14 +266,14 @@ def login():
             return render_template('login.html')
         
         try:
-            response = requests.post(
-                f'{AUTH_SERVICE_URL}/login',
-                json={'email': email, 'password': password},
-                timeout=5
+            response = auth_client.post(
+                '/login',
+                json={'email': email, 'password': password}
             )
             
             if response.status_code == 200:
                 user_data = response.json().get('user', {})
+                store_tokens(response.json())
                 session['user'] = {
                     'id': user_data.get('id'),
                     'username': user_data.get('username'),
@@ -94,10 +305,9 @@ def register():
         password = request.form.get('password')
         
         try:
-            response = requests.post(
-                f'{AUTH_SERVICE_URL}/register',
-                json={'username': name, 'email': email, 'password': password},
-                timeout=5
+            response = auth_client.post(
+                '/register',
+                json={'username': name, 'email': email, 'password': password}
             )
             
             if response.status_code == 201:
@@ -116,37 +326,90 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
-    session.pop('user', None)
+    try:
+        auth_client.post('/logout', json={'refresh_token': session.get('refresh_token')}, headers=auth_headers())
+    except requests.exceptions.RequestException as e:
+        app.logger.warning(f"Logout could not revoke tokens: {e}")
+    clear_session_user()
     flash('Sesión cerrada')
     return redirect(url_for('home'))
 
 # ==================== BOOK ROUTES ====================
+# Parámetros de /catalog que se reenvían tal cual al catalog_service
+CATALOG_QUERY_PARAMS = ('cursor', 'limit', 'sort', 'order', 'author', 'min_price', 'max_price', 'in_stock')
+
+# Parámetros de búsqueda de texto completo (/catalog/search)
+SEARCH_QUERY_PARAMS = ('q', 'offset', 'limit', 'in_stock')
+
 @app.route('/catalog')
 def catalog():
-    try:
-        response = requests.get(f'{CATALOG_SERVICE_URL}/catalog', timeout=5)
-        if response.status_code == 200:
-            books = response.json()
-        else:
-            books = []
-            flash('Error al obtener el catálogo')
-    except requests.exceptions.RequestException as e:
+    if request.args.get('q', '').strip():
+        # Con texto de búsqueda se usa el índice full-text del catálogo
+        path = '/catalog/search'
+        params = {k: v for k, v in request.args.items() if k in SEARCH_QUERY_PARAMS and v != ''}
+        page_param = 'offset'
+    else:
+        path = '/catalog'
+        params = {k: v for k, v in request.args.items() if k in CATALOG_QUERY_PARAMS and v != ''}
+        page_param = 'cursor'
+    page_key = f'catalog:{path}?{urlencode(sorted(params.items()))}'
+    calls = {
+        'page': lambda: response_cache.get_or_fetch(
+            page_key,
+            lambda etag: fetch_json(catalog_client, path, params, etag),
+            # Con el catálogo caído se muestra la última página buena
+            scopes=('catalog',), fallback=True),
+    }
+    user_id = (get_current_user() or {}).get('id')
+    if user_id is not None:
+        # Los libros propios se piden al store en paralelo con el catálogo
+        calls['mine'] = lambda: get_my_books_cached(user_id)
+    results = fan_out(calls)
+
+    next_page = None
+    page = results['page']
+    if isinstance(page, requests.exceptions.HTTPError):
+        books = []
+        flash('Error al obtener el catálogo')
+    elif isinstance(page, Exception):
         books = []
         flash('Error de conexión con el servicio de catálogo')
-    
-    return render_template('catalog.html', books=books)
+    else:
+        books = page.get('items', [])
+        next_page = page.get('next_offset' if page_param == 'offset' else 'next_cursor')
+    # Si el store no responde, simplemente no se marcan los libros propios
+    mine = results.get('mine')
+    own_book_ids = {b['id'] for b in mine} if isinstance(mine, list) else set()
+
+    # Filtros activos (sin el cursor/offset) para construir los enlaces de paginación
+    filters = {k: v for k, v in params.items() if k != page_param}
+    next_args = dict(filters, **{page_param: next_page}) if next_page is not None else None
+
+    # Anónimos sin mensajes pendientes ven todos la misma página: se sirve ya
+    # renderizada mientras sus libros no cambien de versión
+    signature = None
+    if CATALOG_PRERENDER and user_id is None and not isinstance(page, Exception) and '_flashes' not in session:
+        signature = page_signature(books, next_page)
+        html = page_cache.get(page_key, signature) if signature is not None else None
+        if html is not None:
+            return html
+
+    cards = [fragment_cache.card(book, book['id'] in own_book_ids) for book in books]
+    html = render_template('catalog.html', cards=cards, filters=filters, next_args=next_args,
+                           is_first_page=page_param not in params)
+    if signature is not None:
+        page_cache.put(page_key, signature, html)
+    return fill_keys(html)
 
 @app.route('/my_books')
 @login_required
 def my_books():
     user_id = session.get('user', {}).get('id')
     try:
-        response = requests.get(f'{STORE_SERVICE_URL}/books', params={'user_id': user_id}, timeout=5)
-        if response.status_code == 200:
-            books = response.json()
-        else:
-            books = []
-            flash('Error al obtener tus libros')
+        books = get_my_books_cached(user_id)
+    except requests.exceptions.HTTPError:
+        books = []
+        flash('Error al obtener tus libros')
     except requests.exceptions.RequestException as e:
         books = []
         flash('Error de conexión')
@@ -165,8 +428,8 @@ def add_book():
             user_id = session.get('user', {}).get('id')
             
             app.logger.info(f"Intentando agregar libro con user_id={user_id}")
-            response = requests.post(
-                f'{STORE_SERVICE_URL}/books',
+            response = store_client.post(
+                '/books',
                 json={
                     'title': title,
                     'author': author,
@@ -175,10 +438,11 @@ def add_book():
                     'stock': stock,
                     'user_id': user_id
                 },
-                timeout=5
+                headers=auth_headers()
             )
             app.logger.info(f"Respuesta del store: status={response.status_code}, body={response.text}")
             if response.status_code == 201:
+                invalidate_book()
                 flash('Libro agregado exitosamente')
                 return redirect(url_for('my_books'))
             else:
@@ -200,8 +464,8 @@ def edit_book(book_id):
         stock = int(request.form.get('stock'))
         
         try:
-            response = requests.put(
-                f'{STORE_SERVICE_URL}/books/{book_id}',
+            response = store_client.put(
+                f'/books/{book_id}',
                 json={
                     'title': title,
                     'author': author,
@@ -209,10 +473,11 @@ def edit_book(book_id):
                     'price': price,
                     'stock': stock
                 },
-                timeout=5
+                headers=auth_headers()
             )
             
             if response.status_code == 200:
+                invalidate_book(book_id)
                 flash('Libro actualizado exitosamente')
                 return redirect(url_for('my_books'))
             else:
@@ -222,7 +487,7 @@ def edit_book(book_id):
     
     # GET: obtener datos del libro
     try:
-        response = requests.get(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=5)
+        response = store_client.get(f'/books/{book_id}')
         if response.status_code == 200:
             book = response.json()
             return render_template('edit_book.html', book=book)
@@ -237,8 +502,9 @@ def edit_book(book_id):
 @login_required
 def delete_book(book_id):
     try:
-        response = requests.delete(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=5)
+        response = store_client.delete(f'/books/{book_id}', headers=auth_headers())
         if response.status_code == 204:
+            invalidate_book(book_id)
             flash('Libro eliminado exitosamente')
         else:
             flash('Error al eliminar el libro')
@@ -248,155 +514,132 @@ def delete_book(book_id):
     return redirect(url_for('my_books'))
 
 # ==================== PURCHASE/PAYMENT/DELIVERY ====================
+# Los pedidos viven en order_service: el gateway solo los crea y registra el
+# pago y la entrega elegidos; los workers de order_service descuentan el
+# stock, cobran y envían en segundo plano, así que cada paso responde al instante.
+
+# Mock de proveedores (en el monolito viene de la BD)
+DELIVERY_PROVIDERS = [
+    {'id': '1', 'name': 'DHL', 'coverage_area': 'Internacional', 'cost': 50.0},
+    {'id': '2', 'name': 'FedEx', 'coverage_area': 'Internacional', 'cost': 45.0},
+    {'id': '3', 'name': 'Envia', 'coverage_area': 'Nacional', 'cost': 20.0},
+    {'id': '4', 'name': 'Servientrega', 'coverage_area': 'Nacional', 'cost': 15.0},
+]
+
+def get_order(order_id):
+    """Pedido del usuario actual, o None si no existe o es de otro usuario"""
+    response = order_client.get(f'/orders/{order_id}', headers=auth_headers())
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
 @app.route('/buy/<int:book_id>', methods=['POST'])
 @login_required
 def buy(book_id):
-    quantity = int(request.form.get('quantity', 1))
-    price = float(request.form.get('price'))
-    user_id = session.get('user', {}).get('id')
-    
+    quantity = request.form.get('quantity', 1, type=int)
+    if not quantity or quantity < 1:
+        flash('Cantidad inválida')
+        return redirect(url_for('catalog'))
     try:
-        # Obtener información del libro
-        book_response = requests.get(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=5)
-        if book_response.status_code != 200:
+        # order_service toma título y precio del store; aquí solo se comprueba el stock
+        try:
+            book = get_book_cached(book_id)
+        except requests.exceptions.HTTPError:
             flash('Libro no encontrado')
             return redirect(url_for('catalog'))
-        
-        book = book_response.json()
-        
+
         if book.get('stock', 0) < quantity:
             flash('No hay suficiente stock disponible')
             return redirect(url_for('catalog'))
-        
-        # Calcular precio total
-        total_price = price * quantity
-        
-        # NO REDUCIR STOCK AQUÍ - Se reducirá al confirmar la entrega
-        
-        # Crear un ID de compra simulado y guardarlo en sesión
-        import time
-        purchase_id = int(time.time())
-        session['current_purchase'] = {
-            'id': purchase_id,
+
+        # El formulario trae una clave única: reenviarlo (doble clic, reintento)
+        # devuelve el mismo pedido en lugar de crear otro.
+        # NO SE DESCUENTA STOCK AQUÍ - Se descuenta al procesar el pago
+        key = request.form.get('idempotency_key') or uuid.uuid4().hex
+        response = order_client.post('/orders', json={
             'book_id': book_id,
-            'book_title': book.get('title'),
             'quantity': quantity,
-            'total_price': total_price,
-            'user_id': user_id,
-            'status': 'Pending Payment'
-        }
-        # Redirigir a la página de pago
-        return redirect(url_for('payment_page', purchase_id=purchase_id))
+        }, headers=dict(auth_headers(), **{'Idempotency-Key': key}))
+        if response.status_code in (200, 201):
+            return redirect(url_for('payment_page', purchase_id=response.json()['id']))
+        flash('No se pudo crear el pedido')
     except requests.exceptions.RequestException as e:
         flash('Error de conexión')
-    
+
     return redirect(url_for('catalog'))
 
 @app.route('/payment/<int:purchase_id>', methods=['GET', 'POST'])
 @login_required
 def payment_page(purchase_id):
-    # Obtener datos de la compra actual
-    purchase = session.get('current_purchase')
-    
-    if not purchase or purchase.get('id') != purchase_id:
+    try:
+        if request.method == 'POST':
+            method = request.form.get('method')
+            response = order_client.post(f'/orders/{purchase_id}/payment',
+                                         json={'method': method}, headers=auth_headers())
+            if response.status_code == 404:
+                flash('Compra no encontrada')
+                return redirect(url_for('catalog'))
+            if response.status_code != 202:
+                flash('No se pudo registrar el pago')
+                return redirect(url_for('order_status', purchase_id=purchase_id))
+            flash(f'Pago pendiente con {method}')
+            # Redirigir a opciones de entrega
+            return redirect(url_for('select_delivery', purchase_id=purchase_id))
+
+        purchase = get_order(purchase_id)
+    except requests.exceptions.RequestException as e:
+        flash('Error de conexión')
+        return redirect(url_for('catalog'))
+    if purchase is None:
         flash('Compra no encontrada')
         return redirect(url_for('catalog'))
-    
-    if request.method == 'POST':
-        method = request.form.get('method')
-        amount = request.form.get('amount')
-        
-        # Actualizar estado de la compra
-        purchase['status'] = 'Paid'
-        purchase['payment_method'] = method
-        session['current_purchase'] = purchase
-        
-        flash(f'Pago pendiente con {method}')
-        
-        # Redirigir a opciones de entrega
-        return redirect(url_for('select_delivery', purchase_id=purchase_id))
-    
-    # Pasar información de la compra al template
     return render_template('payment.html', purchase=purchase, purchase_id=purchase_id)
 
 @app.route('/delivery/<int:purchase_id>', methods=['GET', 'POST'])
 @login_required
 def select_delivery(purchase_id):
-    # Obtener datos de la compra actual
-    purchase = session.get('current_purchase')
-    
-    if not purchase or purchase.get('id') != purchase_id:
-        flash('Compra no encontrada')
-        return redirect(url_for('catalog'))
-    
     if request.method == 'POST':
         provider_id = request.form.get('provider')
-        
-        # Mock de proveedores
-        providers = [
-            {'id': '1', 'name': 'DHL'},
-            {'id': '2', 'name': 'FedEx'},
-            {'id': '3', 'name': 'Envia'},
-            {'id': '4', 'name': 'Servientrega'},
-        ]
-        provider_name = next((p['name'] for p in providers if p['id'] == provider_id), 'Desconocido')
-        
-        # AQUÍ REDUCIR EL STOCK AL CONFIRMAR LA ENTREGA
+        provider_name = next((p['name'] for p in DELIVERY_PROVIDERS if p['id'] == provider_id), 'Desconocido')
         try:
-            book_id = purchase.get('book_id')
-            quantity = purchase.get('quantity')
-            
-            # Obtener el libro actual
-            book_response = requests.get(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=5)
-            if book_response.status_code == 200:
-                book = book_response.json()
-                updated_stock = book.get('stock', 0) - quantity
-                
-                # Actualizar stock en el backend
-                update_data = {
-                    'title': book.get('title'),
-                    'author': book.get('author'),
-                    'description': book.get('description'),
-                    'price': book.get('price'),
-                    'stock': updated_stock,
-                    'user_id': book.get('user_id')
-                }
-                
-                update_response = requests.put(
-                    f'{STORE_SERVICE_URL}/books/{book_id}',
-                    json=update_data,
-                    timeout=5
-                )
-                
-                if update_response.status_code == 200:
-                    flash(f'Compra completada! Entrega asignada a {provider_name}. Stock actualizado. Libro: {purchase.get("book_title")}')
-                else:
-                    flash(f'Advertencia: Entrega asignada pero hubo un problema al actualizar el stock')
-            else:
-                flash(f'Advertencia: Entrega asignada pero no se pudo actualizar el stock')
-        except Exception as e:
-            flash(f'Advertencia: Entrega asignada pero hubo un error: {e}')
-        
-        # Limpiar la compra de la sesión
-        session.pop('current_purchase', None)
-        
+            response = order_client.post(f'/orders/{purchase_id}/delivery', json={
+                'provider_id': provider_id,
+                'provider_name': provider_name,
+            }, headers=auth_headers())
+        except requests.exceptions.RequestException as e:
+            flash('Error de conexión')
+            return redirect(url_for('select_delivery', purchase_id=purchase_id))
+        if response.status_code == 404:
+            flash('Compra no encontrada')
+            return redirect(url_for('catalog'))
+        if response.status_code != 202:
+            flash('No se pudo asignar la entrega')
+        else:
+            flash(f'Pedido #{purchase_id} en proceso: se enviará con {provider_name} cuando se confirme el pago')
+        return redirect(url_for('order_status', purchase_id=purchase_id))
+
+    return render_template('delivery_options.html', providers=DELIVERY_PROVIDERS, purchase_id=purchase_id)
+
+@app.route('/orders/<int:purchase_id>')
+@login_required
+def order_status(purchase_id):
+    """Estado del pedido; la página se recarga sola hasta que termina"""
+    try:
+        purchase = get_order(purchase_id)
+    except requests.exceptions.RequestException as e:
+        flash('Error de conexión')
         return redirect(url_for('catalog'))
-    
-    # Mock de proveedores (en el monolito viene de la BD)
-    providers = [
-        {'id': 1, 'name': 'DHL', 'coverage_area': 'Internacional', 'cost': 50.0},
-        {'id': 2, 'name': 'FedEx', 'coverage_area': 'Internacional', 'cost': 45.0},
-        {'id': 3, 'name': 'Envia', 'coverage_area': 'Nacional', 'cost': 20.0},
-        {'id': 4, 'name': 'Servientrega', 'coverage_area': 'Nacional', 'cost': 15.0},
-    ]
-    
-    return render_template('delivery_options.html', providers=providers, purchase_id=purchase_id)
+    if purchase is None:
+        flash('Compra no encontrada')
+        return redirect(url_for('catalog'))
+    return render_template('order_status.html', purchase=purchase)
 
 @app.route('/admin/users')
 @login_required
 def list_users():
     try:
-        response = requests.get(f'{AUTH_SERVICE_URL}/users', timeout=5)
+        response = auth_client.get('/users', headers=auth_headers())
         if response.status_code == 200:
             users_data = response.json()
             users = []
@@ -436,5 +679,19 @@ def inject_user():
     
     return dict(current_user=CurrentUser(user))
 
+serving.add_health_routes(app)
+
+def start_background_tasks():
+    """Invalidación de la caché en segundo plano.
+
+    Corre en cada worker: cada proceso tiene su propia caché en memoria y
+    su propia cola de invalidación.
+    """
+    invalidator_thread = threading.Thread(target=start_cache_invalidator, daemon=True)
+    invalidator_thread.start()
+
 if __name__ == '__main__':
+    # Servidor de desarrollo; en producción se usa gunicorn con gunicorn.conf.py
+    start_background_tasks()
+
     app.run(host='0.0.0.0', port=5000, debug=True)
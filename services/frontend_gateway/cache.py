@@ -0,0 +1,255 @@
+"""Caché de respuestas del catálogo en el gateway.
+
+Las entradas viven en un backend intercambiable: en memoria (TTL + LRU, por
+proceso) o compatible con Redis (compartido entre procesos) si CACHE_URL
+empieza por redis://. Cualquier servidor que hable el protocolo de Redis
+sirve como sustituto local.
+
+Cada entrada guarda también el ETag de la respuesta, de modo que al refrescar
+se revalida con If-None-Match y un 304 evita volver a transferir el cuerpo.
+
+La invalidación es por "ámbitos": cada entrada declara de qué ámbitos depende
+(p.ej. 'catalog' o 'book:42') y al invalidar un ámbito se guarda la marca de
+tiempo; una entrada guardada antes de esa marca deja de estar fresca. Las
+entradas no frescas se siguen sirviendo mientras el upstream esté lento o
+caído (stale-while-revalidate) y se refrescan en segundo plano.
+
+Las lecturas con fallback=True guardan además una copia de la última
+respuesta buena durante CACHE_FALLBACK_TTL, que se sirve cuando la entrada
+ya expiró y el upstream falla (p.ej. con su circuit breaker abierto).
+
+Si al refrescar el upstream dice que el recurso ya no existe (Gone, p.ej.
+un 404 de un libro borrado), la entrada y su copia se borran: un recurso
+borrado no es un upstream caído y no se sigue sirviendo.
+
+Aciertos, fallos, refrescos, etc. se cuentan en /cache/stats (por proceso)
+y en la métrica gateway_cache_events_total de /metrics.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from common import metrics
+
+CACHE_URL = os.getenv('CACHE_URL', '')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1000'))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+CACHE_STALE_TTL = float(os.getenv('CACHE_STALE_TTL', '300'))
+# Cuánto se espera al upstream antes de servir una entrada no fresca
+CACHE_REVALIDATE_WAIT = float(os.getenv('CACHE_REVALIDATE_WAIT', '0.3'))
+# Cuánto se guarda la última respuesta buena de las lecturas con fallback
+CACHE_FALLBACK_TTL = float(os.getenv('CACHE_FALLBACK_TTL', '86400'))
+
+# Ámbito del que dependen todas las entradas
+ALL = 'all'
+
+CACHE_EVENTS = metrics.Counter('gateway_cache_events_total',
+                               'Lecturas y refrescos de la caché de respuestas del gateway, por resultado',
+                               ('event',))
+
+
+class NotModified(Exception):
+    """El upstream respondió 304: la entrada cacheada sigue siendo válida"""
+
+
+class Gone(Exception):
+    """El upstream respondió que el recurso ya no existe: la entrada se borra"""
+
+
+class MemoryBackend:
+    """Diccionario LRU con expiración, seguro entre hilos"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisBackend:
+    """Backend compartido sobre cualquier servidor compatible con Redis"""
+
+    def __init__(self, url, prefix='gateway-cache:'):
+        import redis  # dependencia opcional, solo si se configura CACHE_URL
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def make_backend(url=CACHE_URL):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    return MemoryBackend()
+
+
+class ResponseCache:
+    # Las marcas de invalidación solo importan durante `ttl` (después la
+    # entrada ya caducó por tiempo), así que caben muchas en poca memoria.
+    MAX_MARKS = 100000
+
+    def __init__(self, backend, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL, revalidate_wait=CACHE_REVALIDATE_WAIT,
+                 fallback_ttl=CACHE_FALLBACK_TTL):
+        self.backend = backend
+        # En memoria las marcas van aparte para que el LRU de las respuestas no las expulse
+        self.marks = MemoryBackend(self.MAX_MARKS) if isinstance(backend, MemoryBackend) else backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.revalidate_wait = revalidate_wait
+        self.fallback_ttl = fallback_ttl
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='cache-refresh')
+        self.refreshing = {}  # clave -> Future del refresco en curso
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stale_hits': 0,
+                         'refreshes': 0, 'not_modified': 0, 'refresh_errors': 0, 'invalidations': 0,
+                         'fallbacks': 0, 'evictions': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+        CACHE_EVENTS.inc(event=name)
+
+    def invalidate(self, scope):
+        """Marca como no frescas todas las entradas que dependen de `scope`"""
+        self.marks.set(f'inval:{scope}', time.time(), self.ttl)
+        self.count('invalidations')
+
+    def is_fresh(self, entry):
+        if time.time() - entry['t'] >= self.ttl:
+            return False
+        for scope in entry['s']:
+            invalidated_at = self.marks.get(f'inval:{scope}')
+            if invalidated_at is not None and invalidated_at >= entry['t']:
+                return False
+        return True
+
+    def store(self, key, value, etag, scopes, started_at, fallback=False):
+        # Se usa el instante en que empezó la petición: si llega una
+        # invalidación mientras tanto, la respuesta ya nace caducada.
+        entry = {'v': value, 'e': etag, 't': started_at, 's': [ALL] + list(scopes)}
+        self.backend.set(f'entry:{key}', entry, self.ttl + self.stale_ttl)
+        if fallback:
+            self.backend.set(f'last:{key}', value, self.fallback_ttl)
+
+    def evict(self, key):
+        self.backend.delete(f'entry:{key}')
+        self.backend.delete(f'last:{key}')
+        self.count('evictions')
+
+    def fetch_and_store(self, key, fetch, scopes, previous=None, fallback=False):
+        started_at = time.time()
+        try:
+            value, etag = fetch(previous['e'] if previous else None)
+        except Gone:
+            self.evict(key)
+            raise
+        except NotModified:
+            if previous is None:
+                raise
+            value, etag = previous['v'], previous['e']
+            self.count('not_modified')
+        self.store(key, value, etag, scopes, started_at, fallback)
+        return value
+
+    def refresh(self, key, fetch, scopes, previous, fallback=False):
+        """Lanza (o reutiliza) el refresco en segundo plano de `key`"""
+        with self.lock:
+            future = self.refreshing.get(key)
+            if future is not None:
+                return future
+            self.counters['refreshes'] += 1
+            CACHE_EVENTS.inc(event='refreshes')
+            future = self.executor.submit(self.fetch_and_store, key, fetch, scopes, previous, fallback)
+            self.refreshing[key] = future
+        # Fuera del lock: si ya terminó, el callback se ejecuta en este mismo hilo
+        future.add_done_callback(lambda f: self.finish_refresh(key, f))
+        return future
+
+    def finish_refresh(self, key, future):
+        with self.lock:
+            self.refreshing.pop(key, None)
+        if future.exception() is not None:
+            self.count('refresh_errors')
+
+    def get_or_fetch(self, key, fetch, scopes=(), fallback=False):
+        """Devuelve el valor cacheado de `key` o lo obtiene con fetch(etag).
+
+        fetch(etag) debe devolver (valor serializable a JSON, etag), lanzar
+        NotModified si el etag recibido sigue vigente, Gone si el recurso ya
+        no existe, o lanzar otra excepción; los errores no se cachean. Si la
+        entrada existe pero no está fresca se revalida, y si el upstream no
+        contesta en revalidate_wait segundos (o falla) se sirve la entrada
+        anterior. Con fallback=True, si no hay entrada y fetch falla se sirve
+        la última respuesta buena, si se guardó alguna en los últimos
+        fallback_ttl segundos. Gone nunca se cubre así: borra la entrada y se
+        propaga.
+        """
+        entry = self.backend.get(f'entry:{key}')
+        if entry is None:
+            self.count('misses')
+            try:
+                return self.fetch_and_store(key, fetch, scopes, fallback=fallback)
+            except Gone:
+                raise
+            except Exception:
+                last = self.backend.get(f'last:{key}') if fallback else None
+                if last is None:
+                    raise
+            self.count('fallbacks')
+            return last
+        if self.is_fresh(entry):
+            self.count('hits')
+            return entry['v']
+
+        future = self.refresh(key, fetch, scopes, entry, fallback)
+        try:
+            value = future.result(timeout=self.revalidate_wait)
+            self.count('revalidated')
+            return value
+        except Gone:
+            raise
+        except Exception:
+            pass  # el upstream tarda (TimeoutError) o falla: se sirve la entrada anterior
+        self.count('stale_hits')
+        return entry['v']
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['misses'] + stats['revalidated'] + stats['stale_hits']
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 4) if lookups else None
+        stats['backend'] = type(self.backend).__name__
+        return stats
@@ -0,0 +1,129 @@
+"""HTML ya renderizado del catálogo.
+
+- FragmentCache: cada tarjeta de libro se renderiza una vez por versión del
+  libro (el store sube la versión con cualquier cambio, stock incluido) y
+  se reutiliza en todas las páginas donde aparece; los eventos de
+  book_events la descartan.
+- PageCache: páginas completas del catálogo para usuarios anónimos. Cada
+  una guarda la firma de los datos con que se renderizó (ids y versiones
+  de sus libros); cuando los datos cambian se vuelve a montar en la
+  siguiente petición, renderizando solo las tarjetas que cambiaron.
+
+El formulario de compra lleva una Idempotency-Key nueva en cada respuesta,
+así que el HTML cacheado lleva KEY_PLACEHOLDER en su lugar y fill_keys()
+pone una clave distinta en cada aparición al servir la página.
+"""
+import os
+import secrets
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+FRAGMENT_CACHE_MAX_BOOKS = int(os.getenv('FRAGMENT_CACHE_MAX_BOOKS', '10000'))
+CATALOG_PRERENDER_PAGES = int(os.getenv('CATALOG_PRERENDER_PAGES', '200'))
+
+KEY_PLACEHOLDER = '__idempotency_key__'
+
+
+def placeholder_key():
+    return KEY_PLACEHOLDER
+
+
+def fill_keys(html):
+    """Sustituye cada KEY_PLACEHOLDER por una clave de idempotencia nueva"""
+    parts = html.split(KEY_PLACEHOLDER)
+    if len(parts) == 1:
+        return html
+    pieces = [parts[0]]
+    for part in parts[1:]:
+        pieces.append(secrets.token_hex(16))  # mismo formato que uuid4().hex, más barato
+        pieces.append(part)
+    return ''.join(pieces)
+
+
+class FragmentCache:
+    """Tarjetas de libro renderizadas, por id, versión y variante (propio o no)"""
+
+    def __init__(self, template, max_books=FRAGMENT_CACHE_MAX_BOOKS):
+        self.template = template  # función sin argumentos que devuelve la plantilla de la tarjeta
+        self.max_books = max_books
+        self.entries = OrderedDict()  # id -> (versión, {propio: Markup})
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def card(self, book, own):
+        version = book.get('version')
+        with self.lock:
+            entry = self.entries.get(book['id'])
+            if entry is not None and entry[0] == version and own in entry[1]:
+                self.entries.move_to_end(book['id'])
+                self.counters['hits'] += 1
+                return entry[1][own]
+            self.counters['misses'] += 1
+        html = Markup(self.template().render(book=book, own=own, new_idempotency_key=placeholder_key))
+        if version is None:
+            return html  # sin versión no se puede saber cuándo cambia
+        with self.lock:
+            entry = self.entries.get(book['id'])
+            if entry is None or entry[0] != version:
+                entry = self.entries[book['id']] = (version, {})
+            entry[1][own] = html
+            self.entries.move_to_end(book['id'])
+            while len(self.entries) > self.max_books:
+                self.entries.popitem(last=False)
+        return html
+
+    def invalidate(self, book_id=None):
+        """Descarta las tarjetas de un libro, o todas"""
+        with self.lock:
+            if book_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(book_id, None)
+            self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, books=len(self.entries))
+
+
+def page_signature(books, next_page):
+    """Identifica los datos de una página; None si algún libro no trae versión"""
+    versions = tuple((book['id'], book.get('version')) for book in books)
+    if any(version is None for _, version in versions):
+        return None
+    return versions, next_page
+
+
+class PageCache:
+    """Páginas completas del catálogo (con KEY_PLACEHOLDER), por URL"""
+
+    def __init__(self, max_pages=CATALOG_PRERENDER_PAGES):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()  # clave -> (firma, html)
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'builds': 0}
+
+    def get(self, key, signature):
+        """HTML listo para enviar, o None si no está o se renderizó con otros datos"""
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None or page[0] != signature:
+                return None
+            self.pages.move_to_end(key)
+            self.counters['hits'] += 1
+            html = page[1]
+        return fill_keys(html)
+
+    def put(self, key, signature, html):
+        with self.lock:
+            self.pages[key] = (signature, html)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+            self.counters['builds'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pages=len(self.pages))
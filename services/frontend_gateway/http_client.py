@@ -0,0 +1,352 @@
+"""Cliente HTTP compartido para llamar a los microservicios.
+
+Cada upstream (auth, catalog, store) tiene su propia requests.Session con un
+pool de conexiones keep-alive, timeouts de conexión/lectura y reintentos con
+backoff exponencial, en lugar de abrir una conexión TCP nueva por llamada.
+
+Cada petición entrante tiene además un presupuesto de tiempo (deadline): las
+llamadas a upstreams nunca esperan más de lo que le queda, y fan_out() lanza
+en paralelo las llamadas independientes para que una página cueste
+max(latencias) y no la suma.
+
+Para que un upstream lento o caído no arrastre al resto del gateway, cada
+cliente tiene:
+
+- un bulkhead: como mucho `<UPSTREAM>_MAX_CONCURRENCY` llamadas a la vez; si
+  está lleno, la llamada espera `UPSTREAM_BULKHEAD_WAIT` y falla con
+  BulkheadFull en lugar de ocupar otro hilo del gateway. Por defecto es el
+  número de peticiones que el worker atiende a la vez (admission control,
+  tres cuartos de GUNICORN_THREADS), así que la carga admitida nunca lo
+  llena con una llamada por petición: solo limita lo que fan_out() añade
+  encima, y de un upstream colgado protegen el deadline y el breaker;
+- un circuit breaker: tras `<UPSTREAM>_BREAKER_FAILURES` fallos seguidos
+  (error de conexión, timeout o 5xx) se abre y las llamadas fallan al
+  instante con CircuitOpen durante `<UPSTREAM>_BREAKER_RESET` segundos;
+  después deja pasar una llamada de prueba (half-open) que lo cierra si
+  acierta o lo vuelve a abrir si falla.
+
+Un 429, o un 503 con Retry-After, es un upstream sano que descarta carga
+(rate limiting, admission control, pool de hashing lleno): no cuenta como
+fallo del breaker ni se reintenta, porque reenviarlo solo añade carga
+justo cuando el upstream pide menos. Tampoco cuenta un timeout que solo
+se debe al deadline de la petición del gateway (el timeout se recortó a lo
+que quedaba del presupuesto): se lanza DeadlineExceeded y el breaker no
+se entera.
+
+Las dos excepciones derivan de requests.exceptions.ConnectionError, así que
+las rutas las tratan como cualquier upstream caído y la caché sirve la
+última respuesta buena.
+"""
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from flask import has_request_context
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common import metrics, ratelimit, tracing
+
+# Valores por defecto, sobreescribibles por variable de entorno
+CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '2'))
+READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '5'))
+RETRIES = int(os.getenv('UPSTREAM_RETRIES', '2'))
+BACKOFF = float(os.getenv('UPSTREAM_BACKOFF', '0.1'))
+POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '20'))
+# Presupuesto total de una petición del gateway y hilos para llamadas en paralelo
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '8'))
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', '32'))
+# Bulkhead y circuit breaker por upstream
+MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', str(ratelimit.ADMISSION_MAX_CONCURRENT)))
+BULKHEAD_WAIT = float(os.getenv('UPSTREAM_BULKHEAD_WAIT', '0.1'))
+BREAKER_FAILURES = int(os.getenv('UPSTREAM_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.getenv('UPSTREAM_BREAKER_RESET', '10'))
+
+# Latencia de cada llamada vista por el gateway, reintentos incluidos
+UPSTREAM_SECONDS = metrics.Histogram('upstream_request_duration_seconds',
+                                     'Duración de las llamadas del gateway a cada microservicio',
+                                     ('upstream', 'method', 'status'))
+CIRCUIT_STATE = metrics.Gauge('upstream_circuit_state',
+                              'Estado del circuit breaker de cada upstream (0 cerrado, 1 half-open, 2 abierto)',
+                              ('upstream',))
+UPSTREAM_REJECTED = metrics.Counter('upstream_rejected_total',
+                                    'Llamadas a upstreams rechazadas sin enviarse, por motivo',
+                                    ('upstream', 'reason'))
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+_fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Se agotó el presupuesto de tiempo de la petición"""
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """El circuit breaker del upstream está abierto: no se intenta la llamada"""
+
+
+class BulkheadFull(requests.exceptions.ConnectionError):
+    """El upstream ya tiene el máximo de llamadas en curso"""
+
+
+class CircuitBreaker:
+    """Circuit breaker de un upstream, seguro entre hilos.
+
+    closed -> open tras `failure_threshold` fallos seguidos; open -> half_open
+    pasados `reset_timeout` segundos, con una sola llamada de prueba a la vez;
+    half_open -> closed si la prueba acierta, u open de nuevo si falla.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0  # fallos seguidos
+        self.opened_at = None
+        self.probing = False
+        self.times_opened = 0
+        CIRCUIT_STATE.set(0, upstream=name)
+
+    def set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(self.STATE_VALUES[state], upstream=self.name)
+
+    def before_call(self):
+        """Lanza CircuitOpen si la llamada no debe intentarse"""
+        with self.lock:
+            if self.state == self.OPEN:
+                retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    raise CircuitOpen(f'{self.name}: circuito abierto, se reintentará en {retry_in:.1f}s')
+                self.set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    raise CircuitOpen(f'{self.name}: circuito half-open, llamada de prueba en curso')
+                self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+                self.set_state(self.CLOSED)
+
+    def record_neutral(self):
+        """Respuesta que no dice nada de la salud del upstream (p.ej. carga descartada)"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False  # la siguiente llamada vuelve a probar
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # Ya abierto, un fallo de una llamada que empezó antes no alarga el plazo
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED
+                                                 and self.failures >= self.failure_threshold):
+                self.probing = False
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                self.set_state(self.OPEN)
+
+    def stats(self):
+        with self.lock:
+            stats = {'state': self.state, 'consecutive_failures': self.failures,
+                     'failure_threshold': self.failure_threshold, 'reset_timeout': self.reset_timeout,
+                     'times_opened': self.times_opened}
+            if self.state == self.OPEN:
+                stats['retry_in'] = round(max(0, self.opened_at + self.reset_timeout - time.monotonic()), 3)
+        return stats
+
+
+def is_shed(response):
+    """True si el upstream rechazó la llamada por carga (429, o 503 con Retry-After)"""
+    return response.status_code == 429 or (response.status_code == 503 and 'Retry-After' in response.headers)
+
+
+def start_deadline(budget=REQUEST_DEADLINE):
+    """Fija el deadline de la petición actual (llamar al inicio de cada request)"""
+    _deadline.set(time.monotonic() + budget)
+
+
+def remaining_budget():
+    """Segundos que le quedan a la petición actual, o None si no tiene deadline"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def fan_out(calls):
+    """Ejecuta en paralelo llamadas independientes dentro del deadline actual.
+
+    `calls` es un dict nombre -> función sin argumentos. Devuelve un dict
+    nombre -> resultado; si una llamada falla o no termina a tiempo, su
+    valor es la excepción (DeadlineExceeded si se agotó el presupuesto), de
+    modo que cada página decide qué hacer con el upstream que falló.
+    """
+    futures = {
+        name: _fanout_executor.submit(contextvars.copy_context().run, fn)
+        for name, fn in calls.items()
+    }
+    remaining = remaining_budget()
+    wait(futures.values(), timeout=max(0, remaining) if remaining is not None else None)
+    results = {}
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            results[name] = DeadlineExceeded(f'{name}: deadline exceeded')
+        elif future.exception() is not None:
+            results[name] = future.exception()
+        else:
+            results[name] = future.result()
+    return results
+
+
+class UpstreamClient:
+    """Sesión HTTP con pool de conexiones hacia un único microservicio"""
+
+    def __init__(self, name, base_url, pool_size=None, connect_timeout=None, read_timeout=None,
+                 retries=None, backoff=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        # Variables por upstream, p.ej. STORE_POOL_SIZE o CATALOG_READ_TIMEOUT
+        prefix = name.upper()
+        self.pool_size = pool_size or int(os.getenv(f'{prefix}_POOL_SIZE', POOL_SIZE))
+        self.timeout = (
+            connect_timeout or float(os.getenv(f'{prefix}_CONNECT_TIMEOUT', CONNECT_TIMEOUT)),
+            read_timeout or float(os.getenv(f'{prefix}_READ_TIMEOUT', READ_TIMEOUT)),
+        )
+        retries = retries if retries is not None else int(os.getenv(f'{prefix}_RETRIES', RETRIES))
+        backoff = backoff if backoff is not None else BACKOFF
+        self.max_concurrency = int(os.getenv(f'{prefix}_MAX_CONCURRENCY', MAX_CONCURRENCY))
+        self.bulkhead = threading.BoundedSemaphore(self.max_concurrency)
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=int(os.getenv(f'{prefix}_BREAKER_FAILURES', BREAKER_FAILURES)),
+            reset_timeout=float(os.getenv(f'{prefix}_BREAKER_RESET', BREAKER_RESET)))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = {'circuit_open': 0, 'bulkhead_full': 0}
+
+        # Los errores de conexión se reintentan siempre (la petición no llegó a
+        # salir); los 502/504 y errores de lectura solo en métodos idempotentes.
+        # Los 503 no: el upstream está descartando carga (ver is_shed()), y
+        # esperar su Retry-After se saltaría el deadline de la petición.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 504),
+            respect_retry_after_header=False,
+            allowed_methods=frozenset({'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, **kwargs):
+        connect_timeout, read_timeout = timeout = kwargs.pop('timeout', self.timeout)
+        remaining = remaining_budget()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(f'{self.name}: deadline exceeded before {method} {path}')
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+        # Un timeout recortado por el deadline es del gateway, no del upstream
+        clamped = (connect_timeout, read_timeout) != tuple(timeout)
+        wait_for = BULKHEAD_WAIT if remaining is None else max(0, min(BULKHEAD_WAIT, remaining))
+        if not self.bulkhead.acquire(timeout=wait_for):
+            self.reject('bulkhead_full')
+            raise BulkheadFull(f'{self.name}: {self.max_concurrency} llamadas en curso')
+        try:
+            try:
+                self.breaker.before_call()
+            except CircuitOpen:
+                self.reject('circuit_open')
+                raise
+            with self.lock:
+                self.in_flight += 1
+            try:
+                response = self.send(method, path, (connect_timeout, read_timeout), kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                # Agotados los reintentos, un timeout de lectura llega como ConnectionError
+                if not clamped or remaining_budget() > 0:
+                    self.breaker.record_failure()
+                    raise
+                self.breaker.record_neutral()
+                raise DeadlineExceeded(f'{self.name}: deadline exceeded during {method} {path}') from e
+            except requests.exceptions.RequestException:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                self.breaker.record_neutral()  # no llegó a saberse nada del upstream
+                raise
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+            if is_shed(response):
+                self.breaker.record_neutral()
+            elif response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+        finally:
+            self.bulkhead.release()
+
+    def send(self, method, path, timeout, kwargs):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            # Span de cliente; el upstream continúa la traza con la cabecera traceparent
+            with tracing.span(f'{method} {self.name}', 'client', attributes={
+                    'peer.service': self.name, 'http.method': method, 'http.url': f'{self.base_url}{path}'}) as span:
+                kwargs['headers'] = tracing.inject(dict(kwargs.get('headers') or {}))
+                if has_request_context():
+                    # Los límites por IP de los servicios ven al cliente, no al gateway
+                    kwargs['headers'].setdefault('X-Forwarded-For', ratelimit.client_ip())
+                response = self.session.request(method, f'{self.base_url}{path}',
+                                                timeout=timeout, **kwargs)
+                status = response.status_code
+                span.set_attribute('http.status_code', status)
+            return response
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started,
+                                     upstream=self.name, method=method, status=status)
+
+    def reject(self, reason):
+        with self.lock:
+            self.rejected[reason] += 1
+        UPSTREAM_REJECTED.inc(upstream=self.name, reason=reason)
+
+    def stats(self):
+        """Estado del circuit breaker y del bulkhead de este upstream"""
+        with self.lock:
+            stats = {'in_flight': self.in_flight, 'max_concurrency': self.max_concurrency,
+                     'rejected': dict(self.rejected)}
+        stats['circuit'] = self.breaker.stats()
+        return stats
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,547 @@
+from flask import Flask, request, jsonify, abort, g
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text, func, delete, event
+from sqlalchemy.exc import IntegrityError, InterfaceError, OperationalError
+import os
+import pika
+import json
+import threading
+import time
+import requests
+from datetime import datetime, timezone
+from common import tokens, serving, metrics, tracing
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'mysql+pymysql://bookstore_user:bookstore_pass@db/bookstore')
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+db = SQLAlchemy(app)
+
+# GET /metrics: request and query latencies, plus the task relay below
+metrics.init_app(app)
+metrics.instrument_sqlalchemy()
+ORDER_TASKS_PUBLISHED = metrics.Counter('order_tasks_published_total', 'Order steps handed to the workers', ('step',))
+ORDER_TASKS_DEAD = metrics.Counter('order_tasks_dead_total', 'Order steps given up and parked in the dead-letter queue',
+                                   ('reason',))
+# Traces: a server span per request and a span per query (see common/tracing.py)
+tracing.init_app(app, 'orders')
+tracing.instrument_sqlalchemy()
+
+# Orders belong to the user of the access token (see common/tokens.py)
+AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://auth_service:5001')
+STORE_SERVICE_URL = os.getenv('STORE_SERVICE_URL', 'http://store_service:5003')
+tokens.init_app(app, tokens.TokenVerifier(
+    revocations=tokens.RevocationList(tokens.http_revocation_loader(AUTH_SERVICE_URL))))
+
+# Checkout requests only record the order and queue its next step: payment
+# and delivery run in the workers of worker.py. Steps are written to the
+# order_task table in the same transaction as the order change (an outbox)
+# and a relay moves them to the durable ORDER_TASK_QUEUE, where every
+# worker process competes for them.
+rabbitmq_url = os.getenv('RABBITMQ_URL', 'amqp://rabbitmq')
+ORDER_TASK_QUEUE = 'order_tasks'
+TASK_BATCH_SIZE = 100
+TASK_POLL_INTERVAL = float(os.getenv('ORDER_TASK_POLL_INTERVAL', '1.0'))
+relay_wakeup = threading.Event()
+
+# Workers: processes per worker.py, unacked tasks per process, how long a
+# task that failed for a transient reason waits before going back to the
+# queue, and how many times it runs before it is given up
+ORDER_WORKER_PROCESSES = int(os.getenv('ORDER_WORKER_PROCESSES', '2'))
+ORDER_WORKER_PREFETCH = int(os.getenv('ORDER_WORKER_PREFETCH', '2'))
+ORDER_RETRY_DELAY = float(os.getenv('ORDER_RETRY_DELAY', '1.0'))
+ORDER_TASK_MAX_ATTEMPTS = int(os.getenv('ORDER_TASK_MAX_ATTEMPTS', '20'))
+# Tasks given up, with the error in their x-error header, for someone to look at
+ORDER_DEAD_QUEUE = 'order_tasks.dead'
+# Stand-in for the round trip to a payment provider
+PAYMENT_LATENCY = int(os.getenv('PAYMENT_LATENCY_MS', '100')) / 1000.0
+
+# Order state machine: the statuses an order can move to from each status
+TRANSITIONS = {
+    'pending': ('paid', 'failed'),
+    'paid': ('shipped',),
+    'shipped': (),
+    'failed': (),
+}
+
+def utcnow():
+    # Naive UTC, as stored in the DATETIME columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class PurchaseOrder(db.Model):
+    __tablename__ = 'purchase_order'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    # Chosen by the client for every checkout; a retried POST /orders with
+    # the same key returns the order it already created
+    idempotency_key = db.Column(db.String(100), nullable=True)
+    book_id = db.Column(db.Integer, nullable=False)
+    book_title = db.Column(db.String(200))
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    payment_method = db.Column(db.String(50))
+    provider_id = db.Column(db.String(20))
+    provider_name = db.Column(db.String(100))
+    failure_reason = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: utcnow())
+    paid_at = db.Column(db.DateTime)
+    shipped_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=lambda: utcnow(), onupdate=lambda: utcnow())
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'idempotency_key', name='uq_purchase_order_user_key'),
+        # The user's orders, newest first
+        db.Index('ix_purchase_order_user_id_id', 'user_id', 'id'),
+    )
+
+    def advance(self, status, **values):
+        """Move to `status`, which must be reachable from the current one"""
+        if status not in TRANSITIONS[self.status]:
+            raise ValueError(f'order {self.id} cannot go from {self.status} to {status}')
+        self.status = status
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def to_dict(self):
+        def iso(value):
+            return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'book_id': self.book_id,
+            'book_title': self.book_title,
+            'quantity': self.quantity,
+            'unit_price': self.unit_price,
+            'total_price': self.total_price,
+            'status': self.status,
+            'payment_method': self.payment_method,
+            'provider_id': self.provider_id,
+            'provider_name': self.provider_name,
+            'failure_reason': self.failure_reason,
+            'created_at': iso(self.created_at),
+            'paid_at': iso(self.paid_at),
+            'shipped_at': iso(self.shipped_at),
+        }
+
+class OrderTask(db.Model):
+    """A step of an order waiting to be published to ORDER_TASK_QUEUE"""
+    __tablename__ = 'order_task'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    order_id = db.Column(db.BigInteger, nullable=False)
+    step = db.Column(db.String(20), nullable=False)  # 'pay', 'ship' or 'release'
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: utcnow())
+
+def enqueue_step(order_id, step):
+    """Queue a step of an order as part of the current transaction"""
+    db.session.add(OrderTask(order_id=order_id, step=step))
+    db.session.info['tasks_pending'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def wake_relay(session):
+    if session.info.pop('tasks_pending', False):
+        relay_wakeup.set()
+
+def publish_pending_tasks(channel):
+    """Publish the oldest queued steps, one message each so any worker can
+    take any of them, and delete them once the broker has confirmed them.
+    Returns the number of steps published."""
+    with app.app_context():
+        try:
+            pending = (OrderTask.query.order_by(OrderTask.id)
+                       .with_for_update(skip_locked=True)
+                       .limit(TASK_BATCH_SIZE).all())
+            for task in pending:
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=ORDER_TASK_QUEUE,
+                    body=json.dumps({'order_id': task.order_id, 'step': task.step}),
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        message_id=f'order-task-{task.id}',
+                    ))
+                ORDER_TASKS_PUBLISHED.inc(step=task.step)
+            if pending:
+                db.session.execute(delete(OrderTask).where(OrderTask.id.in_([t.id for t in pending])))
+            db.session.commit()
+            return len(pending)
+        except Exception:
+            # Unconfirmed steps stay queued and are published again; the
+            # workers skip a step the order has already gone past
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def run_task_relay():
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
+            channel = connection.channel()
+            channel.queue_declare(queue=ORDER_TASK_QUEUE, durable=True)
+            channel.confirm_delivery()
+            app.logger.info("Order task relay connected to RabbitMQ")
+            while True:
+                relay_wakeup.clear()
+                if publish_pending_tasks(channel) < TASK_BATCH_SIZE:
+                    relay_wakeup.wait(TASK_POLL_INTERVAL)
+                connection.process_data_events(time_limit=0)
+        except Exception as e:
+            app.logger.error(f"Order task relay error: {e}, retrying...")
+            time.sleep(2)
+
+# ==================== WORKERS ====================
+
+class RetryLater(Exception):
+    """A step failed for a reason that may go away (e.g. the store is down)"""
+
+def load_order(order_id, lock=False):
+    # The row lock serializes a worker and a checkout request changing the same order
+    return db.session.get(PurchaseOrder, order_id, with_for_update=lock)
+
+def charge(order):
+    """Charge the order with its payment method.
+
+    Simulated: it only waits PAYMENT_LATENCY. A real provider would get
+    f'order-{order.id}' as idempotency key, so a redelivered task cannot
+    charge twice; a declined charge would fail the order, which releases
+    the reserved stock (see fail_order).
+    """
+    time.sleep(PAYMENT_LATENCY)
+
+def service_headers(idempotency_key):
+    # Workers act on their own behalf, not with the token of the buyer
+    token, _, _ = tokens.issue_access_token({'sub': 'order_service', 'name': 'order worker'})
+    return {'Authorization': f'Bearer {token}', 'Idempotency-Key': idempotency_key}
+
+def reserve_stock(order):
+    """Take the order's units from the store; returns None or the failure reason"""
+    try:
+        response = requests.post(f'{STORE_SERVICE_URL}/books/{order.book_id}/reserve',
+                                 json={'quantity': order.quantity},
+                                 headers=service_headers(f'order-{order.id}'), timeout=10)
+    except requests.exceptions.RequestException as e:
+        raise RetryLater(f'store unreachable: {e}')
+    if response.status_code == 200:
+        return None
+    if response.status_code == 409:
+        return 'out_of_stock'
+    if response.status_code == 404:
+        return 'book_not_found'
+    if response.status_code >= 500 or response.status_code in (408, 429):
+        raise RetryLater(f'store answered {response.status_code}')
+    # Any other answer (bad quantity, rejected credentials...) would be the same on every retry
+    return f'store_rejected_{response.status_code}'
+
+def release_stock(order):
+    """Give back the units reserve_stock() took for the order, with the same key.
+
+    The store only returns them once, and a reservation still in flight
+    when this runs cannot take them afterwards.
+    """
+    try:
+        response = requests.post(f'{STORE_SERVICE_URL}/books/{order.book_id}/release',
+                                 json={'quantity': order.quantity},
+                                 headers=service_headers(f'order-{order.id}'), timeout=10)
+    except requests.exceptions.RequestException as e:
+        raise RetryLater(f'store unreachable: {e}')
+    if response.status_code == 200:
+        return
+    if response.status_code >= 500 or response.status_code in (408, 409, 429):
+        raise RetryLater(f'store answered {response.status_code}')
+    raise RuntimeError(f'store refused to release the stock of order {order.id}: {response.status_code}')
+
+def pay(order_id):
+    """Reserve the stock, then charge: an order that cannot be served is never charged"""
+    order = load_order(order_id)
+    if order is None or order.status != 'pending':
+        return  # already past this step: a redelivered task
+    # The store keys the reservation by order, so a retry never takes stock twice
+    failure = reserve_stock(order)
+    if failure is None:
+        charge(order)
+    db.session.rollback()  # end the read snapshot before taking the lock
+    order = load_order(order_id, lock=True)
+    if order.status == 'pending':
+        if failure is None:
+            order.advance('paid', paid_at=utcnow())
+            if order.provider_id is not None:
+                enqueue_step(order.id, 'ship')
+        else:
+            order.advance('failed', failure_reason=failure)
+    db.session.commit()
+
+def ship(order_id):
+    order = load_order(order_id, lock=True)
+    if order is not None and order.status == 'paid':
+        order.advance('shipped', shipped_at=utcnow())
+    # else shipped already, or not paid yet (pay() queues it then)
+    db.session.commit()
+
+def release(order_id):
+    """Compensate an order given up after its stock may have been reserved (queued by fail_order)"""
+    order = load_order(order_id)
+    if order is not None and order.status == 'failed':
+        release_stock(order)
+
+STEPS = {'pay': pay, 'ship': ship, 'release': release}
+
+def process_task(body):
+    """Run one step; raises RetryLater when it should be tried again.
+
+    Only an unreachable store or database is worth a retry: any other error
+    (a malformed task, a bug) would fail the same way again and propagates.
+    """
+    task = json.loads(body)
+    step, order_id = STEPS[task['step']], int(task['order_id'])
+    with app.app_context():
+        try:
+            step(order_id)
+        except (OperationalError, InterfaceError) as e:
+            db.session.rollback()
+            raise RetryLater(f'database unavailable: {e}')  # also deadlocks and lock wait timeouts
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def fail_order(order_id, reason):
+    """Fail an order whose step was given up, unless it is already past failing.
+
+    Its pay step may have reserved the stock before failing (a charge that
+    raised, a reservation whose answer never arrived), so a release step is
+    queued with the change, and retried like any other step.
+    """
+    with app.app_context():
+        try:
+            order = load_order(order_id, lock=True)
+            if order is not None and 'failed' in TRANSITIONS[order.status]:
+                order.advance('failed', failure_reason=reason)
+                enqueue_step(order.id, 'release')
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+def give_up(channel, body, reason, error):
+    """Fail the order of a task that will not succeed and park the task in ORDER_DEAD_QUEUE"""
+    app.logger.error(f"Giving up on order task {body!r} ({reason}): {error}")
+    ORDER_TASKS_DEAD.inc(reason=reason)
+    try:
+        fail_order(int(json.loads(body)['order_id']), reason)
+    except Exception as e:
+        app.logger.error(f"Could not fail the order of task {body!r}: {e}")
+    channel.basic_publish(exchange='', routing_key=ORDER_DEAD_QUEUE, body=body,
+                          properties=pika.BasicProperties(delivery_mode=2, headers={'x-error': str(error)[:500]}))
+
+def handle_task(channel, delivery_tag, properties, body):
+    """Run a task from ORDER_TASK_QUEUE and ack it once it is done, retried or given up.
+
+    A transient failure goes back to the end of the queue after
+    ORDER_RETRY_DELAY, with its attempt count in the x-attempt header, up
+    to ORDER_TASK_MAX_ATTEMPTS runs; any other failure is given up at once.
+    """
+    attempt = int(((properties.headers if properties else None) or {}).get('x-attempt', 1))
+    try:
+        process_task(body)
+    except RetryLater as e:
+        if attempt < ORDER_TASK_MAX_ATTEMPTS:
+            app.logger.warning(f"Order task {body!r} failed ({e}), retry {attempt} of "
+                               f"{ORDER_TASK_MAX_ATTEMPTS - 1} in {ORDER_RETRY_DELAY}s")
+            time.sleep(ORDER_RETRY_DELAY)
+            channel.basic_publish(exchange='', routing_key=ORDER_TASK_QUEUE, body=body,
+                                  properties=pika.BasicProperties(
+                                      delivery_mode=2,
+                                      message_id=properties.message_id if properties else None,
+                                      headers={'x-attempt': attempt + 1}))
+        else:
+            give_up(channel, body, 'retries_exhausted', e)
+    except Exception as e:
+        give_up(channel, body, 'task_failed', e)
+    channel.basic_ack(delivery_tag=delivery_tag)
+
+def run_worker():
+    """Consume ORDER_TASK_QUEUE forever, acking every step once it is committed"""
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
+            channel = connection.channel()
+            channel.queue_declare(queue=ORDER_TASK_QUEUE, durable=True)
+            channel.queue_declare(queue=ORDER_DEAD_QUEUE, durable=True)
+            channel.basic_qos(prefetch_count=ORDER_WORKER_PREFETCH)
+
+            def on_task(ch, method, properties, body):
+                handle_task(ch, method.delivery_tag, properties, body)
+
+            channel.basic_consume(queue=ORDER_TASK_QUEUE, on_message_callback=on_task, auto_ack=False)
+            app.logger.info("Order worker consuming order_tasks")
+            channel.start_consuming()
+        except Exception as e:
+            app.logger.error(f"Order worker lost RabbitMQ ({e}), retrying...")
+            time.sleep(5)
+
+# ==================== API ====================
+
+def parse_positive_int(value, name):
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        abort(400, f'{name} must be a positive integer')
+    return value
+
+def current_user_id():
+    return int(g.token_claims['sub'])
+
+def get_own_order(order_id, lock=False):
+    order = load_order(order_id, lock)
+    if order is None or order.user_id != current_user_id():
+        abort(404)
+    return order
+
+@app.route('/')
+def index():
+    return jsonify({"service": "orders", "status": "ok"})
+
+def book_for_sale(book_id):
+    """Title and unit price of a book, from the store: the buyer does not get to set them"""
+    try:
+        response = requests.get(f'{STORE_SERVICE_URL}/books/{book_id}', timeout=(2, 5))
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Store unreachable while creating an order: {e}")
+        abort(503, 'store unavailable, retry shortly')
+    if response.status_code == 404:
+        abort(400, 'book_id does not exist')
+    if response.status_code != 200:
+        abort(503, f'store answered {response.status_code}, retry shortly')
+    book = response.json()
+    if book.get('price') is None:
+        abort(409, 'book has no price')
+    return book.get('title'), book['price']
+
+def replay_order(existing, book_id, quantity):
+    """Answer a retry with the order it created; a key reused for another
+    book or quantity is a client bug, not a retry, and gets 422 (as in the store)"""
+    if (existing.book_id, existing.quantity) != (book_id, quantity):
+        return jsonify({'error': 'idempotency_key_reused', 'order_id': existing.id,
+                        'description': 'the Idempotency-Key was used for a different order'}), 422
+    return jsonify(existing.to_dict())
+
+@app.route('/orders', methods=['POST'])
+@tokens.token_required
+def create_order():
+    """Create a pending order: {"book_id", "quantity"}.
+
+    Title and unit price are the store's current ones. Send an
+    Idempotency-Key header: a retry with the same key answers 200 with the
+    order created by the first request instead of a new one, or 422 if that
+    order was for another book or quantity.
+    """
+    data = request.get_json() or {}
+    book_id = parse_positive_int(data.get('book_id'), 'book_id')
+    quantity = parse_positive_int(data.get('quantity', 1), 'quantity')
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 100:
+        abort(400, 'Idempotency-Key must have 1 to 100 characters')
+    user_id = current_user_id()
+
+    if key is not None:
+        existing = PurchaseOrder.query.filter_by(user_id=user_id, idempotency_key=key).first()
+        if existing is not None:
+            return replay_order(existing, book_id, quantity)
+    title, unit_price = book_for_sale(book_id)
+    order = PurchaseOrder(user_id=user_id, idempotency_key=key, book_id=book_id,
+                          book_title=title, quantity=quantity,
+                          unit_price=unit_price, total_price=round(unit_price * quantity, 2))
+    db.session.add(order)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent retry with the same key created it first
+        db.session.rollback()
+        existing = PurchaseOrder.query.filter_by(user_id=user_id, idempotency_key=key).first_or_404()
+        return replay_order(existing, book_id, quantity)
+    return jsonify(order.to_dict()), 201
+
+@app.route('/orders', methods=['GET'])
+@tokens.token_required
+def list_orders():
+    """The caller's orders, newest first (?limit=, at most 100)"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    orders = (PurchaseOrder.query.filter_by(user_id=current_user_id())
+              .order_by(PurchaseOrder.id.desc()).limit(limit).all())
+    return jsonify([o.to_dict() for o in orders])
+
+@app.route('/orders/<int:order_id>', methods=['GET'])
+@tokens.token_required
+def get_order(order_id):
+    return jsonify(get_own_order(order_id).to_dict())
+
+@app.route('/orders/<int:order_id>/payment', methods=['POST'])
+@tokens.token_required
+def pay_order(order_id):
+    """Queue the payment of a pending order with {"method"}; answers 202 at once.
+
+    Repeating it is harmless: the payment is only queued the first time.
+    """
+    data = request.get_json() or {}
+    method = data.get('method')
+    if not method or not isinstance(method, str):
+        abort(400, 'method is required')
+    order = get_own_order(order_id, lock=True)
+    if order.payment_method is None:
+        if order.status != 'pending':
+            abort(409, f'order is {order.status}')
+        order.payment_method = method[:50]
+        enqueue_step(order.id, 'pay')
+    db.session.commit()
+    return jsonify(order.to_dict()), 202
+
+@app.route('/orders/<int:order_id>/delivery', methods=['POST'])
+@tokens.token_required
+def choose_delivery(order_id):
+    """Set the delivery provider with {"provider_id", "provider_name"}; answers 202 at once.
+
+    The order ships once it is paid, whichever of the two happens last.
+    """
+    data = request.get_json() or {}
+    provider_id = data.get('provider_id')
+    if provider_id is None:
+        abort(400, 'provider_id is required')
+    order = get_own_order(order_id, lock=True)
+    if order.provider_id is None:
+        if order.status not in ('pending', 'paid'):
+            abort(409, f'order is {order.status}')
+        order.provider_id = str(provider_id)[:20]
+        order.provider_name = (data.get('provider_name') or '')[:100] or None
+        if order.status == 'paid':
+            enqueue_step(order.id, 'ship')
+    db.session.commit()
+    return jsonify(order.to_dict()), 202
+
+@app.route('/orders/stats')
+def order_stats():
+    """Orders per status and steps not yet handed to the workers"""
+    counts = dict(db.session.query(PurchaseOrder.status, func.count(PurchaseOrder.id))
+                  .group_by(PurchaseOrder.status).all())
+    return jsonify({
+        'orders': {status: counts.get(status, 0) for status in TRANSITIONS},
+        'queued_steps': db.session.query(func.count(OrderTask.id)).scalar(),
+    })
+
+serving.add_health_routes(app, {'database': lambda: db.session.execute(text('SELECT 1'))})
+
+def create_schema():
+    db.create_all()
+
+def start_background_tasks():
+    """Start the task relay; with several server workers only one runs it"""
+    serving.run_exclusively('order-task-relay', run_task_relay)
+
+if __name__ == '__main__':
+    # Development server; production runs gunicorn with gunicorn.conf.py.
+    # The steps run in worker.py.
+    with app.app_context():
+        create_schema()
+    start_background_tasks()
+    app.run(host='0.0.0.0', port=5004, debug=True)
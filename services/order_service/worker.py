@@ -0,0 +1,33 @@
+"""Order workers: python worker.py
+
+Runs ORDER_WORKER_PROCESSES processes that take order steps (payment,
+delivery) from the order_tasks queue; a process that dies is replaced.
+Throughput grows with the processes of each container and with the
+number of containers (docker compose up --scale order_worker=N), since
+they all compete for the same queue.
+"""
+import logging
+import multiprocessing
+import time
+
+from app import app, run_worker, ORDER_WORKER_PROCESSES
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(processName)s: %(message)s')
+    app.logger.setLevel(logging.INFO)
+    processes = {}
+    while True:
+        for n in range(ORDER_WORKER_PROCESSES):
+            process = processes.get(n)
+            if process is None or not process.is_alive():
+                if process is not None:
+                    app.logger.error(f"Order worker {n} exited with {process.exitcode}, restarting")
+                process = processes[n] = multiprocessing.Process(target=run_worker, name=f'order-worker-{n}',
+                                                                 daemon=True)
+                process.start()
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,63 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, g, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text, func, update, select, delete, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import os
 import pika
 import json
-from threading import Lock
+import threading
 import time
+import csv
+import io
+from datetime import datetime, timezone
+from common import tokens, serving, metrics, tracing, migrations, events, streaming, conditional
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'mysql+pymysql://bookstore_user:bookstore_pass@db/bookstore')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# RabbitMQ setup with reconnection
+# RabbitMQ setup. Events are not published from request handlers: they are
+# written to the outbox table in the same transaction as the book change and
+# a background relay publishes them in batches with publisher confirms.
 rabbitmq_url = os.getenv('RABBITMQ_URL', 'amqp://rabbitmq')
-rabbitmq_lock = Lock()
-rabbitmq_channel = None
-
-def get_rabbitmq_channel():
-    global rabbitmq_channel
-    with rabbitmq_lock:
-        if rabbitmq_channel is None or rabbitmq_channel.is_closed:
-            retries = 5
-            while retries > 0:
-                try:
-                    connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
-                    rabbitmq_channel = connection.channel()
-                    rabbitmq_channel.exchange_declare(exchange='book_events', 
-                                                   exchange_type='fanout', 
-                                                   durable=True)
-                    break
-                except pika.exceptions.AMQPConnectionError:
-                    retries -= 1
-                    if retries == 0:
-                        raise
-                    time.sleep(2)
-        return rabbitmq_channel
-
-def publish_event(event_type, book_data):
-    try:
-        channel = get_rabbitmq_channel()
-        message = {
-            'type': event_type,
-            'book': book_data
-        }
-        channel.basic_publish(
-            exchange='book_events',
-            routing_key='',
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            ))
-    except Exception as e:
-        app.logger.error(f"Failed to publish event: {e}")
-        # Continue anyway - eventual consistency
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))
+relay_wakeup = threading.Event()
 
 db = SQLAlchemy(app)
 
+# GET /metrics: request and query latencies, plus the outbox relay below
+metrics.init_app(app)
+metrics.instrument_sqlalchemy()
+PUBLISH_SECONDS = metrics.Histogram('rabbitmq_publish_duration_seconds',
+                                    'Time to publish one outbox message until the broker confirms it')
+OUTBOX_EVENTS = metrics.Counter('outbox_events_published_total', 'Book events published by the outbox relay')
+OUTBOX_LAG_SECONDS = metrics.Histogram('outbox_lag_seconds',
+                                       'Time from the oldest event of a message being committed to its publication',
+                                       buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+
+# Traces: a server span per request and a span per query (see common/tracing.py);
+# the outbox carries the trace of each change on to the catalog
+tracing.init_app(app, 'store')
+tracing.instrument_sqlalchemy()
+
+# Callers are identified by the access token issued by auth_service, verified
+# locally. With STORE_AUTH_REQUIRED=1 every write needs one.
+AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://auth_service:5001')
+STORE_AUTH_REQUIRED = os.getenv('STORE_AUTH_REQUIRED', '0') == '1'
+tokens.init_app(app, tokens.TokenVerifier(
+    revocations=tokens.RevocationList(tokens.http_revocation_loader(AUTH_SERVICE_URL))))
+
+@app.before_request
+def require_token_for_writes():
+    if STORE_AUTH_REQUIRED and request.method not in ('GET', 'HEAD', 'OPTIONS') and g.token_claims is None:
+        abort(401, 'token required')
+
+def utcnow():
+    # Naive UTC, as stored in the DATETIME column
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -62,7 +65,15 @@ class Book(db.Model):
     description = db.Column(db.Text, nullable=True)
     price = db.Column(db.Float, default=0.0)
     stock = db.Column(db.Integer, default=0)
-    user_id = db.Column(db.Integer, nullable=False)
+    # Indexed for the owner's list (?user_id=): the index entries end in the
+    # primary key, so the rows also come out in id order without a sort
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    # Bumped on every change; read replicas use it to drop stale or
+    # duplicated events when replaying after a snapshot
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=lambda: utcnow(), onupdate=lambda: utcnow())
+
+    __mapper_args__ = {'version_id_col': version}
 
     def to_dict(self):
         return {
@@ -72,9 +83,213 @@ class Book(db.Model):
             "description": self.description,
             "price": self.price,
             "stock": self.stock,
-            "user_id": self.user_id
+            "user_id": self.user_id,
+            "version": self.version
         }
 
+# Columns of to_dict(), for column-only queries that skip building ORM objects
+BOOK_COLUMNS = [c for c in Book.__table__.c if c.name != 'updated_at']
+
+class BookListState(db.Model):
+    """Single row counting book writes; its value versions every GET /books listing"""
+    __tablename__ = 'book_list_state'
+    id = db.Column(db.Integer, primary_key=True)
+    changes = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=lambda: utcnow())
+
+def mark_books_changed():
+    """Bump the listing generation in the current transaction"""
+    db.session.execute(update(BookListState).where(BookListState.id == 1).values(
+        changes=BookListState.changes + 1, updated_at=utcnow()))
+
+@event.listens_for(db.session, 'before_commit')
+def bump_book_list(session):
+    """One bump per transaction that recorded book events, as it commits.
+
+    An atomic UPDATE: concurrent writers queue on the row instead of losing
+    increments, so it runs as late as possible, and after the pending book
+    changes are flushed, so every writer locks its books before this row.
+    """
+    if session.info.pop('books_changed', False):
+        mark_books_changed()
+
+class OutboxEvent(db.Model):
+    """Event waiting to be published to book_events by the outbox relay"""
+    __tablename__ = 'outbox_event'
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: utcnow())
+    # JSON {"traceparent": ..., "written_at": epoch seconds} of the request that wrote it
+    trace_context = db.Column(db.Text, nullable=True)
+
+def current_trace_context():
+    return json.dumps({'traceparent': tracing.current_traceparent(), 'written_at': time.time()})
+
+def record_event(book_event):
+    """Queue a book event (see common/events.py) in the outbox as part of the current transaction.
+
+    Call it before db.session.commit(): the event is then stored if and
+    only if the book change is, and published by the relay afterwards.
+    Every book write records an event, so this also bumps the listing
+    generation on commit (see bump_book_list()).
+    """
+    db.session.add(OutboxEvent(event_type=book_event['type'], payload=json.dumps(book_event),
+                               trace_context=current_trace_context()))
+    db.session.info['outbox_pending'] = db.session.info['books_changed'] = True
+
+def record_events(book_events):
+    """Queue several book events as a single outbox row.
+
+    Used by bulk writes: the relay publishes the whole row as one batch
+    message instead of one outbox row and message per book.
+    """
+    db.session.add(OutboxEvent(event_type='batch', payload=json.dumps(book_events),
+                               trace_context=current_trace_context()))
+    db.session.info['outbox_pending'] = db.session.info['books_changed'] = True
+
+def outbox_row_events(row):
+    """Schema 2 events of an outbox row; rows written before it hold the bare book"""
+    payload = json.loads(row.payload)
+    if row.event_type == 'batch':
+        return [events.normalize(e) for e in payload]
+    if payload.get('v') is None:
+        payload = {'type': row.event_type, 'book': payload}
+    return [events.normalize(payload)]
+
+@event.listens_for(db.session, 'after_commit')
+def wake_relay(session):
+    if session.info.pop('outbox_pending', False):
+        relay_wakeup.set()
+
+class RelayStats:
+    """Counters of the outbox relay, read by /outbox/stats"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = 0
+        self.batches = 0
+        self.last_error = None
+        self.last_published_at = None
+
+    def record_batch(self, count):
+        with self.lock:
+            self.published += count
+            self.batches += 1
+            self.last_error = None
+            self.last_published_at = time.time()
+
+    def record_error(self, error):
+        with self.lock:
+            self.last_error = str(error)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'published': self.published,
+                'batches': self.batches,
+                'last_error': self.last_error,
+                'last_published_at': self.last_published_at,
+            }
+
+relay_stats = RelayStats()
+
+def publish_outbox_batch(channel):
+    """Publish the oldest pending outbox events and delete them once confirmed.
+
+    Several events go out as one {"type": "batch", "events": [...]} message,
+    so a whole batch costs a single publisher-confirm round trip; large
+    messages are compressed (see common/events.py). Rows are
+    locked with SKIP LOCKED so relays in other processes take other rows.
+    Rows written by record_events() already hold a list of events; rows are
+    taken until about OUTBOX_BATCH_SIZE events are collected.
+    Returns the number of events published.
+    """
+    with app.app_context():
+        try:
+            pending = (OutboxEvent.query.order_by(OutboxEvent.id)
+                       .with_for_update(skip_locked=True)
+                       .limit(OUTBOX_BATCH_SIZE).all())
+            if not pending:
+                db.session.rollback()
+                return 0
+            rows = []
+            outgoing = []
+            spans = []
+            for r in pending:
+                if outgoing and len(outgoing) >= OUTBOX_BATCH_SIZE:
+                    break
+                rows.append(r)
+                row_events = outbox_row_events(r)
+                if r.trace_context:
+                    # The catalog continues the writer's trace and measures write-to-visible latency
+                    trace = json.loads(r.trace_context)
+                    publish_span = tracing.start_span('publish book_events', 'producer', trace.get('traceparent'), attributes={
+                        'outbox.id': r.id,
+                        'outbox.events': len(row_events),
+                        'outbox.wait_ms': round((time.time() - trace['written_at']) * 1000, 1),
+                    })
+                    spans.append(publish_span)
+                    trace['traceparent'] = publish_span.traceparent
+                    for e in row_events:
+                        e['trace'] = trace
+                outgoing.extend(row_events)
+            message = outgoing[0] if len(outgoing) == 1 else {'type': 'batch', 'events': outgoing}
+            body, content_type, content_encoding = events.encode(message)
+            oldest = rows[0].created_at.replace(tzinfo=timezone.utc)
+            # With confirm_delivery() this blocks until the broker has the
+            # message and raises if it is nacked or unroutable.
+            with PUBLISH_SECONDS.time():
+                channel.basic_publish(
+                    exchange='book_events',
+                    routing_key='',
+                    body=body,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        content_type=content_type,
+                        content_encoding=content_encoding,
+                        timestamp=int(oldest.timestamp()),  # lets the catalog measure replication lag
+                        message_id=f'outbox-{rows[0].id}-{rows[-1].id}',
+                        headers={'traceparent': spans[0].traceparent} if spans else None,
+                    ))
+            db.session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_([r.id for r in rows])))
+            db.session.commit()
+            for publish_span in spans:
+                publish_span.end()
+            relay_stats.record_batch(len(outgoing))
+            OUTBOX_EVENTS.inc(len(outgoing))
+            OUTBOX_LAG_SECONDS.observe(max(0.0, time.time() - oldest.timestamp()))
+            return len(outgoing)
+        except Exception:
+            # Unconfirmed rows stay in the outbox and are retried; consumers
+            # drop any duplicate thanks to the book versions.
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def run_outbox_relay():
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.URLParameters(rabbitmq_url))
+            channel = connection.channel()
+            channel.exchange_declare(exchange='book_events',
+                                     exchange_type='fanout',
+                                     durable=True)
+            channel.confirm_delivery()
+            app.logger.info("Outbox relay connected to RabbitMQ")
+            while True:
+                relay_wakeup.clear()
+                published = publish_outbox_batch(channel)
+                if published < OUTBOX_BATCH_SIZE:
+                    # Caught up: sleep until a commit adds events or the poll interval passes
+                    relay_wakeup.wait(OUTBOX_POLL_INTERVAL)
+                connection.process_data_events(time_limit=0)
+        except Exception as e:
+            relay_stats.record_error(e)
+            app.logger.error(f"Outbox relay error: {e}, retrying...")
+            time.sleep(2)
+
 @app.route('/')
 def index():
     return jsonify({"service": "store", "status": "ok"})
@@ -83,22 +298,202 @@ def index():
 @app.route('/books', methods=['GET'])
 def list_books():
     user_id = request.args.get('user_id', type=int)
+    query = Book.query
     if user_id is not None:
-        books = Book.query.filter_by(user_id=user_id).all()
+        query = query.filter_by(user_id=user_id)
+
+    # Validated by the listing generation, one primary key read, instead of
+    # scanning the books: every insert, update and delete bumps it. The ETag
+    # names the representation, JSON array or NDJSON, and caches key on Accept.
+    ndjson = streaming.wants_ndjson()
+    state = db.session.get(BookListState, 1)
+    etag = f"books-{state.changes}-{'ndjson' if ndjson else 'json'}"
+    cached = conditional.not_modified(etag, state.updated_at, vary='Accept')
+    if cached:
+        return cached
+
+    # Streamed as JSON (or NDJSON with ?format=ndjson) straight from a
+    # column-only query, instead of loading every book first
+    rows = query.with_entities(*BOOK_COLUMNS).order_by(Book.id)
+    response = streaming.stream_json(streaming.iterate_rows(rows), ndjson)
+    return conditional.with_validators(response, etag, state.updated_at, vary='Accept')
+
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '1000'))
+IMPORT_MAX_ERRORS = 100
+IMPORT_COLUMNS = ('title', 'author', 'description', 'price', 'stock', 'user_id', 'version', 'updated_at')
+
+@app.route('/books/export', methods=['GET'])
+def export_books():
+    """Stream a consistent snapshot of every book as NDJSON, or CSV with ?format=csv.
+
+    The rows are read inside a single REPEATABLE READ transaction (a
+    consistent snapshot in InnoDB) with a server-side cursor, so memory
+    stays flat. The last NDJSON line is {"end": true, "count": N}; a stream
+    without it was cut short and must not be trusted. ?user_id= limits the
+    export to one owner's books.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        abort(400, 'format must be ndjson or csv')
+    query = db.select(*BOOK_COLUMNS).order_by(Book.id)
+    user_id = request.args.get('user_id', type=int)
+    if user_id is not None:
+        query = query.where(Book.user_id == user_id)
+    engine = db.engine  # the generator runs after the app context is gone
+    isolation = 'REPEATABLE READ' if engine.dialect.name == 'mysql' else 'SERIALIZABLE'
+
+    def stream_rows():
+        with engine.connect().execution_options(isolation_level=isolation) as conn:
+            with conn.begin():
+                result = conn.execution_options(stream_results=True, yield_per=streaming.STREAM_BATCH_SIZE).execute(query)
+                for row in result:
+                    yield row
+
+    def generate_ndjson():
+        count = 0
+        for row in stream_rows():
+            count += 1
+            yield json.dumps(row._asdict()) + '\n'
+        yield json.dumps({'end': True, 'count': count}) + '\n'
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([c.name for c in BOOK_COLUMNS])
+        for row in stream_rows():
+            writer.writerow(row)
+            if buffer.tell() >= 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    if fmt == 'csv':
+        return Response(generate_csv(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=books.csv'})
+    return Response(streaming.chunked(generate_ndjson()), mimetype='application/x-ndjson')
+
+def read_import_rows(stream, csv_format):
+    """Yield (line number, row) from an upload, reading it as a stream.
+
+    CSV rows are dicts keyed by the header line; NDJSON rows are the raw
+    lines, decoded by the caller so a bad line is reported, not fatal.
+    """
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if csv_format:
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            yield reader.line_num, row
     else:
-        books = Book.query.all()
-    return jsonify([b.to_dict() for b in books])
+        for number, line in enumerate(text_stream, start=1):
+            if line.strip():
+                yield number, line
+
+def parse_import_row(row, default_user_id):
+    """Validate one imported row and return its column values, or raise ValueError"""
+    if isinstance(row, str):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError('row must be an object')
+    if not row.get('title'):
+        raise ValueError('title is required')
+    user_id = row.get('user_id') or default_user_id
+    if user_id is None:
+        raise ValueError('user_id is required')
+    return {
+        'title': str(row['title']),
+        'author': row.get('author') or None,
+        'description': row.get('description') or None,
+        'price': float(row.get('price') or 0.0),
+        'stock': int(row.get('stock') or 0),
+        'user_id': int(user_id),
+    }
+
+def insert_books(rows):
+    """Insert rows with a single multi-row INSERT and return their new ids in order.
+
+    The SQL is written by hand: compiling a Core insert with thousands of
+    VALUES rows costs more than running it. Both MySQL (InnoDB, with
+    auto_increment_increment = 1) and SQLite give the rows of one INSERT
+    consecutive ids; MySQL reports the first one and SQLite the last.
+    """
+    connection = db.session.connection()
+    marker = '?' if connection.dialect.paramstyle == 'qmark' else '%s'
+    row_markers = '(' + ', '.join([marker] * len(IMPORT_COLUMNS)) + ')'
+    statement = f"INSERT INTO book ({', '.join(IMPORT_COLUMNS)}) VALUES " + ', '.join([row_markers] * len(rows))
+    now = utcnow()
+    params = []
+    for row in rows:
+        params.extend(row[c] for c in IMPORT_COLUMNS[:-2])
+        params.extend((1, now))
+    last_id = connection.exec_driver_sql(statement, tuple(params)).lastrowid
+    first_id = last_id if connection.dialect.name == 'mysql' else last_id - len(rows) + 1
+    return list(range(first_id, first_id + len(rows)))
+
+def import_chunk(rows):
+    """Insert one chunk and its batched book_created event in one transaction"""
+    try:
+        ids = insert_books(rows)
+        record_events([events.created(dict(id=book_id, **row, version=1)) for book_id, row in zip(ids, rows)])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+@app.route('/books/import', methods=['POST'])
+def import_books():
+    """Bulk-create books from an NDJSON upload, or CSV with Content-Type text/csv.
+
+    The body is read as a stream and written in chunks of IMPORT_CHUNK_SIZE
+    rows: one multi-row INSERT, one commit and one outbox row (a single
+    batch message for the catalog) per chunk. Invalid rows are skipped and
+    reported; ?user_id= (else the caller's token) is the owner of rows that
+    do not set one.
+    """
+    default_user_id = request.args.get('user_id', type=int)
+    if default_user_id is None and g.token_claims:
+        default_user_id = int(g.token_claims['sub'])
+    imported = 0
+    chunks = 0
+    rejected = 0
+    errors = []
+    chunk = []
+    for line, row in read_import_rows(request.stream, request.mimetype == 'text/csv'):
+        try:
+            chunk.append(parse_import_row(row, default_user_id))
+        except (ValueError, TypeError) as e:
+            rejected += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({'line': line, 'error': str(e)})
+            continue
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            import_chunk(chunk)
+            imported += len(chunk)
+            chunks += 1
+            chunk = []
+    if chunk:
+        import_chunk(chunk)
+        imported += len(chunk)
+        chunks += 1
+    app.logger.info(f"Imported {imported} books in {chunks} chunks ({rejected} rejected)")
+    return jsonify({'imported': imported, 'chunks': chunks, 'rejected': rejected, 'errors': errors}), 201
 
 @app.route('/books/<int:book_id>', methods=['GET'])
 def get_book(book_id):
     book = Book.query.get_or_404(book_id)
-    return jsonify(book.to_dict())
+    etag = f'book-{book.id}-v{book.version}'
+    cached = conditional.not_modified(etag, book.updated_at)
+    if cached:
+        return cached
+    return conditional.with_validators(jsonify(book.to_dict()), etag, book.updated_at)
 
 @app.route('/books', methods=['POST'])
 def create_book():
     data = request.get_json() or {}
     if 'title' not in data:
         abort(400, 'title is required')
+    if 'user_id' not in data and g.token_claims:
+        data['user_id'] = int(g.token_claims['sub'])
     if 'user_id' not in data:
         abort(400, 'user_id is required')
     book = Book(
@@ -110,39 +505,274 @@ def create_book():
         user_id=data['user_id']
     )
     db.session.add(book)
-    db.session.commit()
-    # Publish book created event
+    db.session.flush()  # assigns the id
+    # Book created event, committed together with the book
     book_data = book.to_dict()
-    publish_event('book_created', book_data)
+    record_event(events.created(book_data))
+    db.session.commit()
     return jsonify(book_data), 201
 
+def concurrent_change(book_id):
+    """409 for a write to a book whose version moved on after it was read (e.g. a reservation)"""
+    db.session.rollback()
+    return jsonify({'error': 'conflict', 'book_id': book_id,
+                    'description': 'the book changed while this request was writing it, retry'}), 409
+
 @app.route('/books/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
     book = Book.query.get_or_404(book_id)
     data = request.get_json() or {}
+    before = book.to_dict()
     book.title = data.get('title', book.title)
     book.author = data.get('author', book.author)
     book.description = data.get('description', book.description)
     book.price = data.get('price', book.price)
     book.stock = data.get('stock', book.stock)
-    db.session.commit()
-    # Publish book updated event
+    try:
+        db.session.flush()  # bumps the version, unless another change bumped it first
+    except StaleDataError:
+        return concurrent_change(book_id)
+    # Book updated event with only the changed fields, committed together with the change
     book_data = book.to_dict()
-    publish_event('book_updated', book_data)
+    if book_data['version'] != before['version']:
+        record_event(events.book_event('book_updated', book.id, book.version,
+                                       events.changed_fields(before, book_data)))
+    db.session.commit()
     return jsonify(book_data)
 
+class StockReservation(db.Model):
+    """Result of a reservation sent with an Idempotency-Key.
+
+    A caller that retries (e.g. an order worker redelivered the same task)
+    gets the stored result back instead of having the stock taken twice.
+    released_at is set once POST /books/<id>/release gave the stock back.
+    """
+    key = db.Column(db.String(100), primary_key=True)
+    book_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    stock = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: utcnow())
+    released_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {'id': self.book_id, 'reserved': self.quantity, 'stock': self.stock, 'version': self.version}
+
+def reused_key(done, book_id, quantity):
+    """422 if the stored reservation is for another book or quantity: a key
+    reused that way is a client bug, not a retry. None when it matches."""
+    if (done.book_id, done.quantity) != (book_id, quantity):
+        return jsonify({'error': 'idempotency_key_reused', 'book_id': done.book_id, 'quantity': done.quantity,
+                        'description': 'the Idempotency-Key was used for a different reservation'}), 422
+    return None
+
+def replay_reservation(done, book_id, quantity):
+    """Answer a retry with the stored reservation, or 409 if it was released since"""
+    rejected = reused_key(done, book_id, quantity)
+    if rejected:
+        return rejected
+    if done.released_at is not None:
+        return jsonify({'error': 'reservation_released', 'book_id': book_id,
+                        'description': 'the reservation with this Idempotency-Key was released'}), 409
+    return jsonify(done.to_dict())
+
+class InsufficientStock(Exception):
+    def __init__(self, book_id, stock):
+        super().__init__(f'not enough stock for book {book_id}')
+        self.book_id = book_id
+        self.stock = stock
+
+def parse_quantity(value):
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        abort(400, 'quantity must be a positive integer')
+    return value
+
+def reserve_stock(book_id, quantity):
+    """Decrement stock atomically inside the current transaction.
+
+    The UPDATE only matches while enough stock is left, so concurrent
+    buyers can never oversell. Returns the new (stock, version); raises
+    InsufficientStock, or 404 if the book does not exist.
+    """
+    result = db.session.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.stock >= quantity)
+        .values(stock=Book.stock - quantity, version=Book.version + 1, updated_at=utcnow())
+        .execution_options(synchronize_session=False))
+    row = db.session.execute(select(Book.stock, Book.version).where(Book.id == book_id)).first()
+    if row is None:
+        abort(404)
+    if result.rowcount == 0:
+        raise InsufficientStock(book_id, row.stock)
+    return row.stock, row.version
+
+def restock(book_id, quantity):
+    """Increment stock atomically inside the current transaction; returns the
+    new (stock, version), or None if the book no longer exists"""
+    db.session.execute(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(stock=Book.stock + quantity, version=Book.version + 1, updated_at=utcnow())
+        .execution_options(synchronize_session=False))
+    return db.session.execute(select(Book.stock, Book.version).where(Book.id == book_id)).first()
+
+def record_stock_changed(book_id, stock, version):
+    record_event(events.book_event('book_updated', book_id, version, {'stock': stock}))
+
+@app.route('/books/<int:book_id>/reserve', methods=['POST'])
+def reserve_book(book_id):
+    """Take `quantity` units of stock. With an Idempotency-Key header a retry
+    of the same reservation answers the first result without taking more."""
+    data = request.get_json() or {}
+    quantity = parse_quantity(data.get('quantity', 1))
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 100:
+        abort(400, 'Idempotency-Key must have 1 to 100 characters')
+    if key is not None:
+        done = db.session.get(StockReservation, key)
+        if done is not None:
+            return replay_reservation(done, book_id, quantity)
+    try:
+        stock, version = reserve_stock(book_id, quantity)
+    except InsufficientStock as e:
+        db.session.rollback()
+        return jsonify({'error': 'insufficient_stock', 'book_id': book_id, 'stock': e.stock}), 409
+    record_stock_changed(book_id, stock, version)
+    if key is not None:
+        db.session.add(StockReservation(key=key, book_id=book_id, quantity=quantity, stock=stock, version=version))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if key is None:
+            raise
+        # A concurrent request with the same key won: ours is undone, answer theirs
+        return replay_reservation(db.session.get(StockReservation, key), book_id, quantity)
+    return jsonify({'id': book_id, 'reserved': quantity, 'stock': stock, 'version': version})
+
+@app.route('/books/<int:book_id>/release', methods=['POST'])
+def release_book(book_id):
+    """Give back the stock taken by the reservation made with the same
+    Idempotency-Key and `quantity` (e.g. for an order that failed after
+    reserving). Only the first release returns stock. Releasing a key that
+    reserved nothing (yet) records it as released, so a reservation with
+    that key still in flight cannot take the stock afterwards."""
+    data = request.get_json() or {}
+    quantity = parse_quantity(data.get('quantity', 1))
+    key = request.headers.get('Idempotency-Key')
+    if key is None or not 0 < len(key) <= 100:
+        abort(400, 'Idempotency-Key of the reservation is required, 1 to 100 characters')
+    done = db.session.get(StockReservation, key, with_for_update=True)
+    released = 0
+    if done is None:
+        row = db.session.execute(select(Book.stock, Book.version).where(Book.id == book_id)).first()
+        db.session.add(StockReservation(key=key, book_id=book_id, quantity=quantity, stock=row.stock if row else 0,
+                                        version=row.version if row else 0, released_at=utcnow()))
+    else:
+        rejected = reused_key(done, book_id, quantity)
+        if rejected:
+            db.session.rollback()
+            return rejected
+        if done.released_at is None:
+            row = restock(book_id, quantity)
+            if row is not None:  # a deleted book has nothing to give the stock back to
+                record_stock_changed(book_id, row.stock, row.version)
+                released = quantity
+            done.released_at = utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The reservation with this key was committed meanwhile: the caller retries and releases it
+        db.session.rollback()
+        return jsonify({'error': 'conflict', 'book_id': book_id,
+                        'description': 'a reservation with this Idempotency-Key is being made, retry'}), 409
+    return jsonify({'id': book_id, 'released': released})
+
+@app.route('/books/reserve', methods=['POST'])
+def reserve_books():
+    """All-or-nothing reservation for a multi-item cart: {"items": [{"book_id", "quantity"}]}"""
+    data = request.get_json() or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        abort(400, 'items is required')
+    quantities = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('book_id'), int):
+            abort(400, 'every item needs an integer book_id')
+        quantities[item['book_id']] = quantities.get(item['book_id'], 0) + parse_quantity(item.get('quantity', 1))
+
+    reserved = []
+    try:
+        # Always lock rows in id order so concurrent carts cannot deadlock
+        for book_id in sorted(quantities):
+            stock, version = reserve_stock(book_id, quantities[book_id])
+            reserved.append({'id': book_id, 'reserved': quantities[book_id], 'stock': stock, 'version': version})
+            record_stock_changed(book_id, stock, version)
+    except InsufficientStock as e:
+        db.session.rollback()
+        return jsonify({'error': 'insufficient_stock', 'book_id': e.book_id, 'stock': e.stock}), 409
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    return jsonify({'items': reserved})
+
 @app.route('/books/<int:book_id>', methods=['DELETE'])
 def delete_book(book_id):
     book = Book.query.get_or_404(book_id)
-    book_data = book.to_dict()  # Get data before deletion
+    # The delete is one more change: replicas must see it as newer than the last update
+    deleted = events.book_event('book_deleted', book.id, book.version + 1)
     db.session.delete(book)
-    db.session.commit()
-    # Publish book deleted event
-    publish_event('book_deleted', book_data)
+    # Book deleted event, committed together with the delete
+    record_event(deleted)
+    try:
+        db.session.commit()
+    except StaleDataError:
+        return concurrent_change(book_id)
     return '', 204
 
+@app.route('/outbox/stats')
+def outbox_stats():
+    stats = relay_stats.snapshot()
+    stats['pending'] = db.session.query(func.count(OutboxEvent.id)).scalar()
+    return jsonify(stats)
+
+# Schema changes made after the first deploy, applied in order by
+# create_schema() (see common/migrations.py). Append, never edit or reorder.
+MIGRATIONS = [
+    (1, 'book.version for ordering events',
+     lambda conn: migrations.add_column(conn, 'book', 'version', 'INTEGER NOT NULL DEFAULT 1')),
+    (2, 'book.updated_at for Last-Modified',
+     lambda conn: migrations.add_column(conn, 'book', 'updated_at', 'DATETIME NULL')),
+    (3, 'outbox_event.trace_context',
+     lambda conn: migrations.add_column(conn, 'outbox_event', 'trace_context', 'TEXT NULL')),
+    (4, 'index on book.user_id',
+     lambda conn: migrations.create_index(conn, Book.__table__, 'ix_book_user_id')),
+    (5, 'stock_reservation.released_at',
+     lambda conn: migrations.add_column(conn, 'stock_reservation', 'released_at', 'DATETIME NULL')),
+]
+
+def create_schema():
+    """Create missing tables, then apply pending migrations"""
+    db.create_all()
+    migrations.migrate(db.engine, MIGRATIONS, app.logger)
+    if db.session.get(BookListState, 1) is None:
+        db.session.add(BookListState(id=1, changes=0))
+        db.session.commit()
+
+serving.add_health_routes(app, {'database': lambda: db.session.execute(text('SELECT 1'))})
+
+def start_background_tasks():
+    """Start the outbox relay; with several server workers only one runs it"""
+    serving.run_exclusively('store-outbox-relay', run_outbox_relay)
+
 if __name__ == '__main__':
+    # Development server; production runs gunicorn with gunicorn.conf.py
     # create tables on startup (idempotent)
     with app.app_context():
-        db.create_all()
+        create_schema()
+
+    # Publish outbox events in background thread
+    start_background_tasks()
+
     app.run(host='0.0.0.0', port=5000, debug=True)
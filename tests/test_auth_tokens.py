@@ -0,0 +1,61 @@
+"""Rotation of refresh tokens by POST /token/refresh of auth_service"""
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def session(auth, reset_rows):
+    """The first refresh token of a new session of a fresh user"""
+    with reset_rows(auth, auth.RefreshToken) as db_session:
+        auth.User.query.filter_by(username='refresher').delete()
+        user = auth.User(username='refresher', email='refresher@example.com', password_hash='x')
+        db_session.add(user)
+        db_session.flush()
+        issued = auth.issue_tokens(user)
+    return issued['refresh_token']
+
+
+def refresh(auth, token):
+    return auth.app.test_client().post('/token/refresh', json={'refresh_token': token})
+
+
+def live_tokens(auth):
+    with auth.app.app_context():
+        count = auth.RefreshToken.query.filter_by(revoked_at=None).count()
+        auth.db.session.remove()
+    return count
+
+
+def test_refresh_rotates_the_token(auth, session):
+    response = refresh(auth, session)
+    assert response.status_code == 200
+    assert refresh(auth, response.get_json()['refresh_token']).status_code == 200
+    assert live_tokens(auth) == 1
+
+
+def test_concurrent_refreshes_of_one_session_all_succeed(auth, session):
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(refresh(auth, session))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [r.status_code for r in responses] == [200] * 4
+    assert live_tokens(auth) == 4
+    for response in responses:
+        assert refresh(auth, response.get_json()['refresh_token']).status_code == 200
+
+
+def test_reuse_after_the_grace_period_ends_every_session(auth, session, monkeypatch):
+    rotated = refresh(auth, session).get_json()['refresh_token']
+    monkeypatch.setattr(auth, 'REFRESH_REUSE_GRACE', 0)
+    assert refresh(auth, session).status_code == 401
+    assert refresh(auth, rotated).status_code == 401
+    assert live_tokens(auth) == 0
+
+
+def test_reuse_after_logout_is_not_accepted(auth, session):
+    rotated = refresh(auth, session).get_json()['refresh_token']
+    auth.app.test_client().post('/logout', json={'refresh_token': rotated})
+    assert refresh(auth, session).status_code == 401
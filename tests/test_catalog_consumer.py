@@ -0,0 +1,118 @@
+"""Book events applied by the catalog's consumer"""
+import json
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+
+@pytest.fixture
+def replica(catalog, reset_rows):
+    """The catalog module with one book, id 1 at version 3"""
+    with reset_rows(catalog, catalog.BookTombstone, catalog.Book) as session:
+        session.add(catalog.Book(id=1, title='Title', author='Author', price=10.0, stock=5, version=3))
+    return catalog
+
+
+class Channel:
+    """Records what apply_batch() acks and rejects"""
+
+    def __init__(self):
+        self.acked = []
+        self.rejected = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected.append((delivery_tag, requeue))
+
+
+def deliver(catalog, *messages):
+    """apply_batch() over messages (dicts, or raw bodies), delivery tags 1, 2, ..."""
+    channel = Channel()
+    batch = [(tag, catalog.pika.BasicProperties(content_type='application/json'),
+              message if isinstance(message, bytes) else json.dumps(message).encode())
+             for tag, message in enumerate(messages, 1)]
+    catalog.apply_batch(channel, batch)
+    return channel
+
+
+def stored(catalog, book_id):
+    with catalog.app.app_context():
+        book = catalog.db.session.get(catalog.Book, book_id)
+        values = book and (book.title, book.stock, book.version)
+        catalog.db.session.remove()
+    return values
+
+
+def test_unversioned_update_keeps_the_local_version(replica):
+    channel = deliver(replica, {'type': 'book_stock_changed', 'book': {'id': 1, 'stock': 2}})
+    assert channel.acked == [1] and channel.rejected == []
+    assert stored(replica, 1) == ('Title', 2, 3)
+
+
+def test_unversioned_create_starts_at_version_one(replica):
+    deliver(replica, {'type': 'book_created', 'book': {'id': 2, 'title': 'New', 'author': 'A', 'price': 1.0,
+                                                       'stock': 1, 'description': None}})
+    assert stored(replica, 2) == ('New', 1, 1)
+
+
+def update(book_id, version, **fields):
+    return {'v': 2, 'type': 'book_updated', 'id': book_id, 'version': version, 'fields': fields}
+
+
+def test_batch_is_acked_at_once(replica):
+    channel = deliver(replica, update(1, 4, stock=4), update(1, 5, stock=3))
+    assert channel.acked == [2] and channel.rejected == []
+    assert stored(replica, 1) == ('Title', 3, 5)
+
+
+@pytest.mark.parametrize('body', [b'not json', json.dumps({'v': 2, 'type': 'book_updated', 'id': 'one', 'version': 4,
+                                                           'fields': {}}).encode(),
+                                  json.dumps(update(1, 4, owner=2)).encode()])
+def test_malformed_message_is_rejected_without_blocking_the_rest(replica, body):
+    channel = deliver(replica, body, update(1, 4, stock=4))
+    assert channel.rejected == [(1, False)] and channel.acked == [2]
+    assert stored(replica, 1) == ('Title', 4, 4)
+
+
+@pytest.fixture
+def database_locked_once(replica, monkeypatch):
+    """process_book_event fails the way a locked SQLite database does for the event with stock=1:
+    in the whole batch, then in the retry of that message alone"""
+    process_book_event = replica.process_book_event
+    failures = [2]
+
+    def locked(event, state):
+        if failures[0] and event['fields'].get('stock') == 1:
+            failures[0] -= 1
+            raise OperationalError('UPDATE book', {}, Exception('database is locked'))
+        return process_book_event(event, state)
+
+    monkeypatch.setattr(replica, 'process_book_event', locked)
+    monkeypatch.setattr(replica, 'CONSUMER_RETRY_DELAY', 0)
+    return replica
+
+
+def test_transient_failure_requeues_the_message_and_the_rest(database_locked_once):
+    channel = deliver(database_locked_once, update(1, 4, stock=4), update(1, 5, stock=1), update(1, 6, stock=0))
+    assert channel.acked == [1] and channel.rejected == [(2, True), (3, True)]
+    assert stored(database_locked_once, 1) == ('Title', 4, 4)
+    channel = deliver(database_locked_once, update(1, 5, stock=1), update(1, 6, stock=0))
+    assert channel.acked == [2] and channel.rejected == []
+    assert stored(database_locked_once, 1) == ('Title', 0, 6)
+
+
+def test_gap_waits_in_the_queue_while_the_store_is_down(replica, monkeypatch, store_response):
+    monkeypatch.setattr(replica, 'CONSUMER_RETRY_DELAY', 0)
+    # STORE_SERVICE_URL points where nothing listens: the missed change cannot be reloaded yet
+    channel = deliver(replica, update(1, 4, stock=4), update(1, 7, stock=1))
+    assert channel.acked == [1] and channel.rejected == [(2, True)]
+    assert stored(replica, 1) == ('Title', 4, 4)
+
+    monkeypatch.setattr(replica.requests, 'get', lambda url, timeout=None: store_response(200, {
+        'id': 1, 'title': 'Retitled', 'author': 'Author', 'description': None, 'price': 10.0, 'stock': 1,
+        'version': 7}))
+    channel = deliver(replica, update(1, 7, stock=1))
+    assert channel.acked == [1] and channel.rejected == []
+    assert stored(replica, 1) == ('Retitled', 1, 7)
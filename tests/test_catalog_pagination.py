@@ -0,0 +1,66 @@
+"""Keyset pagination of GET /catalog walks every book exactly once, NULL sort keys included"""
+import json
+
+import pytest
+
+BOOKS = 199
+
+
+@pytest.fixture
+def client(catalog, reset_rows):
+    with reset_rows(catalog, catalog.Book) as session:
+        session.add_all(catalog.Book(
+            id=i,
+            title=None if i % 3 == 0 else f'Title {i % 40:02d}',
+            author=f'Author {i % 2}',
+            price=None if i % 4 == 0 else float(i % 25),
+            stock=i % 5,
+            version=1) for i in range(1, BOOKS + 1))
+        catalog.mark_changed()
+    return catalog.app.test_client()
+
+
+def expected_ids(client, sort, order, **filters):
+    """Ids in (sort, id) order, with NULL keys first ascending as SQLite sorts them"""
+    books = [json.loads(line) for line in
+             client.get('/catalog', query_string={'format': 'ndjson', **filters}).get_data(as_text=True).splitlines()]
+    books.sort(key=lambda b: (b[sort] is not None, b[sort] or 0, b['id']))
+    ids = [b['id'] for b in books]
+    return ids[::-1] if order == 'desc' else ids
+
+
+def walk(client, **params):
+    ids, cursor = [], None
+    while True:
+        page = client.get('/catalog', query_string=dict(params, limit=17, **({'cursor': cursor} if cursor else {})))
+        assert page.status_code == 200
+        body = page.get_json()
+        ids += [b['id'] for b in body['items']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize('sort', ['id', 'title', 'price'])
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_pages_cover_every_book_in_order(client, sort, order):
+    ids = walk(client, sort=sort, order=order)
+    assert len(ids) == BOOKS
+    assert ids == expected_ids(client, sort, order)
+
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_filtered_pages_cover_every_match(client, order):
+    ids = walk(client, sort='title', order=order, author='Author 1')
+    assert ids == expected_ids(client, 'title', order, author='Author 1')
+    ids = walk(client, sort='price', order=order, min_price=3)
+    assert ids == expected_ids(client, 'price', order, min_price=3)
+    assert len(ids) == len(set(ids)) > 0
+
+
+def test_ndjson_continues_after_a_null_cursor(client):
+    first = client.get('/catalog', query_string={'sort': 'title', 'limit': 17}).get_json()
+    assert first['items'][-1]['title'] is None
+    rest = client.get('/catalog', query_string={'sort': 'title', 'format': 'ndjson', 'cursor': first['next_cursor']})
+    ids = [b['id'] for b in first['items']] + [json.loads(line)['id'] for line in rest.get_data(as_text=True).splitlines()]
+    assert ids == expected_ids(client, 'title', 'asc')
@@ -0,0 +1,40 @@
+"""Conditional GETs of /catalog: one ETag per representation, Vary: Accept"""
+import pytest
+
+
+@pytest.fixture
+def client(catalog, reset_rows):
+    with reset_rows(catalog, catalog.Book) as session:
+        session.add_all(catalog.Book(id=i, title=f'Title {i}', author='Author', price=float(i), stock=1, version=1)
+                        for i in range(1, 6))
+        catalog.mark_changed()
+    return catalog.app.test_client()
+
+
+NDJSON = {'Accept': 'application/x-ndjson'}
+
+
+def test_json_and_ndjson_have_different_etags(client):
+    page = client.get('/catalog')
+    stream = client.get('/catalog', headers=NDJSON)
+    assert stream.mimetype == 'application/x-ndjson'
+    assert page.headers['ETag'] != stream.headers['ETag']
+    assert 'Accept' in page.headers['Vary'] and 'Accept' in stream.headers['Vary']
+
+
+def test_etag_of_one_representation_does_not_revalidate_the_other(client):
+    page = client.get('/catalog')
+    stream = client.get('/catalog', headers=dict(NDJSON, **{'If-None-Match': page.headers['ETag']}))
+    assert stream.status_code == 200 and stream.mimetype == 'application/x-ndjson'
+    page = client.get('/catalog', headers={'If-None-Match': stream.headers['ETag']})
+    assert page.status_code == 200 and page.mimetype == 'application/json'
+
+
+@pytest.mark.parametrize('headers, query', [({}, {}), (NDJSON, {}), ({}, {'format': 'ndjson'})])
+def test_same_representation_is_not_modified(client, headers, query):
+    first = client.get('/catalog', headers=headers, query_string=query)
+    again = client.get('/catalog', headers=dict(headers, **{'If-None-Match': first.headers['ETag']}),
+                       query_string=query)
+    assert again.status_code == 304
+    assert again.headers['ETag'] == first.headers['ETag']
+    assert 'Accept' in again.headers['Vary']
@@ -0,0 +1,43 @@
+"""Validators of common/conditional.py"""
+from datetime import datetime
+
+import pytest
+from flask import Flask, jsonify
+
+from common import conditional
+
+UPDATED_AT = datetime(2024, 5, 1, 12, 30, 15, 250000)
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/thing')
+    def thing():
+        return (conditional.not_modified('thing-1', UPDATED_AT, vary='Accept') or
+                conditional.with_validators(jsonify({'id': 1}), 'thing-1', UPDATED_AT, vary='Accept'))
+
+    return app.test_client()
+
+
+def test_full_response_carries_the_validators(client):
+    response = client.get('/thing')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == 'W/"thing-1"'
+    assert response.last_modified == conditional.http_date(UPDATED_AT)
+    assert 'Accept' in response.headers['Vary']
+
+
+@pytest.mark.parametrize('headers', [{'If-None-Match': 'W/"thing-1"'},
+                                     {'If-Modified-Since': 'Wed, 01 May 2024 12:30:15 GMT'}])
+def test_current_copy_is_not_modified(client, headers):
+    response = client.get('/thing', headers=headers)
+    assert response.status_code == 304
+    assert response.headers['ETag'] == 'W/"thing-1"' and 'Accept' in response.headers['Vary']
+
+
+def test_etag_takes_precedence_over_the_date(client):
+    response = client.get('/thing', headers={'If-None-Match': 'W/"thing-0"',
+                                             'If-Modified-Since': 'Wed, 01 May 2024 12:30:15 GMT'})
+    assert response.status_code == 200
@@ -0,0 +1,21 @@
+"""Sizing of the auth service's password hashing queue"""
+import hashing
+
+
+def test_queue_holds_what_the_pool_hashes_in_the_target_time():
+    assert hashing.queue_size(1, 0.12, target=2) == 16
+    assert hashing.queue_size(4, 0.12, target=2) == 66
+    assert hashing.queue_size(2, 10, target=2) == 2  # never below one job per worker
+
+
+def test_default_queue_is_sized_from_the_measured_hash_time():
+    hasher = hashing.PasswordHasher(method='scrypt:32768:8:1', workers=1, max_pending=0)
+    assert hasher.max_pending == hashing.queue_size(1, hasher.hash_seconds)
+    assert hasher.max_pending >= 8  # a default scrypt hash takes well under HASH_QUEUE_TARGET / 8
+    assert hashing.PasswordHasher(method='scrypt:32768:8:1', workers=1, max_pending=3).max_pending == 3
+
+
+def test_server_workers_split_the_cpus():
+    assert hashing.pool_size(8, 2) == 4
+    assert hashing.pool_size(8, 1) == 8
+    assert hashing.pool_size(2, 4) == 1  # more server workers than CPUs: one hashing process each
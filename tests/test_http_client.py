@@ -0,0 +1,120 @@
+"""Circuit breaker and retries of the gateway's UpstreamClient against a local server"""
+import threading
+import time
+
+import pytest
+import requests
+from flask import Flask
+from werkzeug.serving import make_server
+
+import http_client
+
+
+@pytest.fixture(scope='module')
+def upstream():
+    """A server whose routes answer a fixed status, counting the requests they get"""
+    app = Flask(__name__)
+    hits = {}
+
+    def answer(name, status, headers=None):
+        hits[name] = hits.get(name, 0) + 1
+        return 'x', status, headers or {}
+
+    app.add_url_rule('/ok', 'ok', lambda: answer('ok', 200))
+    app.add_url_rule('/error', 'error', lambda: answer('error', 500))
+    app.add_url_rule('/bad-gateway', 'bad_gateway', lambda: answer('bad_gateway', 502))
+    app.add_url_rule('/shed', 'shed', lambda: answer('shed', 503, {'Retry-After': '30'}))
+    app.add_url_rule('/limited', 'limited', lambda: answer('limited', 429, {'Retry-After': '30'}))
+    app.add_url_rule('/slow', 'slow', lambda: time.sleep(0.5) or answer('slow', 200))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', hits
+    server.shutdown()
+
+
+@pytest.fixture
+def client(upstream):
+    url, hits = upstream
+    hits.clear()
+    client = http_client.UpstreamClient('testupstream', url, retries=2, backoff=0)
+    client.breaker.failure_threshold = 3
+    yield client
+    client.close()
+
+
+@pytest.mark.parametrize('path', ['/shed', '/limited'])
+def test_shed_responses_do_not_open_the_breaker(client, upstream, path):
+    for _ in range(10):
+        assert client.get(path).status_code in (429, 503)
+    assert client.breaker.state == client.breaker.CLOSED
+    assert client.get('/ok').status_code == 200
+
+
+def test_shed_responses_are_not_retried_nor_waited_for(client, upstream):
+    _, hits = upstream
+    started = time.monotonic()
+    client.get('/shed')
+    assert time.monotonic() - started < 5  # Retry-After is 30
+    assert hits['shed'] == 1
+
+
+def test_bad_gateway_is_retried(client, upstream):
+    _, hits = upstream
+    assert client.get('/bad-gateway').status_code == 502
+    assert hits['bad_gateway'] == 3
+
+
+def test_errors_open_the_breaker(client):
+    for _ in range(3):
+        assert client.get('/error').status_code == 500
+    with pytest.raises(http_client.CircuitOpen):
+        client.get('/ok')
+
+
+def test_shed_probe_leaves_the_breaker_half_open(client):
+    for _ in range(3):
+        client.get('/error')
+    client.breaker.opened_at -= client.breaker.reset_timeout
+    assert client.get('/shed').status_code == 503
+    assert client.breaker.state == client.breaker.HALF_OPEN
+    assert client.get('/ok').status_code == 200
+    assert client.breaker.state == client.breaker.CLOSED
+
+
+@pytest.fixture
+def deadline():
+    """Runs the test inside a gateway request whose deadline each call to the fixture restarts"""
+    token = http_client._deadline.set(None)
+    yield http_client.start_deadline
+    http_client._deadline.reset(token)
+
+
+def test_deadline_timeouts_do_not_open_the_breaker(client, deadline):
+    for _ in range(5):
+        deadline(0.1)
+        with pytest.raises(http_client.DeadlineExceeded):
+            client.get('/slow')
+    assert client.breaker.state == client.breaker.CLOSED
+
+
+def test_upstream_timeouts_open_the_breaker(client, deadline):
+    client.timeout = (1.0, 0.1)
+    for _ in range(3):
+        deadline(30)
+        with pytest.raises(requests.exceptions.RequestException) as raised:
+            client.get('/slow')
+        assert not isinstance(raised.value, http_client.DeadlineExceeded)
+    assert client.breaker.state == client.breaker.OPEN
+
+
+def test_admitted_requests_fit_in_the_default_bulkhead(client):
+    assert client.max_concurrency == http_client.ratelimit.ADMISSION_MAX_CONCURRENT
+    statuses = []
+    calls = [threading.Thread(target=lambda: statuses.append(client.get('/slow').status_code))
+             for _ in range(client.max_concurrency)]
+    for call in calls:
+        call.start()
+    for call in calls:
+        call.join()
+    assert statuses == [200] * client.max_concurrency
+    assert client.rejected['bulkhead_full'] == 0
@@ -0,0 +1,50 @@
+"""Worker files of common/metrics.py under several processes"""
+import json
+import os
+
+import pytest
+
+from common import metrics
+
+
+@pytest.fixture
+def registry(tmp_path):
+    """A registry writing to its own directory, with one metric of each kind"""
+    registry = metrics.Registry(directory=str(tmp_path))
+    metrics.Counter('jobs_total', 'Jobs', ('kind',), registry=registry)
+    metrics.Gauge('queue_depth', 'Queue depth', registry=registry)
+    metrics.Histogram('job_seconds', 'Job duration', buckets=(1,), registry=registry)
+    return registry
+
+
+def exited_worker(registry, pid, jobs):
+    """Write the file a worker with this pid left behind"""
+    snapshot = {'jobs_total': [[['a'], jobs]], 'queue_depth': [[[], 7]], 'job_seconds': [[[], [[jobs, 0], 0.5, jobs]]]}
+    with open(registry.path(pid), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def test_retired_workers_are_folded_into_the_archive(registry):
+    exited_worker(registry, 101, 2)
+    exited_worker(registry, 102, 3)
+    registry.retire(101)
+    registry.retire(102)
+    assert sorted(os.path.basename(path) for path in registry.worker_files()) == ['archive.json']
+    collected = registry.collect()
+    assert collected['jobs_total'] == {('a',): 5}
+    assert collected['job_seconds'] == {(): [[5, 0], 1.0, 5]}
+    assert collected['queue_depth'] == {}  # an exited worker's gauges are dropped
+
+
+def test_unknown_metrics_stay_in_the_worker_file(registry):
+    with open(registry.path(103), 'w') as f:
+        json.dump({'jobs_total': [[['a'], 1]], 'other_total': [[[], 4]]}, f)
+    registry.retire(103)
+    with open(registry.path(103)) as f:
+        assert json.load(f) == {'other_total': [[[], 4]]}
+    assert registry.collect()['jobs_total'] == {('a',): 1}
+
+
+def test_retiring_a_worker_without_a_file_is_a_no_op(registry):
+    registry.retire(104)
+    assert registry.worker_files() == []
@@ -0,0 +1,181 @@
+"""Order steps run by the workers of order_service, with the store stubbed out"""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def worker(orders, monkeypatch, reset_rows, store_response):
+    """The orders module with charge() and the store's reserve endpoint recorded"""
+    calls = {'charged': [], 'reserved': [], 'reserve_status': 200}
+
+    def reserve(url, json=None, headers=None, timeout=None):
+        calls['reserved'].append(url)
+        return store_response(calls['reserve_status'])
+
+    monkeypatch.setattr(orders.requests, 'post', reserve)
+    monkeypatch.setattr(orders, 'charge', lambda order: calls['charged'].append(order.id))
+    with reset_rows(orders, orders.OrderTask, orders.PurchaseOrder):
+        pass
+    orders.calls = calls
+    return orders
+
+
+def new_order(orders, **values):
+    with orders.app.app_context():
+        order = orders.PurchaseOrder(**dict(dict(user_id=1, book_id=7, quantity=1, unit_price=10.0, total_price=10.0,
+                                                 payment_method='card', provider_id='1'), **values))
+        orders.db.session.add(order)
+        orders.db.session.commit()
+        order_id = order.id
+        orders.db.session.remove()
+    return order_id
+
+
+def order_status(orders, order_id):
+    with orders.app.app_context():
+        order = orders.db.session.get(orders.PurchaseOrder, order_id)
+        status, reason = order.status, order.failure_reason
+        orders.db.session.remove()
+    return status, reason
+
+
+def run(orders, step, order_id):
+    orders.process_task(json.dumps({'step': step, 'order_id': order_id}))
+
+
+def test_stock_is_reserved_before_charging(worker):
+    order_id = new_order(worker)
+    run(worker, 'pay', order_id)
+    assert worker.calls['reserved'] and worker.calls['charged'] == [order_id]
+    assert order_status(worker, order_id) == ('paid', None)
+    run(worker, 'ship', order_id)
+    assert order_status(worker, order_id) == ('shipped', None)
+
+
+@pytest.mark.parametrize('status, reason', [(409, 'out_of_stock'), (404, 'book_not_found')])
+def test_unservable_order_fails_without_charge(worker, status, reason):
+    worker.calls['reserve_status'] = status
+    order_id = new_order(worker)
+    run(worker, 'pay', order_id)
+    assert worker.calls['charged'] == []
+    assert order_status(worker, order_id) == ('failed', reason)
+
+
+class Channel:
+    """Records what handle_task() publishes and acks"""
+
+    def __init__(self):
+        self.published = []
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, body, properties.headers))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+
+def handle(orders, body, attempt=None):
+    channel = Channel()
+    properties = orders.pika.BasicProperties(headers={'x-attempt': attempt} if attempt else None)
+    orders.handle_task(channel, 1, properties, body if isinstance(body, str) else json.dumps(body))
+    assert channel.acked == [1]
+    return channel.published
+
+
+@pytest.fixture
+def no_delay(worker, monkeypatch):
+    monkeypatch.setattr(worker, 'ORDER_RETRY_DELAY', 0)
+    return worker
+
+
+def test_transient_failure_goes_back_to_the_queue(no_delay):
+    no_delay.calls['reserve_status'] = 503
+    order_id = new_order(no_delay)
+    published = handle(no_delay, {'step': 'pay', 'order_id': order_id})
+    assert published == [(no_delay.ORDER_TASK_QUEUE, json.dumps({'step': 'pay', 'order_id': order_id}),
+                          {'x-attempt': 2})]
+    assert order_status(no_delay, order_id) == ('pending', None)
+
+
+def test_database_errors_are_transient(no_delay, monkeypatch):
+    def unavailable(order_id, lock=False):
+        raise no_delay.OperationalError('SELECT 1', {}, Exception('gone away'))
+
+    monkeypatch.setattr(no_delay, 'load_order', unavailable)
+    published = handle(no_delay, {'step': 'ship', 'order_id': 1})
+    assert [queue for queue, _, _ in published] == [no_delay.ORDER_TASK_QUEUE]
+
+
+def test_retries_are_capped(no_delay):
+    no_delay.calls['reserve_status'] = 503
+    order_id = new_order(no_delay)
+    published = handle(no_delay, {'step': 'pay', 'order_id': order_id}, attempt=no_delay.ORDER_TASK_MAX_ATTEMPTS)
+    assert [queue for queue, _, _ in published] == [no_delay.ORDER_DEAD_QUEUE]
+    assert order_status(no_delay, order_id) == ('failed', 'retries_exhausted')
+
+
+@pytest.mark.parametrize('status', [400, 401, 403, 422])
+def test_rejected_reservation_fails_the_order_at_once(no_delay, status):
+    no_delay.calls['reserve_status'] = status
+    order_id = new_order(no_delay)
+    assert handle(no_delay, {'step': 'pay', 'order_id': order_id}) == []
+    assert order_status(no_delay, order_id) == ('failed', f'store_rejected_{status}')
+    assert no_delay.calls['charged'] == []
+
+
+def queued_steps(orders, order_id):
+    with orders.app.app_context():
+        steps = [t.step for t in orders.OrderTask.query.filter_by(order_id=order_id)]
+        orders.db.session.remove()
+    return steps
+
+
+def test_bug_in_a_step_is_not_retried(no_delay, monkeypatch):
+    def broken(order):
+        raise RuntimeError('bug')
+
+    monkeypatch.setattr(no_delay, 'charge', broken)
+    order_id = new_order(no_delay)
+    published = handle(no_delay, {'step': 'pay', 'order_id': order_id})
+    assert [(queue, headers) for queue, _, headers in published] == [(no_delay.ORDER_DEAD_QUEUE, {'x-error': 'bug'})]
+    assert order_status(no_delay, order_id) == ('failed', 'task_failed')
+    assert queued_steps(no_delay, order_id) == ['release']  # the stock was reserved before the charge broke
+
+
+@pytest.fixture
+def store_backed(no_delay, store, monkeypatch, reset_rows):
+    """The worker with its calls to the store sent to the store app, and a book with 5 units there"""
+    client = store.app.test_client()
+    monkeypatch.setattr(no_delay.requests, 'post', lambda url, json=None, headers=None, timeout=None: client.post(
+        url[len(no_delay.STORE_SERVICE_URL):], json=json, headers=headers))
+    # Order ids start over in every test, and so do their reservation keys
+    with reset_rows(store, store.StockReservation) as session:
+        book = store.Book(title='Reserved', author='A', price=10.0, stock=5, user_id=1)
+        session.add(book)
+        session.flush()
+        no_delay.store_book_id = book.id
+    no_delay.store_stock = lambda: client.get(f'/books/{no_delay.store_book_id}').get_json()['stock']
+    return no_delay
+
+
+@pytest.mark.parametrize('attempt', [1, 'last'])
+def test_stock_comes_back_when_the_order_is_given_up(store_backed, monkeypatch, attempt):
+    def declined(order):
+        raise (RuntimeError if attempt == 1 else store_backed.RetryLater)('payment provider down')
+
+    monkeypatch.setattr(store_backed, 'charge', declined)
+    order_id = new_order(store_backed, book_id=store_backed.store_book_id, quantity=2)
+    handle(store_backed, {'step': 'pay', 'order_id': order_id},
+           attempt=None if attempt == 1 else store_backed.ORDER_TASK_MAX_ATTEMPTS)
+    assert order_status(store_backed, order_id)[0] == 'failed'
+    assert store_backed.store_stock() == 3
+    for _ in range(2):  # a redelivered release gives nothing more back
+        assert handle(store_backed, {'step': 'release', 'order_id': order_id}) == []
+    assert store_backed.store_stock() == 5
+
+
+def test_malformed_task_is_parked(no_delay):
+    published = handle(no_delay, 'not json')
+    assert [queue for queue, _, _ in published] == [no_delay.ORDER_DEAD_QUEUE]
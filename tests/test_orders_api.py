@@ -0,0 +1,45 @@
+"""POST /orders of order_service, with the store stubbed out"""
+import pytest
+
+from common import tokens
+
+
+@pytest.fixture
+def client(orders, monkeypatch, store_response):
+    books = {7: {'id': 7, 'title': 'Store title', 'price': 12.5}}
+    monkeypatch.setattr(orders.requests, 'get', lambda url, timeout=None: (
+        store_response(200, books[int(url.rsplit('/', 1)[1])]) if int(url.rsplit('/', 1)[1]) in books
+        else store_response(404)))
+    token, _, _ = tokens.issue_access_token({'sub': '1', 'name': 'buyer'})
+    client = orders.app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    return client
+
+
+def test_price_and_title_come_from_the_store(client):
+    response = client.post('/orders', json={'book_id': 7, 'quantity': 2, 'unit_price': 0, 'book_title': 'Free'},
+                           headers={'Idempotency-Key': 'price-test'})
+    assert response.status_code == 201
+    order = response.get_json()
+    assert (order['book_title'], order['unit_price'], order['total_price']) == ('Store title', 12.5, 25.0)
+
+
+def test_unknown_book_is_rejected(client):
+    assert client.post('/orders', json={'book_id': 8, 'quantity': 1}).status_code == 400
+
+
+def test_retry_with_the_same_key_returns_the_order(client):
+    first = client.post('/orders', json={'book_id': 7, 'quantity': 1}, headers={'Idempotency-Key': 'retry-test'})
+    again = client.post('/orders', json={'book_id': 7, 'quantity': 1}, headers={'Idempotency-Key': 'retry-test'})
+    assert (first.status_code, again.status_code) == (201, 200)
+    assert again.get_json()['id'] == first.get_json()['id']
+
+
+@pytest.mark.parametrize('other', [{'book_id': 9, 'quantity': 1}, {'book_id': 7, 'quantity': 3}])
+def test_key_reused_for_another_order_is_rejected(client, other):
+    assert client.post('/orders', json={'book_id': 7, 'quantity': 1},
+                       headers={'Idempotency-Key': f'reuse-{other["book_id"]}-{other["quantity"]}'}).status_code == 201
+    response = client.post('/orders', json=other,
+                           headers={'Idempotency-Key': f'reuse-{other["book_id"]}-{other["quantity"]}'})
+    assert response.status_code == 422
+    assert response.get_json()['error'] == 'idempotency_key_reused'
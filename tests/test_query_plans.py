@@ -0,0 +1,95 @@
+"""The hot queries of the services use their indexes.
+
+Every request below is sent through the app's test client while the SELECT
+statements it runs are recorded, and each statement's EXPLAIN QUERY PLAN is
+checked: the plans must use the expected index, never sort in a temporary
+b-tree and never scan a whole table unless the case allows it, so a change
+that drops or bypasses an index fails here before it reaches a large table.
+
+The store runs on MySQL in production; its plans here come from SQLite,
+which is enough to tell whether a filter or an ORDER BY has an index.
+"""
+import re
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+# (service, method, path, JSON body, plan fragments that must appear).
+# A bare 'SCAN <table>' among the fragments allows that full scan: /catalog
+# sorted by id walks the table in rowid order and stops at the page size.
+CASES = [
+    ('store', 'GET', '/books?user_id=3', None, ['USING INDEX ix_book_user_id']),
+    ('store', 'GET', '/books/export?user_id=3', None, ['USING INDEX ix_book_user_id']),
+    ('store', 'GET', '/books/7', None, ['USING INTEGER PRIMARY KEY']),
+    ('catalog', 'GET', '/catalog', None, ['SCAN book']),
+    ('catalog', 'GET', '/catalog?sort=title', None, ['INDEX ix_book_title_id']),
+    ('catalog', 'GET', '/catalog?sort=price&order=desc&min_price=5', None, ['INDEX ix_book_price_id']),
+    ('catalog', 'GET', '/catalog?author=Author%203', None, ['INDEX ix_book_author_id']),
+    ('catalog', 'GET', '/catalog?author=Author%203&sort=title', None, ['INDEX ix_book_author_title_id']),
+    ('catalog', 'GET', '/catalog?author=Author%203&sort=price&max_price=50', None, ['INDEX ix_book_author_price_id']),
+    ('catalog', 'GET', '/catalog/search?q=title', None, ['book_fts VIRTUAL TABLE', 'USING INTEGER PRIMARY KEY']),
+    ('auth', 'POST', '/login', {'email': 'nobody@example.com', 'password': 'x'}, ['INDEX ix_user_email']),
+    ('auth', 'POST', '/register', {'username': 'someone', 'email': 'reader@example.com', 'password': 'x'},
+     ['INDEX ix_user_username', 'INDEX ix_user_email']),
+]
+
+
+@pytest.fixture(scope='module')
+def services(load_service):
+    """store, catalog and auth with a few rows, so the plans are not those of empty tables"""
+    modules = {name: load_service(name) for name in ('store', 'catalog', 'auth')}
+    for name, module in modules.items():
+        db = module.db
+        with module.app.app_context():
+            if name == 'store':
+                module.Book.query.delete()
+                db.session.add_all(module.Book(title=f'Title {i}', author=f'Author {i % 10}', price=i % 100,
+                                               stock=i % 5, user_id=i % 20) for i in range(1, 501))
+            elif name == 'catalog':
+                module.Book.query.delete()
+                db.session.add_all(module.Book(id=i, title=f'Title {i}', author=f'Author {i % 10}',
+                                               price=i % 100, stock=i % 5) for i in range(1, 501))
+            else:
+                module.User.query.filter_by(email='reader@example.com').delete()
+                db.session.add(module.User(username='reader', email='reader@example.com', password_hash='x'))
+            db.session.commit()
+            db.session.remove()
+    return modules
+
+
+@pytest.fixture
+def selects():
+    """(database, statement, parameters) of every SELECT run while the test runs"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')) and 'sqlite_master' not in statement:
+            statements.append((conn.engine.url.database, statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(Engine, 'before_cursor_execute', record)
+
+
+def explain(database, statement, parameters):
+    with sqlite3.connect(database) as conn:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+@pytest.mark.parametrize('service, method, path, body, expected', CASES,
+                         ids=[f'{case[0]} {case[1]} {case[2]}' for case in CASES])
+def test_query_uses_index(services, selects, service, method, path, body, expected):
+    response = services[service].app.test_client().open(path, method=method, json=body)
+    response.get_data()  # streamed bodies run their query while being read
+    plans = [(' '.join(statement.split()), explain(database, statement, parameters))
+             for database, statement, parameters in selects]
+    lines = [line for _, plan in plans for line in plan]
+    for fragment in expected:
+        assert any(fragment in line for line in lines), f'no plan uses {fragment!r}: {plans}'
+    for line in lines:
+        assert 'USE TEMP B-TREE' not in line, f'sorts in a temporary b-tree: {plans}'
+        assert not FULL_SCAN.match(line) or line in expected, f'scans a whole table: {plans}'
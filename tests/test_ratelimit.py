@@ -0,0 +1,21 @@
+"""Admission control of common/ratelimit.py"""
+import pytest
+
+from common import ratelimit
+
+
+@pytest.mark.parametrize('threads, expected', [(16, (12, 4)), (8, (6, 2)), (1, (1, 0)), (0, (12, 16))])
+def test_admission_fits_in_the_worker_threads(threads, expected):
+    concurrent, queue = ratelimit.admission_defaults(threads)
+    assert (concurrent, queue) == expected
+    assert not threads or concurrent + queue == threads  # every waiting request holds a thread
+
+
+def test_requests_past_the_queue_are_shed():
+    admission = ratelimit.AdmissionControl(max_concurrent=1, max_queue=0, queue_timeout=0.01)
+    admission.acquire()
+    with pytest.raises(ratelimit.Overloaded):
+        admission.acquire()
+    admission.release()
+    admission.acquire()
+    assert admission.stats()['scope'] == 'process'
@@ -0,0 +1,63 @@
+"""The gateway's ResponseCache: counters in /metrics and entries of deleted resources"""
+import pytest
+
+import cache
+
+
+@pytest.fixture
+def response_cache():
+    """A cache whose entries are never fresh, so every read after the first refreshes"""
+    response_cache = cache.ResponseCache(cache.MemoryBackend(), ttl=0, revalidate_wait=5)
+    yield response_cache
+    response_cache.executor.shutdown()
+
+
+def fetcher(*results):
+    """fetch(etag) returning, or raising, each of `results` in turn"""
+    results = list(results)
+
+    def fetch(etag):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result, None
+
+    return fetch
+
+
+def events():
+    return {key[0]: value for key, value in cache.CACHE_EVENTS.samples.items()}
+
+
+def test_lookups_are_counted_in_the_metrics_registry():
+    response_cache = cache.ResponseCache(cache.MemoryBackend())
+    before = events()
+    fetch = fetcher({'id': 1})
+    response_cache.get_or_fetch('book:1', fetch)
+    response_cache.get_or_fetch('book:1', fetch)
+    after = events()
+    assert after['misses'] - before.get('misses', 0) == 1
+    assert after['hits'] - before.get('hits', 0) == 1
+    assert 'gateway_cache_events_total{event="hits"}' in cache.metrics.REGISTRY.render()
+
+
+def test_refresh_that_finds_the_resource_gone_evicts_it(response_cache):
+    fetch = fetcher({'id': 1}, cache.Gone(), {'id': 1, 'again': True})
+    assert response_cache.get_or_fetch('book:1', fetch) == {'id': 1}
+    with pytest.raises(cache.Gone):
+        response_cache.get_or_fetch('book:1', fetch)
+    assert response_cache.backend.get('entry:book:1') is None
+    misses = response_cache.stats()['misses']
+    assert response_cache.get_or_fetch('book:1', fetch) == {'id': 1, 'again': True}
+    assert response_cache.stats()['misses'] == misses + 1
+    assert response_cache.stats()['evictions'] == 1
+
+
+def test_gone_is_not_covered_by_the_fallback_copy(response_cache):
+    fetch = fetcher({'id': 1}, cache.Gone(), RuntimeError('store down'))
+    response_cache.get_or_fetch('book:1', fetch, fallback=True)
+    response_cache.backend.delete('entry:book:1')
+    with pytest.raises(cache.Gone):
+        response_cache.get_or_fetch('book:1', fetch, fallback=True)
+    with pytest.raises(RuntimeError):
+        response_cache.get_or_fetch('book:1', fetch, fallback=True)
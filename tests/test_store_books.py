@@ -0,0 +1,117 @@
+"""Writes to books in the store racing with reservations, and idempotent reservations"""
+import uuid
+
+import pytest
+from sqlalchemy import event, insert, update
+
+
+@pytest.fixture
+def book_id(store):
+    with store.app.app_context():
+        book = store.Book(title='Raced', author='A', price=10.0, stock=5, user_id=1)
+        store.db.session.add(book)
+        store.db.session.commit()
+        book_id = book.id
+        store.db.session.remove()
+    return book_id
+
+
+@pytest.fixture
+def reserve_meanwhile(store, book_id):
+    """Take one unit with a raw UPDATE right before the request's next flush, as a concurrent reservation would"""
+    pending = [True]
+
+    def reserve(session, flush_context, instances):
+        if not pending:
+            return
+        pending.clear()
+        with store.db.engine.begin() as conn:
+            conn.execute(update(store.Book).where(store.Book.id == book_id)
+                         .values(stock=store.Book.stock - 1, version=store.Book.version + 1))
+
+    event.listen(store.db.session, 'before_flush', reserve)
+    yield
+    event.remove(store.db.session, 'before_flush', reserve)
+
+
+def test_update_racing_a_reservation_is_a_conflict(store, book_id, reserve_meanwhile):
+    response = store.app.test_client().put(f'/books/{book_id}', json={'stock': 50})
+    assert response.status_code == 409
+    assert response.get_json()['error'] == 'conflict'
+    book = store.app.test_client().get(f'/books/{book_id}').get_json()
+    assert (book['stock'], book['version']) == (4, 2)  # the reservation was not overwritten
+
+
+def test_delete_racing_a_reservation_is_a_conflict(store, book_id, reserve_meanwhile):
+    assert store.app.test_client().delete(f'/books/{book_id}').status_code == 409
+    assert store.app.test_client().get(f'/books/{book_id}').status_code == 200
+
+
+def reserve(store, book_id, quantity, key):
+    return store.app.test_client().post(f'/books/{book_id}/reserve', json={'quantity': quantity},
+                                        headers={'Idempotency-Key': key})
+
+
+def test_retried_reservation_takes_stock_once(store, book_id):
+    key = str(uuid.uuid4())
+    first = reserve(store, book_id, 2, key)
+    assert first.status_code == 200
+    again = reserve(store, book_id, 2, key)
+    assert again.status_code == 200 and again.get_json() == first.get_json()
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 3
+
+
+@pytest.mark.parametrize('other', ['quantity', 'book'])
+def test_key_reused_for_another_reservation_is_rejected(store, book_id, other):
+    key = str(uuid.uuid4())
+    assert reserve(store, book_id, 1, key).status_code == 200
+    response = reserve(store, book_id, 2, key) if other == 'quantity' else reserve(store, book_id + 1, 1, key)
+    assert response.status_code == 422
+    assert response.get_json()['error'] == 'idempotency_key_reused'
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 4
+
+
+def test_key_reused_by_a_concurrent_request_is_rejected(store, book_id, monkeypatch):
+    """The other request stores the key between our lookup and our commit"""
+    key = str(uuid.uuid4())
+    reserve_stock = store.reserve_stock
+
+    def other_request_first(*args):
+        with store.db.engine.begin() as conn:
+            conn.execute(insert(store.StockReservation).values(key=key, book_id=book_id, quantity=3, stock=2,
+                                                               version=2, created_at=store.utcnow()))
+        return reserve_stock(*args)
+
+    monkeypatch.setattr(store, 'reserve_stock', other_request_first)
+    response = reserve(store, book_id, 1, key)
+    assert response.status_code == 422
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 5  # ours was rolled back
+
+
+def release(store, book_id, quantity, key):
+    return store.app.test_client().post(f'/books/{book_id}/release', json={'quantity': quantity},
+                                        headers={'Idempotency-Key': key})
+
+
+def test_release_gives_the_stock_back_once(store, book_id):
+    key = str(uuid.uuid4())
+    assert reserve(store, book_id, 2, key).status_code == 200
+    assert release(store, book_id, 2, key).get_json()['released'] == 2
+    assert release(store, book_id, 2, key).get_json()['released'] == 0
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 5
+    assert reserve(store, book_id, 2, key).status_code == 409  # released: a retry takes nothing
+
+
+def test_release_before_the_reservation_blocks_it(store, book_id):
+    key = str(uuid.uuid4())
+    assert release(store, book_id, 2, key).get_json()['released'] == 0
+    response = reserve(store, book_id, 2, key)
+    assert response.status_code == 409 and response.get_json()['error'] == 'reservation_released'
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 5
+
+
+def test_release_of_another_reservation_is_rejected(store, book_id):
+    key = str(uuid.uuid4())
+    assert reserve(store, book_id, 2, key).status_code == 200
+    assert release(store, book_id, 3, key).status_code == 422
+    assert store.app.test_client().get(f'/books/{book_id}').get_json()['stock'] == 3
@@ -0,0 +1,58 @@
+"""Conditional GETs of the store's GET /books, versioned by the listing generation"""
+import pytest
+
+NDJSON = {'Accept': 'application/x-ndjson'}
+
+
+@pytest.fixture
+def client(store, reset_rows):
+    with reset_rows(store, store.Book) as session:
+        session.add_all(store.Book(id=i, title=f'Title {i}', author='Author', price=float(i), stock=1, user_id=1)
+                        for i in range(1, 4))
+        store.mark_books_changed()
+    return store.app.test_client()
+
+
+def list_books(client, headers=None):
+    response = client.get('/books', headers=headers)
+    response.get_data()  # read the stream, closing its request context
+    return response
+
+
+def revalidate(client, response, headers=None):
+    return list_books(client, dict(headers or {}, **{'If-None-Match': response.headers['ETag']}))
+
+
+def test_unchanged_list_is_not_modified(client):
+    first = list_books(client)
+    again = revalidate(client, first)
+    assert again.status_code == 304 and again.headers['ETag'] == first.headers['ETag']
+
+
+@pytest.mark.parametrize('write', [
+    lambda client: client.post('/books', json={'title': 'New', 'author': 'A', 'price': 1.0, 'stock': 1,
+                                               'user_id': 1}),
+    lambda client: client.put('/books/2', json={'stock': 5}),
+    lambda client: client.delete('/books/3'),
+    lambda client: client.post('/books/1/reserve', json={'quantity': 1}, headers={'Idempotency-Key': 'list-etag'}),
+])
+def test_every_write_changes_the_etag(client, write):
+    first = list_books(client)
+    assert write(client).status_code in (200, 201, 204)
+    assert revalidate(client, first).status_code == 200
+
+
+def test_delete_then_create_does_not_reuse_the_etag(client):
+    """Same count and max(id) as before, the collision of an aggregate fingerprint"""
+    first = list_books(client)
+    client.delete('/books/3')
+    client.post('/books', json={'title': 'Title 3', 'author': 'Author', 'price': 3.0, 'stock': 1, 'user_id': 1})
+    assert list_books(client).headers['ETag'] != first.headers['ETag']
+
+
+def test_json_and_ndjson_have_different_etags(client):
+    page = list_books(client)
+    stream = list_books(client, NDJSON)
+    assert stream.mimetype == 'application/x-ndjson' and page.headers['ETag'] != stream.headers['ETag']
+    assert 'Accept' in page.headers['Vary'] and 'Accept' in stream.headers['Vary']
+    assert revalidate(client, page, NDJSON).status_code == 200
@@ -0,0 +1,34 @@
+"""Streamed listings of common/streaming.py"""
+import json
+
+import pytest
+from flask import Flask
+
+from common import streaming
+
+
+def test_chunks_join_small_pieces(monkeypatch):
+    monkeypatch.setattr(streaming, 'STREAM_CHUNK_SIZE', 4)
+    assert list(streaming.chunked(['ab', 'cd', 'e', 'fghi', 'j'])) == ['abcd', 'efghi', 'j']
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    items = [{'id': i} for i in range(3)]
+    app.add_url_rule('/items', 'items', lambda: streaming.stream_json(iter(items), streaming.wants_ndjson()))
+    return app
+
+
+@pytest.mark.parametrize('headers, query', [({'Accept': 'application/x-ndjson'}, {}), ({}, {'format': 'ndjson'})])
+def test_ndjson_on_request(app, headers, query):
+    response = app.test_client().get('/items', headers=headers, query_string=query)
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == [{'id': 0}, {'id': 1},
+                                                                                          {'id': 2}]
+
+
+def test_json_array_by_default(app):
+    response = app.test_client().get('/items')
+    assert response.mimetype == 'application/json'
+    assert response.get_json() == [{'id': 0}, {'id': 1}, {'id': 2}]
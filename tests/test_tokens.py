@@ -0,0 +1,31 @@
+"""Signing keys of common/tokens.py"""
+import logging
+
+import pytest
+
+from common import tokens
+
+
+def test_missing_keys_fail(monkeypatch):
+    monkeypatch.delenv('AUTH_TOKEN_KEYS', raising=False)
+    monkeypatch.delenv('AUTH_TOKEN_DEV_KEYS', raising=False)
+    with pytest.raises(RuntimeError):
+        tokens.load_keys()
+
+
+def test_dev_keys_must_be_asked_for_and_warn(monkeypatch, caplog):
+    monkeypatch.delenv('AUTH_TOKEN_KEYS', raising=False)
+    monkeypatch.setenv('AUTH_TOKEN_DEV_KEYS', '1')
+    monkeypatch.setattr(tokens, '_dev_keys_warned', False)
+    with caplog.at_level(logging.WARNING, logger=tokens.__name__):
+        keys = tokens.load_keys()
+    assert list(keys) == ['dev']
+    assert 'public development key' in caplog.text
+
+
+def test_configured_keys_sign_and_verify(monkeypatch):
+    monkeypatch.setenv('AUTH_TOKEN_KEYS', 'new:first-secret,old:second-secret')
+    token, _, _ = tokens.issue_access_token({'sub': '1'})
+    assert tokens.TokenVerifier(tokens.load_keys('old:second-secret,new:first-secret')).verify(token)['sub'] == '1'
+    with pytest.raises(tokens.InvalidToken):
+        tokens.TokenVerifier(tokens.load_keys('old:second-secret')).verify(token)